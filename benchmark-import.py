@@ -0,0 +1,196 @@
+#!/usr/bin/env python3.4
+
+import argparse
+import concurrent.futures
+import hashlib
+import html
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+
+import lxml.etree
+import lxml.html
+from bs4 import BeautifulSoup
+from shapely.geometry import box
+
+import punktyadresowe_import
+from punktyadresowe_import import GUGiK, iMPA
+
+__log = logging.getLogger(__name__)
+
+_kml = '{http://www.opengis.net/kml/2.2}'
+
+
+class DomGUGiK(GUGiK):
+    """GUGiK parsing whole tile and each Placemark description into a tree, for comparison with streaming parser"""
+    @staticmethod
+    def _parseDescription(desc):
+        return dict(
+            (str(x.find('strong').find('span').text), x.find('span').text or '')
+            for x in lxml.html.fromstring(desc).find('ul').iterchildren()
+        )
+
+    def _parseTile(self, body):
+        doc = lxml.etree.fromstring(body.read()).find(_kml + 'Document')
+        placemarks = list(doc.iterchildren(_kml + 'Placemark'))
+        return (list(filter(self._isEligible, map(self._convertToAddress, placemarks))), len(placemarks))
+
+
+class SoupiMPA(iMPA):
+    """iMPA parsing whole GetFeatureInfo response with BeautifulSoup, for comparison with streaming parser"""
+    @staticmethod
+    def _tableToDict(table):
+        return dict(zip(
+            map(lambda x: str(x.text), table.find_all('th')),
+            map(lambda x: str(x.text), table.find_all('td'))
+        ))
+
+    def _parseFeatureInfo(self, data):
+        return list(map(self._convertToAddress, BeautifulSoup(data, 'lxml').find_all('table')))
+
+
+# source -> parser name -> class
+parsers = {
+    'gugik': {
+        'dom': DomGUGiK,
+        'stream': GUGiK,
+    },
+    'impa': {
+        'soup': SoupiMPA,
+        'stream': iMPA,
+    },
+}
+
+
+def synthetic_kml(path, count, seed=0):
+    """writes GUGiK KML GetMap response with count Placemarks to path"""
+    rnd = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n')
+        for i in range(count):
+            attributes = (
+                ('IDENTYFIKATOR_PUNKTU', 'PL.ZIPIN.%d.EMUiA_%d.1' % (i // 1000, i)),
+                ('NUMER_PORZADKOWY', str(i % 60 + 1)),
+                ('KOD_POCZTOWY', '%02d-%03d' % (i // 1000 % 100, i % 1000)),
+                ('NAZWA_MIEJSCOWOSCI', 'Miejscowość %d' % (i // 2000)),
+                ('TERYT_MIEJSCOWOSCI', '%07d' % (i // 2000)),
+                ('NAZWA_ULICY', 'Ulica "%d" & Syn' % (i // 60)),
+                ('TERYT_ULICY', '%05d' % (i // 60)),
+                ('STATUS', 'zatwierdzony'),
+            )
+            description = '<h4>Punkt adresowy</h4><ul class="textattributes">' + ''.join(
+                '<li><strong><span class="atr-name">%s</span>:</strong> <span class="atr-value">%s</span></li>' % (k, html.escape(v))
+                for (k, v) in attributes) + '</ul>'
+            f.write('<Placemark><name>%s</name><description><![CDATA[%s]]></description><Point><coordinates>%.7f,%.7f</coordinates></Point></Placemark>\n' % (
+                attributes[1][1], description, rnd.uniform(14.1, 24.1), rnd.uniform(49.0, 54.8)))
+        f.write('</Document></kml>\n')
+
+
+def synthetic_html(path, count, seed=0):
+    """writes iMPA GetFeatureInfo response with count points to path"""
+    rnd = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"></head><body>\n')
+        for i in range(count):
+            attributes = (
+                ('Numer', '%d%s' % (i % 60 + 1, 'a' if i % 7 == 0 else '')),
+                ('Kod pocztowy', '%02d-%03d ' % (i // 1000 % 100, i % 1000)),
+                ('Nazwa ulicy(Id GUS)', 'Ulica "%d" & Syn(%05d)' % (i // 60, i // 60) if i % 5 else ''),
+                ('Miejscowość(Id GUS)', 'Miejscowość %d(%07d)' % (i // 2000, i // 2000)),
+                ('GPS (WGS 84)', 'λ %.7f, φ %.7f' % (rnd.uniform(14.1, 24.1), rnd.uniform(49.0, 54.8))),
+                ('Źródło danych', 'EMUiA'),
+                ('idIIP', 'PL.ZIPIN.%d.EMUiA_%d' % (i // 1000, i)),
+            )
+            f.write('<table class="punkt">' + ''.join(
+                '<tr><th>%s</th><td>%s</td></tr>' % (html.escape(k), html.escape(v)) for (k, v) in attributes
+            ) + '</table><br>\n')
+        f.write('</body></html>\n')
+
+
+def parse(source, parser, path, keep):
+    """
+    parses path with parser in this process, returns (seconds, number of addresses, digest of addresses, peak RSS
+    in MB). Without keep, all GUGiK addresses are outside of imported area, so memory is used only by parser. iMPA
+    keeps all addresses
+    """
+    # mapping needs dictionaries downloaded from OSM and TERYT, it is not part of parsing
+    punktyadresowe_import.mapstreet = lambda name, sym_ul: name
+    punktyadresowe_import.mapcity = lambda name, simc: name
+    start = time.perf_counter()
+    if source == 'impa':
+        imp = parsers[source][parser](wms='http://localhost/')
+        with open(path, 'rb') as f:
+            ret = imp._parseFeatureInfo(f.read())
+    else:
+        imp = parsers[source][parser](None)
+        imp.shape = box(-180, -90, 180, 90) if keep else box(0, 0, 0.001, 0.001)
+        with open(path, 'rb') as f:
+            ret = imp._parseTile(f)[0]
+    seconds = time.perf_counter() - start
+    digest = hashlib.sha1()
+    for addr in ret:
+        digest.update(repr((addr.to_JSON(), getattr(addr, 'status', None), getattr(addr, 'wazny_do', None))).encode('utf-8'))
+    return (seconds, len(ret), digest.hexdigest(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def run(source, parser, path, keep):
+    # each run in new, not forked process, so peak memory is its own. Peak memory is inherited by child process on
+    # Linux, so only digest of addresses is passed back, to keep this process small
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(parse, source, parser, path, keep).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares speed and memory use of GUGiK KML and iMPA GetFeatureInfo " +
+                                     "parsers on recorded responses. Time and peak memory of GUGiK parsers are measured " +
+                                     "without keeping parsed addresses")
+    parser.add_argument('--gugik-kml', action='append', default=[], dest='gugik_kml',
+                        help='GUGiK KML GetMap response, as downloaded by GUGiK.fetchTiles, may be given more than once')
+    parser.add_argument('--impa-html', action='append', default=[], dest='impa_html',
+                        help='iMPA GetFeatureInfo response, as downloaded by iMPA.fetchTiles, may be given more than once')
+    parser.add_argument('--synthetic', type=int, action='append', default=[],
+                        help='test also on generated GUGiK KML and iMPA HTML with that many points, may be given more than once')
+    parser.add_argument('--source', action='append', choices=sorted(parsers.keys()), dest='sources',
+                        help='limit synthetic tests to this source, may be given more than once (default: all)')
+    parser.add_argument('--parser', action='append', choices=sorted(set(itertools.chain.from_iterable(parsers.values()))),
+                        dest='parsers', help='parser to test, may be given more than once (default: all)')
+    parser.add_argument('--log-level', help='Set logging level (debug=10, info=20, warning=30, error=40, critical=50), default: 30', dest='log_level', default=30, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [('gugik', x) for x in args.gugik_kml] + [('impa', x) for x in args.impa_html]
+        for count in args.synthetic:
+            if 'gugik' in (args.sources or parsers):
+                paths.append(('gugik', os.path.join(tmp, 'synthetic-%d.kml' % (count,))))
+                synthetic_kml(paths[-1][1], count)
+            if 'impa' in (args.sources or parsers):
+                paths.append(('impa', os.path.join(tmp, 'synthetic-%d.html' % (count,))))
+                synthetic_html(paths[-1][1], count)
+        if not paths:
+            parser.error('no files given')
+
+        print("%-30s %8s %-8s %-8s %9s %12s %8s %10s %11s" % ('file', 'MB', 'source', 'parser', 'time [s]', 'points/s', 'MB/s', 'peak [MB]', 'same as 1st'))
+        for (source, path) in paths:
+            size = os.path.getsize(path) / 1024 / 1024
+            reference = None
+            for name in sorted(parsers[source].keys()):
+                if args.parsers and name not in args.parsers:
+                    continue
+                (seconds, _, _, peak) = run(source, name, path, False)
+                (_, count, digest, _) = run(source, name, path, True)
+                if reference is None:
+                    reference = digest
+                print("%-30s %8.1f %-8s %-8s %9.3f %12.0f %8.1f %10.1f %11s" % (
+                    os.path.basename(path)[-30:], size, source, name, seconds, count / seconds, size / seconds, peak,
+                    'yes' if digest == reference else 'NO'
+                ))
+
+if __name__ == '__main__':
+    main()
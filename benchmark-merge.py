@@ -0,0 +1,291 @@
+#!/usr/bin/env python3.4
+
+import argparse
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import math
+import random
+import sys
+import time
+
+import overpass
+import punktyadresowe_import
+from punktyadresowe_import import Address
+import merger
+import spatialindex
+
+__log = logging.getLogger(__name__)
+
+# synthetic gmina: villages on a grid, each with streets of houses
+_origin = (52.0, 21.0)
+_degrees_per_meter = 1 / 111320.0
+_houses_per_street = 40
+_streets_per_village = 20
+_house_spacing = 25.0
+_street_spacing = 60.0
+_village_spacing = 3000.0
+_boundary_margin = 200.0
+_terc = '9999999'
+
+_meta = {'version': 1, 'timestamp': '2015-01-01T00:00:00Z', 'changeset': 1, 'uid': 1, 'user': 'synthetic'}
+
+# phases compared with baseline, in order of execution
+_phases = ('osmdb_load', 'index_rebuild', 'pre_merge', 'merge', 'post_merge', 'xml_output')
+
+
+def generate(count, seed=0, duplicate_ratio=0.05, offset_ratio=0.1, mismatch_ratio=0.05, relation_ratio=0.02,
+             osm_address_ratio=0.6):
+    """
+    returns (osm, boundary, addresses) for synthetic gmina with count buildings and import addresses:
+    osm - Overpass JSON with buildings (ways and multipolygon relations) and address nodes, as from merger.getAddresses()
+    boundary - Overpass JSON with boundary relation, as queried by merger.get_boundary_shape()
+    addresses - list of Address, one per building
+
+    osm_address_ratio - part of buildings with address in OSM, on the building or as a node within
+    mismatch_ratio - part of OSM addresses with different street name or housenumber, than in import
+    duplicate_ratio - part of OSM addresses, that have another node with the same address 20-200m away
+    offset_ratio - part of import addresses placed 3-30m from the center of the building
+    """
+    rnd = random.Random(seed)
+    ids = itertools.count(1)
+    elements = []
+    addresses = []
+    columns = int(math.ceil(math.sqrt(math.ceil(count / (_houses_per_street * _streets_per_village)))))
+    dlat = _degrees_per_meter
+    dlon = _degrees_per_meter / math.cos(math.radians(_origin[0]))
+
+    def node(lat, lon, tags=None):
+        ret = dict(_meta, type='node', id=next(ids), lat=round(lat, 7), lon=round(lon, 7))
+        if tags:
+            ret['tags'] = tags
+        elements.append(ret)
+        return ret
+
+    def way(corners, tags):
+        nodes = [node(lat, lon) for (lat, lon) in corners]
+        lats = [x['lat'] for x in nodes]
+        lons = [x['lon'] for x in nodes]
+        ret = dict(_meta, type='way', id=next(ids), nodes=[x['id'] for x in nodes] + [nodes[0]['id']], tags=tags,
+                   bounds={'minlat': min(lats), 'minlon': min(lons), 'maxlat': max(lats), 'maxlon': max(lons)})
+        elements.append(ret)
+        return ret
+
+    def moved(point, min_meters, max_meters):
+        dist = rnd.uniform(min_meters, max_meters)
+        angle = rnd.uniform(0, 2 * math.pi)
+        return (point[0] + dist * math.sin(angle) * dlat, point[1] + dist * math.cos(angle) * dlon)
+
+    for i in range(count):
+        (village, house) = divmod(i, _houses_per_street * _streets_per_village)
+        (street, number) = divmod(house, _houses_per_street)
+        (row, column) = divmod(village, columns)
+        lat = _origin[0] + (row * _village_spacing + street * _street_spacing) * dlat
+        lon = _origin[1] + (column * _village_spacing + number * _house_spacing) * dlon
+        city = 'Wieś %d' % (village + 1,)
+        street_name = 'Ulica %d' % (street + 1,)
+        housenumber = str(number + 1)
+
+        building = way(((lat, lon), (lat + 10 * dlat, lon), (lat + 10 * dlat, lon + 12 * dlon), (lat, lon + 12 * dlon)),
+                       {'building': 'house'})
+        if rnd.random() < relation_ratio:
+            outer = building
+            building = dict(_meta, type='relation', id=next(ids), bounds=outer['bounds'], tags=outer['tags'],
+                            members=[{'type': 'way', 'ref': outer['id'], 'role': 'outer'}])
+            building['tags']['type'] = 'multipolygon'
+            outer['tags'] = {}
+            elements.append(building)
+        center = (lat + 5 * dlat, lon + 6 * dlon)
+
+        if rnd.random() < osm_address_ratio:
+            tags = {'addr:city': city, 'addr:street': street_name, 'addr:housenumber': housenumber}
+            if rnd.random() < mismatch_ratio:
+                if rnd.random() < 0.5:
+                    tags['addr:street'] = 'Stara ' + street_name
+                else:
+                    tags['addr:housenumber'] = housenumber + 'A'
+            if rnd.random() < 2 / 3:
+                building['tags'].update(tags)
+            else:
+                node(center[0], center[1], dict(tags))
+            if rnd.random() < duplicate_ratio:
+                node(*moved(center, 20, 200), tags=dict(tags))
+
+        location = moved(center, 3, 30) if rnd.random() < offset_ratio else center
+        addresses.append(Address(housenumber, '', street_name, city, '', '', 'synthetic',
+                                 {'lat': '%.7f' % location[0], 'lon': '%.7f' % location[1]},
+                                 id_=str(i + 1), last_change='2015-01-01'))
+
+    osm = {'version': 0.6, 'generator': 'benchmark-merge.py', 'osm3s': {'timestamp_osm_base': _meta['timestamp']},
+           'elements': elements}
+
+    # boundary around all villages, node() and way() add to new elements list
+    rows = int(math.ceil(math.ceil(count / (_houses_per_street * _streets_per_village)) / columns))
+    (south, west) = (_origin[0] - _boundary_margin * dlat, _origin[1] - _boundary_margin * dlon)
+    north = _origin[0] + ((rows - 1) * _village_spacing + _streets_per_village * _street_spacing + _boundary_margin) * dlat
+    east = _origin[1] + ((columns - 1) * _village_spacing + _houses_per_street * _house_spacing + _boundary_margin) * dlon
+    elements = []
+    outer = way(((south, west), (north, west), (north, east), (south, east)), {})
+    relation = dict(_meta, type='relation', id=next(ids), bounds=outer['bounds'],
+                    members=[{'type': 'way', 'ref': outer['id'], 'role': 'outer'}],
+                    tags={'type': 'boundary', 'boundary': 'administrative', 'admin_level': '7', 'teryt:terc': _terc})
+    boundary = {'version': 0.6, 'generator': 'benchmark-merge.py', 'elements': [relation] + elements}
+    return (osm, boundary, addresses)
+
+
+def work_offline(boundaries):
+    """
+    makes Overpass queries for boundary relations return values from boundaries dict (terc -> Overpass JSON)
+    and fails on any other request to Overpass or TERYT
+    """
+    def query_json(qry):
+        for (terc, boundary) in boundaries.items():
+            if '"%s"' % (terc,) in qry:
+                return json.loads(json.dumps(boundary))
+        raise RuntimeError("Benchmark runs offline, unexpected Overpass query: %s" % (qry,))
+
+    def offline(qry):
+        raise RuntimeError("Benchmark runs offline, unexpected Overpass query: %s" % (qry,))
+
+    overpass.query_json = query_json
+    overpass._open = offline
+    # street and city mapping download dictionaries from Overpass and TERYT, synthetic names need no mapping
+    punktyadresowe_import.mapstreet = lambda name, sym_ul: name
+    punktyadresowe_import.mapcity = lambda name, simc: name
+
+
+@contextlib.contextmanager
+def timer(timings, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def benchmark(osm, addresses, columnar=False, spatial_index=spatialindex.RtreeIndex, projected=False):
+    """merges addresses with osm and returns timings of each phase, strategy hits and checksum of result"""
+    timings = collections.OrderedDict()
+    shape = merger.get_boundary_shape(_terc)
+    with timer(timings, 'osmdb_load'):
+        m = merger.Merger(addresses, osm, _terc, columnar=columnar, spatial_index=spatial_index, projected=projected,
+                          import_area_shape=shape, profile=0)
+    # OsmDb builds its indexes when loaded, so this times rebuilding all of them over already loaded elements
+    with timer(timings, 'index_rebuild'):
+        m.osmdb.update_index()
+    m.post_func.append(m.merge_addresses)
+    m.merge()
+    for name in ('pre_merge', 'merge', 'post_merge'):
+        timings[name] = m.profile.sections[name]['wall_s']
+    with timer(timings, 'xml_output'):
+        result = b''.join(m.iter_incremental_result())
+    return {
+        'timings': timings,
+        'hits': dict((name.split('/', 1)[1], stats['hits']) for (name, stats) in m.profile.sections.items()
+                     if name.startswith('merge/')),
+        'output_sha1': hashlib.sha1(result).hexdigest(),
+        'output_bytes': len(result),
+    }
+
+
+def compare(name, ret, baseline, tolerance):
+    """prints ret compared to baseline, returns False if result differs or any phase is slower than allowed"""
+    ok = True
+    print("%s, %d bytes of output" % (name, ret['output_bytes']))
+    print("  %-13s %10s %12s %8s" % ('phase', 'time [s]', 'baseline [s]', 'ratio'))
+    for phase in _phases:
+        now = ret['timings'][phase]
+        before = baseline['timings'].get(phase) if baseline else None
+        if before:
+            ratio = now / before
+            slower = ratio > 1 + tolerance
+            ok &= not slower
+            print("  %-13s %10.3f %12.3f %8.2f%s" % (phase, now, before, ratio, ' SLOWER' if slower else ''))
+        else:
+            print("  %-13s %10.3f %12s %8s" % (phase, now, '-', '-'))
+    print("  strategy hits: %s" % (", ".join("%s=%d" % x for x in sorted(ret['hits'].items())),))
+    if baseline and (baseline['output_sha1'], baseline['hits']) != (ret['output_sha1'], ret['hits']):
+        print("  RESULT CHANGED: output %s, baseline %s" % (ret['output_sha1'], baseline['output_sha1']))
+        ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times loading, each merge phase and XML output of merger.py on synthetic gminas, " +
+                                     "and compares them with stored baseline. Runs offline")
+    parser.add_argument('--addresses', type=int, action='append', dest='counts',
+                        help='number of addresses (and buildings) in gmina, may be given more than once (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--osm-address-ratio', type=float, default=0.6, dest='osm_address_ratio',
+                        help='part of buildings with address in OSM (default: 0.6)')
+    parser.add_argument('--mismatch-ratio', type=float, default=0.05, dest='mismatch_ratio',
+                        help='part of OSM addresses with different street or housenumber than import (default: 0.05)')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.05, dest='duplicate_ratio',
+                        help='part of OSM addresses duplicated 20-200m away (default: 0.05)')
+    parser.add_argument('--offset-ratio', type=float, default=0.1, dest='offset_ratio',
+                        help='part of import addresses 3-30m from building center (default: 0.1)')
+    parser.add_argument('--relation-ratio', type=float, default=0.02, dest='relation_ratio',
+                        help='part of buildings mapped as multipolygon relations (default: 0.02)')
+    parser.add_argument('--low-memory', action='store_const', const=True, default=False, dest='low_memory',
+                        help='use ColumnarOsmDb, as merger.py --low-memory. Use for 100k addresses and more')
+    parser.add_argument('--projected', action='store_const', const=True, default=False)
+    parser.add_argument('--spatial-index', choices=sorted(spatialindex.backends.keys()), default='rtree', dest='spatial_index')
+    parser.add_argument('--baseline', help='JSON file with baseline results', dest='baseline')
+    parser.add_argument('--save-baseline', action='store_const', const=True, default=False, dest='save_baseline',
+                        help='store results in baseline file instead of failing on differences')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='merge each gmina that many times and take the shortest time of each phase (default: 1)')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown of a phase against baseline, as a fraction (default: 0.25)')
+    parser.add_argument('--log-level', help='Set logging level (debug=10, info=20, warning=30, error=40, critical=50), default: 40',
+                        dest='log_level', default=40, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    baselines = {}
+    if args.baseline:
+        try:
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                baselines = json.load(f)
+        except FileNotFoundError:
+            __log.warning("No baseline file %s", args.baseline)
+
+    boundaries = {}
+    work_offline(boundaries)
+    ok = True
+    for count in args.counts or [1000]:
+        # results depend on data and settings, so they are part of baseline name
+        name = "%d addresses, seed=%d, osm=%s, mismatch=%s, duplicate=%s, offset=%s, relation=%s, %s, %s%s" % (
+            count, args.seed, args.osm_address_ratio, args.mismatch_ratio, args.duplicate_ratio, args.offset_ratio,
+            args.relation_ratio, 'columnar' if args.low_memory else 'dict', args.spatial_index,
+            ', projected' if args.projected else ''
+        )
+        ret = None
+        for _ in range(args.repeat):
+            # merge changes data, so it is generated again for each run
+            start = time.perf_counter()
+            (osm, boundaries[_terc], addresses) = generate(count, args.seed, args.duplicate_ratio, args.offset_ratio,
+                                                           args.mismatch_ratio, args.relation_ratio, args.osm_address_ratio)
+            __log.info("Generated %d elements in %.1fs", len(osm['elements']), time.perf_counter() - start)
+            current = benchmark(osm, addresses, columnar=args.low_memory, spatial_index=spatialindex.backends[args.spatial_index],
+                                projected=args.projected)
+            del osm, addresses
+            if ret is None:
+                ret = current
+            else:
+                ret['timings'] = collections.OrderedDict((k, min(v, current['timings'][k])) for (k, v) in ret['timings'].items())
+        ok &= compare(name, ret, None if args.save_baseline else baselines.get(name), args.tolerance)
+        if args.save_baseline:
+            baselines[name] = ret
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3.4
+
+import argparse
+import json
+import logging
+import random
+import time
+
+import numpy as np
+
+from osmdb import _get_id, get_soup_position
+import spatialindex
+
+__log = logging.getLogger(__name__)
+
+
+class InsertRtreeIndex(spatialindex.RtreeIndex):
+    """R-tree filled with one insert per element, for comparison with bulk loading"""
+    def __init__(self, ids=(), bounds=()):
+        super(InsertRtreeIndex, self).__init__()
+        for (i, b) in zip(*spatialindex._as_arrays(ids, bounds)):
+            self.insert(int(i), b.tolist())
+
+backends = dict(spatialindex.backends, **{'rtree-insert': InsertRtreeIndex})
+
+
+def load_osm(fileobj):
+    """returns (ids, bounds) of elements in Overpass JSON file, as they are put in OsmDb index"""
+    elements = json.load(fileobj)['elements']
+    ids = list(map(_get_id, elements))
+    bounds = list(map(get_soup_position, elements))
+    return (ids, bounds)
+
+
+def random_data(count, seed):
+    """returns (ids, bounds) of count small boxes, distributed as buildings in some clusters (villages)"""
+    rnd = np.random.default_rng(seed)
+    centers = rnd.uniform((50.0, 19.0), (50.2, 19.3), size=(max(1, count // 500), 2))
+    points = centers[rnd.integers(0, len(centers), size=count)] + rnd.normal(0, 0.005, size=(count, 2))
+    sizes = rnd.uniform(0, 0.0003, size=(count, 2))
+    return (np.arange(count, dtype=np.int64) * 3 + 1, np.hstack((points, points + sizes)))
+
+
+def benchmark(name, cls, ids, bounds, queries, num_results):
+    start = time.perf_counter()
+    idx = cls(ids, bounds)
+    build = time.perf_counter() - start
+
+    latencies = []
+    results = []
+    for q in queries:
+        start = time.perf_counter()
+        results.append(set(idx.nearest(q, num_results)))
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1e6
+    return {
+        'backend': name,
+        'build_s': build,
+        'nearest_mean_us': latencies.mean(),
+        'nearest_p50_us': np.percentile(latencies, 50),
+        'nearest_p99_us': np.percentile(latencies, 99),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares build time and nearest() latency of OsmDb spatial index backends on the same dataset")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--addresses-file', type=argparse.FileType("r", encoding='UTF-8'), dest='addresses_file',
+                        help='Overpass JSON file, as used by merger.py')
+    source.add_argument('--random', type=int, help='number of random boxes to generate')
+    parser.add_argument('--queries', type=int, default=10000, help='number of nearest queries (default: 10000)')
+    parser.add_argument('--num-results', type=int, default=10, dest='num_results', help='num_results for nearest queries (default: 10)')
+    parser.add_argument('--backend', action='append', choices=sorted(backends.keys()), dest='backends',
+                        help='backend to test, may be given more than once (default: all)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', help='Set logging level (debug=10, info=20, warning=30, error=40, critical=50), default: 20', dest='log_level', default=20, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    if args.addresses_file:
+        (ids, bounds) = load_osm(args.addresses_file)
+    else:
+        (ids, bounds) = random_data(args.random, args.seed)
+    (ids, bounds) = spatialindex._as_arrays(ids, bounds)
+    __log.info("Dataset: %d boxes", len(ids))
+
+    rnd = random.Random(args.seed)
+    (minx, miny) = bounds[:, :2].min(axis=0)
+    (maxx, maxy) = bounds[:, 2:].max(axis=0)
+    queries = [(rnd.uniform(minx, maxx), rnd.uniform(miny, maxy)) * 2 for _ in range(args.queries)]
+
+    reference = None
+    print("%-12s %10s %12s %12s %12s %12s" % ('backend', 'build [s]', 'mean [us]', 'p50 [us]', 'p99 [us]', 'same as 1st'))
+    for name in args.backends or sorted(backends.keys()):
+        ret = benchmark(name, backends[name], ids, bounds, queries, args.num_results)
+        if reference is None:
+            reference = ret['results']
+        same = sum(1 for (a, b) in zip(reference, ret['results']) if a == b)
+        print("%-12s %10.3f %12.1f %12.1f %12.1f %11.1f%%" % (
+            name, ret['build_s'], ret['nearest_mean_us'], ret['nearest_p50_us'], ret['nearest_p99_us'],
+            100.0 * same / max(1, len(queries))
+        ))
+
+if __name__ == '__main__':
+    main()
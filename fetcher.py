@@ -0,0 +1,323 @@
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import http.client
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+__log = logging.getLogger(__name__)
+
+
+class _Body(object):
+    """response body, that raises socket.timeout when read after deadline"""
+    def __init__(self, response, deadline):
+        self._response = response
+        self._deadline = deadline
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(1024*1024), b''))
+        if time.monotonic() > self._deadline:
+            raise socket.timeout("Download not finished within timeout")
+        ret = self._response.read(size)
+        if not ret and size and self._response.length:
+            # http.client returns shorter body, when connection is closed early
+            raise http.client.IncompleteRead(b'', self._response.length)
+        return ret
+
+
+class _CachingBody(object):
+    """response body, that writes everything read to cache file. Cache entry is added by commit()"""
+    def __init__(self, body, cache, url, validators):
+        self._body = body
+        self._cache = cache
+        self._url = url
+        self._validators = validators
+        self._file = tempfile.NamedTemporaryFile(dir=cache.directory, prefix='tmp', delete=False)
+
+    def read(self, size=-1):
+        ret = self._body.read(size)
+        self._file.write(ret)
+        return ret
+
+    def commit(self):
+        while self.read(1024*1024):
+            pass
+        self._file.close()
+        self._cache.add(self._url, self._file.name, self._validators)
+
+    def discard(self):
+        self._file.close()
+        with contextlib.suppress(OSError):
+            os.remove(self._file.name)
+
+
+class HttpCache(object):
+    """
+    On-disk cache of HTTP responses. Responses are used without asking the server for ttl seconds, after that
+    they are revalidated using ETag and Last-Modified. Least recently used responses are removed, when all
+    responses take more than max_size bytes
+    """
+    __log = logging.getLogger(__name__).getChild('HttpCache')
+    _default_ports = {'http': 80, 'https': 443}
+
+    def __init__(self, directory, ttl=24*3600, max_size=1024*1024*1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def normalize_url(url):
+        """returns url with lowercase scheme and host, without default port and fragment, and with sorted query"""
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        netloc = (parts.hostname or '').lower()
+        if parts.port and parts.port != HttpCache._default_ports.get(scheme):
+            netloc += ':%d' % (parts.port,)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(self.normalize_url(url).encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """returns cache entry for url or None"""
+        path = self._path(url)
+        try:
+            with open(path + '.json', encoding='utf-8') as f:
+                entry = json.load(f)
+            if os.path.getsize(path + '.body') != entry['size']:
+                # body written by another thread, metadata not yet
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        entry['path'] = path
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored'] < self.ttl
+
+    def read(self, entry, func):
+        """returns func(body) for body of cached entry"""
+        self.__log.debug("Using cached response for %s", entry['url'])
+        with open(entry['path'] + '.body', 'rb') as f:
+            # modification time of body is time of last use
+            os.utime(f.fileno())
+            return func(f)
+
+    def _write_entry(self, entry):
+        path = entry.pop('path')
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.directory, prefix='tmp', delete=False) as f:
+            json.dump(entry, f)
+        os.replace(f.name, path + '.json')
+
+    def refresh(self, entry):
+        """marks entry as validated with server now"""
+        entry = dict(entry, stored=time.time())
+        self._write_entry(entry)
+
+    def tee(self, url, body, headers):
+        """returns body, which stores everything read into cache, after call to commit()"""
+        validators = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        return _CachingBody(body, self, url, validators)
+
+    def add(self, url, filename, validators):
+        path = self._path(url)
+        size = os.path.getsize(filename)
+        os.replace(filename, path + '.body')
+        self._write_entry(dict(validators, path=path, url=self.normalize_url(url), stored=time.time(), size=size))
+        self.evict()
+
+    def evict(self):
+        """removes least recently used responses, until they take at most max_size bytes"""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                with contextlib.suppress(OSError):
+                    stat = entry.stat()
+                    if entry.name.endswith('.body'):
+                        entries.append((stat.st_mtime, stat.st_size, entry.path[:-len('.body')]))
+                    elif entry.name.startswith('tmp') and stat.st_mtime < time.time() - 24*3600:
+                        # left by interrupted download
+                        os.remove(entry.path)
+            total = sum(x[1] for x in entries)
+            for (_, size, path) in sorted(entries):
+                if total <= self.max_size:
+                    break
+                self.__log.debug("Removing %s from cache", path)
+                for suffix in ('.json', '.body'):
+                    with contextlib.suppress(OSError):
+                        os.remove(path + suffix)
+                total -= size
+
+
+class Fetcher(object):
+    """
+    Downloads over HTTP with at most max_per_host connections to one host at a time. Connections are kept alive
+    and reused. Requests failing with network errors, timeouts or 429 and 5xx responses are retried up to retries
+    times, waiting backoff seconds, twice as long after each failure. Other HTTP errors are raised as
+    urllib.error.HTTPError at once. Responses are stored in cache, if HttpCache is given
+    """
+    __log = logging.getLogger(__name__).getChild('Fetcher')
+    _retry_status = (429, 500, 502, 503, 504)
+    _redirect_status = (301, 302, 303, 307, 308)
+
+    def __init__(self, headers=None, max_per_host=4, timeout=300.0, retries=4, backoff=2.0, max_redirects=5, cache=None):
+        """
+        headers - headers sent with each request
+        timeout - seconds, in which whole response has to be downloaded
+        """
+        self.headers = dict(headers or {})
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_redirects = max_redirects
+        self.cache = cache
+        self._lock = threading.Lock()
+        # (scheme, host) -> (semaphore, idle connections)
+        self._hosts = {}
+
+    def _get_host(self, key):
+        with self._lock:
+            try:
+                return self._hosts[key]
+            except KeyError:
+                ret = self._hosts[key] = (threading.BoundedSemaphore(self.max_per_host), [])
+                return ret
+
+    @contextlib.contextmanager
+    def _connection(self, key):
+        """yields idle or new connection to host, it is kept for reuse unless an exception is raised"""
+        (semaphore, idle) = self._get_host(key)
+        with semaphore:
+            with self._lock:
+                conn = idle.pop() if idle else None
+            if conn is None:
+                conn_class = http.client.HTTPSConnection if key[0] == 'https' else http.client.HTTPConnection
+                conn = conn_class(key[1], timeout=self.timeout)
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            with self._lock:
+                idle.append(conn)
+
+    def _fetch_once(self, url, func, cached=None):
+        deadline = time.monotonic() + self.timeout
+        headers = dict(self.headers, **{'Accept-Encoding': 'gzip'})
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        orig_url = url
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            with self._connection((parts.scheme, parts.netloc)) as conn:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                if response.status in self._redirect_status and response.getheader('Location'):
+                    response.read()
+                    url = urljoin(url, response.getheader('Location'))
+                    continue
+                if response.status == 304 and cached is not None:
+                    response.read()
+                    break
+                if response.status != 200:
+                    response.read()
+                    raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+                body = _Body(response, deadline)
+                if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+                    body = gzip.GzipFile(fileobj=body, mode='rb')
+                if self.cache is not None:
+                    body = self.cache.tee(orig_url, body, response.headers)
+                    try:
+                        ret = func(body)
+                        body.commit()
+                    except BaseException:
+                        body.discard()
+                        raise
+                else:
+                    ret = func(body)
+                # connection can be reused only after whole response is read
+                response.read()
+                if response.will_close:
+                    conn.close()
+                return ret
+        else:
+            raise urllib.error.HTTPError(url, 310, "Too many redirects", None, None)
+        # not modified since cached
+        self.cache.refresh(cached)
+        return self.cache.read(cached, func)
+
+    def fetch(self, url, func=lambda x: x.read()):
+        """
+        downloads url and returns func(body), body is a file-like object with response body. func is called
+        again when download fails while it reads the body. Fresh responses from cache are used without download.
+        Response is stored in cache only if func returns, so func should raise on invalid response
+        """
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None and self.cache.is_fresh(cached):
+            try:
+                return self.cache.read(cached, func)
+            except FileNotFoundError:
+                # removed from cache meanwhile
+                pass
+        for attempt in itertools.count():
+            try:
+                return self._fetch_once(url, func, self.cache.get(url) if self.cache is not None else None)
+            except urllib.error.HTTPError as e:
+                if e.code not in self._retry_status or attempt >= self.retries:
+                    raise
+                error = e
+            except (OSError, http.client.HTTPException) as e:
+                if attempt >= self.retries:
+                    raise
+                error = e
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+            self.__log.warning("Download of %s failed (%s), retrying in %.1fs", url, error, delay)
+            time.sleep(delay)
+
+    def map(self, func, urls, errors=()):
+        """
+        returns list of fetch(url, func) for each of urls. Urls are downloaded concurrently, each is passed
+        to func as soon as response arrives. Exceptions of classes in errors are returned in place of result,
+        other exceptions are raised
+        """
+        def fetch(url):
+            try:
+                return self.fetch(url, func)
+            except errors as e:
+                return e
+
+        urls = list(urls)
+        if not urls:
+            return []
+        hosts = set(urlsplit(x)[:2] for x in urls)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(urls), self.max_per_host * len(hosts))) as executor:
+            return list(executor.map(fetch, urls))
+
+    def close(self):
+        with self._lock:
+            for (_, idle) in self._hosts.values():
+                for conn in idle:
+                    conn.close()
+                del idle[:]
@@ -1,16 +1,28 @@
 #!/usr/bin/env python3.4
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import heapq
 import logging
 import io
 import itertools
+import math
+import numpy as np
+import os
 import sys
-from osmdb import OsmDb, get_soup_center, distance
+import time
+from osmdb import OsmDb, ColumnarOsmDb, get_soup_center, distance, load_snapshot, snapshot_covers, _get_id
 import json
+import shapely
 from shapely.geometry import Point
 import shapely.geometry.base
 from punktyadresowe_import import iMPA, GUGiK, Address
 import overpass
+import spatialindex
 from utils import parallel_map
 from lxml.builder import E
 import lxml.etree
@@ -18,10 +30,10 @@ import lxml.etree
 __log = logging.getLogger(__name__)
 
 # depends FreeBSD
-# portmaster graphics/py-pyproj devel/py-rtree devel/py-shapely www/py-beautifulsoup devel/py-lxml
+# portmaster graphics/py-pyproj devel/py-rtree devel/py-shapely www/py-beautifulsoup devel/py-lxml math/py-numpy
 
 # depeds Lubuntu:
-# apt-get install python3-pyproj libspatialindex-dev python3-shapely python3-bs4 python3-lxml
+# apt-get install python3-pyproj libspatialindex-dev python3-shapely python3-bs4 python3-lxml python3-numpy
 # easy_install3 Rtree
 
 # TODO: import admin_level=8 for area, and add addr:city if missing for addresses within that area (needs greater refactoring)
@@ -234,54 +246,654 @@ class OsmAddress(Address):
         return root
 
 
+class ChangeSet(object):
+    """
+    set of OSM entries keeping insertion order. Entries are keyed by integer key of their type and id,
+    so membership checks take constant time and entries added more than once are kept once
+    """
+    def __init__(self, entries=()):
+        self._entries = {}
+        self.update(entries)
+
+    def add(self, entry):
+        self._entries.setdefault(_get_id(entry._raw), entry)
+
+    def update(self, entries):
+        for entry in entries:
+            self.add(entry)
+
+    def __contains__(self, entry):
+        return _get_id(entry._raw) in self._entries
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CandidateContext(object):
+    """
+    OSM objects near one import address, shared by merge strategies and pre_func functions.
+    Spatial index is queried once, with the largest radius used by strategies, and distance, contains
+    and similar_to checks are computed once per candidate. Geometry does not change during merge,
+    but addresses do, so similar_to results are dropped with forget_addresses()
+    """
+    radius = 10.0
+
+    def __init__(self, merger, entry):
+        self.entry = entry
+        self._merger = merger
+        self._candidates = None
+        self._distances = {}
+        self._approx_distances = {}
+        self._contains = {}
+        self._similar = {}
+
+    @staticmethod
+    def _key(x):
+        return (x.objtype, x['id'])
+
+    def _query(self):
+        if self._candidates is None:
+            # contexts are created in pre-merge and kept until the entry is merged. When pre-merge of the entry ran
+            # elsewhere (tiles merged in other processes, pre-merge replayed by incremental merge), the context is
+            # created in merge, after points may have been added for other entries, so new points are skipped
+            self._candidates = [x for x in self._merger.osmdb.within_radius(self.entry.center, self.radius, with_distances=True)
+                                if not x[0].is_new()]
+            self._merger.profile.count('candidate_queries')
+            self._merger.profile.count('candidates', len(self._candidates))
+            self._merger._add_deps(x for (x, _) in self._candidates)
+        return self._candidates
+
+    def candidates(self, meters=None, filter=None):
+        """
+        returns OSM objects, which bounding boxes are within meters (default: radius) from the address,
+        ordered by that distance. filter - function called on each candidate, returns False for entries to skip
+        """
+        if meters is None:
+            meters = self.radius
+        if meters > self.radius:
+            raise ValueError("Radius %s is larger than context radius %s" % (meters, self.radius))
+        ret = [x for (x, dist) in self._query() if dist <= meters and (filter is None or filter(x))]
+        self._merger.profile.count('candidate_lists')
+        self._merger.profile.count('candidate_list_entries', len(ret))
+        return ret
+
+    def distances(self, entries, approx=False):
+        """
+        returns list of distances in meters between address and center of each of entries. approx=True uses
+        fast approximation, for threshold checks, see osmdb.distances()
+        """
+        cache = self._approx_distances if approx else self._distances
+        missing = dict((self._key(x), x) for x in entries if self._key(x) not in cache)
+        self._merger.profile.count('distances_requested', len(entries))
+        if missing:
+            if not cache:
+                # compute all candidates at once, they are checked by most strategies
+                missing.update((self._key(x), x) for (x, _) in self._query())
+            keys = list(missing.keys())
+            self._merger.profile.count('distances_computed', len(keys))
+            cache.update(zip(keys, self._merger.osmdb.distances(self.entry.center, [missing[x] for x in keys], approx).tolist()))
+        return [cache[self._key(x)] for x in entries]
+
+    def distance(self, entry, approx=False):
+        return self.distances((entry,), approx)[0]
+
+    def containing(self, entries):
+        """returns list telling which of entries contain the address"""
+        missing = dict((self._key(x), x) for x in entries if self._key(x) not in self._contains)
+        self._merger.profile.count('contains_requested', len(entries))
+        if missing:
+            keys = list(missing.keys())
+            self._merger.profile.count('contains_computed', len(keys))
+            self._contains.update(zip(keys, self._merger.osmdb.containing_point([missing[x] for x in keys], self.entry.center).tolist()))
+        return [self._contains[self._key(x)] for x in entries]
+
+    def contains(self, entry):
+        """returns True if entry contains the address"""
+        return self.containing((entry,))[0]
+
+    def similar(self, entry):
+        """returns True if entry is similar to the address"""
+        key = self._key(entry)
+        try:
+            return self._similar[key]
+        except KeyError:
+            ret = self._similar[key] = self.entry.similar_to(entry)
+            return ret
+
+    def in_area(self, entry):
+        """returns True if center of entry is within imported area"""
+        return self._merger.osmdb.in_area((entry,))[0]
+
+    def forget_addresses(self):
+        self._similar.clear()
+
+
+class MergeProfile(object):
+    """
+    Counters and timings of merge phases and strategies. Sections are named phase/function, counters are added
+    to innermost measured section. Entries, that took the longest to pre-merge and merge, are kept too.
+    Measurements are correct only with sequential parallel_process_func
+    """
+    def __init__(self, top=20):
+        self.top = top
+        self.sections = collections.OrderedDict()
+        self._current = None
+        self._pending = {}
+        self._slowest = []
+        self._seq = itertools.count()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        stats = self.sections.setdefault(name, collections.Counter())
+        (previous, self._current) = (self._current, stats)
+        (wall, cpu) = (time.perf_counter(), time.process_time())
+        try:
+            yield stats
+        finally:
+            stats['calls'] += 1
+            stats['wall_s'] += time.perf_counter() - wall
+            stats['cpu_s'] += time.process_time() - cpu
+            self._current = previous
+
+    def count(self, name, value=1):
+        if self._current is not None:
+            self._current[name] += value
+
+    def entry_time(self, entry, seconds, strategy=None):
+        """adds seconds spent on import entry. Pre-merge time is kept until entry is merged, with strategy given"""
+        seconds += self.take_pending(entry)
+        if strategy is None:
+            self._pending[id(entry)] = seconds
+            return
+        self._add_slowest(seconds, {
+            'seconds': seconds,
+            'address': str(entry),
+            'id': entry.id_,
+            'location': entry.location,
+            'strategy': strategy,
+        })
+
+    def take_pending(self, entry):
+        """returns and forgets pre-merge time of entry, that was not merged yet"""
+        return self._pending.pop(id(entry), 0.0)
+
+    def _add_slowest(self, seconds, info):
+        item = (seconds, next(self._seq), info)
+        if len(self._slowest) < self.top:
+            heapq.heappush(self._slowest, item)
+        elif self._slowest and item[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+
+    def get_state(self):
+        """returns measurements, that can be added to other profile with update()"""
+        return {'sections': [(k, dict(v)) for (k, v) in self.sections.items()], 'slowest': [x[2] for x in self._slowest]}
+
+    def update(self, state):
+        for (name, stats) in state['sections']:
+            self.sections.setdefault(name, collections.Counter()).update(stats)
+        for info in state['slowest']:
+            self._add_slowest(info['seconds'], info)
+
+    def report(self):
+        sections = collections.OrderedDict()
+        for (name, stats) in self.sections.items():
+            stats = dict(stats)
+            if stats.get('candidate_lists'):
+                stats['avg_candidate_list'] = stats['candidate_list_entries'] / stats['candidate_lists']
+            if stats.get('candidate_queries'):
+                stats['avg_candidates'] = stats['candidates'] / stats['candidate_queries']
+            sections[name] = stats
+        return {
+            'sections': sections,
+            'slowest': [x[2] for x in sorted(self._slowest, reverse=True)],
+        }
+
+
+class _NoProfile(object):
+    """MergeProfile, that measures nothing"""
+    @contextlib.contextmanager
+    def measure(self, name):
+        yield None
+
+    def count(self, name, value=1):
+        pass
+
+    def entry_time(self, entry, seconds, strategy=None):
+        pass
+
+    def take_pending(self, entry):
+        return 0.0
+
+    def get_state(self):
+        return None
+
+    def update(self, state):
+        pass
+
+
+class EntryRecord(object):
+    """
+    outcome of pre-merge and merge of one import entry, kept in incremental state file. Actions are lists:
+    ['update', osmid], ['create'], ['state', osmid, value], ['fixme', osmid, text], ['housenumber', osmid, value]
+    """
+    def __init__(self, key, fingerprint):
+        self.key = key
+        self.fingerprint = fingerprint
+        # import entry after pre-merge
+        self.street = None
+        self.fixmes = []
+        # osmids of OSM objects, that were looked at
+        self.deps = set()
+        self.actions = {'pre': [], 'merge': []}
+        # False when changes can't be replayed, ex. were made on new points
+        self.replayable = True
+
+    def touched(self):
+        """returns osmids of OSM objects changed by actions"""
+        return set(x[1] for x in itertools.chain.from_iterable(self.actions.values()) if x[0] != 'create')
+
+    def to_JSON(self):
+        return {
+            'key': self.key,
+            'fingerprint': self.fingerprint,
+            'street': self.street,
+            'fixmes': self.fixmes,
+            'deps': sorted(self.deps),
+            'pre': self.actions['pre'],
+            'merge': self.actions['merge'],
+            'replayable': self.replayable,
+        }
+
+    @staticmethod
+    def from_JSON(obj):
+        ret = EntryRecord(obj['key'], obj['fingerprint'])
+        ret.street = obj['street']
+        ret.fixmes = obj['fixmes']
+        ret.deps = set(obj['deps'])
+        ret.actions = {'pre': obj['pre'], 'merge': obj['merge']}
+        ret.replayable = obj['replayable']
+        return ret
+
+
 class Merger(object):
     __log = logging.getLogger(__name__).getChild('Merger')
 
-    def __init__(self, impdata, asis, terc, parallel_process_func=lambda func, elems: tuple(map(func, elems))):
+    # tiles per process, more tiles balance the work better
+    __tiles_per_process = 4
+    # buffers in meters, with which address nodes are merged with buildings, smallest first
+    __merge_buffers = (0, 2, 5)
+
+    def __init__(self, impdata, asis, terc, parallel_process_func=lambda func, elems: tuple(map(func, elems)), columnar=False,
+                 spatial_index=spatialindex.RtreeIndex, processes=1, tile_margin=50.0, import_area_shape=None, projected=False,
+                 incremental_state=None, profile=None):
+        """
+        asis - Overpass JSON with OSM data, as returned by getAddresses()
+        columnar - use ColumnarOsmDb to keep OSM data. Loaded data use about 7 times less memory, peak memory
+                   of merge is about 1.2 times lower. Empties asis['elements']
+        spatial_index - spatial index backend class, one of spatialindex.backends
+        processes - number of processes for merge. With more than one, pre-merge is run for all entries in this
+                    process, then import is split into spatial tiles, each merged in separate process with OSM data
+                    within tile_margin meters from tile and OSM data with the same addresses as entries in tile
+        import_area_shape - shape of imported area, when not given it is fetched for terc
+        projected - keep OSM data also in EPSG:2180, so distances, containment and buffers are computed in meters.
+                    Otherwise buffers are converted to degrees of latitude, which makes them narrower east-west
+        incremental_state - path of file with merge state. Pre-merge and merge are run only for import entries,
+                    that changed or are near OSM objects that changed since the state was saved, decisions for
+                    the rest are reused. State is saved there after merge. Entries are then merged in one process,
+                    and functions in pre_func are run only for merged entries, changes they make are reused only
+                    when done with set_state()
+        profile - number of slowest entries to report. When given, merge is measured in self.profile (MergeProfile)
+        """
         self.impdata = impdata
         self.asis = asis
-        self.osmdb = OsmDb(self.asis, valuefunc=OsmAddress.from_soup, indexes={'address': lambda x: x.get_index_key(), 'id': lambda x: x.osmid})
-        self._new_nodes = []
-        self._updated_nodes = []
+        self._columnar = columnar
+        self._spatial_index = spatial_index
+        self._projected = projected
+        db_class = ColumnarOsmDb if columnar else OsmDb
+        self.osmdb = db_class(self.asis, valuefunc=OsmAddress.from_soup, indexes={'address': lambda x: x.get_index_key()},
+                              spatial_index=spatial_index, projected=projected)
+        self._new_nodes = ChangeSet()
+        self._updated_nodes = ChangeSet()
         self._node_id = 0
         self.pre_func = []
         self.post_func = []
-        self._soup_visible = []
-        self._import_area_shape = get_boundary_shape(terc)
-        self._state_changes = []
+        self._soup_visible = ChangeSet()
+        self._import_area_shape = import_area_shape if import_area_shape is not None else get_boundary_shape(terc)
+        self.osmdb.set_area(self._import_area_shape)
+        self._state_changes = ChangeSet()
         self._parallel_process_func = parallel_process_func
-
-    def _create_index(self):
-        self.osmdb.update_index()
+        self._processes = processes
+        self._tile_margin = tile_margin
+        self._contexts = {}
+        self._incremental_state = incremental_state
+        # (EntryRecord, phase) for import entry being merged by incremental merge
+        self._recording = None
+        self.profile = MergeProfile(profile) if profile is not None else _NoProfile()
 
     def merge(self):
-        self.__log.debug("Starting premerger functinos")
-        self._pre_merge()
-        self._create_index()
-        self.__log.debug("Starting merge functinos")
-        self._do_merge()
+        # OsmDb indexes are kept up to date as entries change. Functions in pre_func and post_func
+        # that change address of OSM objects need to call self.osmdb.reindex(node) afterwards
+        if self._incremental_state:
+            self.__log.debug("Starting incremental premerge and merge")
+            with self.profile.measure('incremental_merge'):
+                self._incremental_merge()
+        elif self._processes > 1 and len(self.impdata) > 1:
+            self.__log.debug("Starting tiled premerge and merge in %d processes", self._processes)
+            with self.profile.measure('tiled_merge'):
+                self._tiled_merge()
+        else:
+            self.__log.debug("Starting premerger functinos")
+            with self.profile.measure('pre_merge'):
+                self._pre_merge()
+            self.__log.debug("Starting merge functinos")
+            with self.profile.measure('merge'):
+                self._do_merge()
         self.__log.debug("Starting postmerge functinos")
-        self._post_merge()
+        with self.profile.measure('post_merge'):
+            self._post_merge()
+        self.__log.debug("OsmDb cache statistics: %s", self.osmdb.cache_stats())
 
     def set_state(self, node, value):
-        self._state_changes.append(node)
+        self._record('state', node, value)
+        self._state_changes.add(node)
         node.set_state(value)
 
-    def _pre_merge(self):
-        def process(entry):
-            self._fix_similar_addr(entry)
-            tuple(map(lambda x: x(self, entry), self.pre_func))
-        self._parallel_process_func(process, self.impdata)
+    def _record(self, action, node=None, *args):
+        """records change of OSM data made for import entry merged by incremental merge"""
+        if self._recording is None:
+            return
+        (record, phase) = self._recording
+        if node is None:
+            record.actions[phase].append([action])
+        elif node.is_new():
+            record.replayable = False
+        else:
+            record.actions[phase].append([action, node.osmid] + list(args))
+
+    def _add_deps(self, entries):
+        """records OSM objects looked at for import entry merged by incremental merge"""
+        if self._recording is not None:
+            self._recording[0].deps.update(x.osmid for x in entries if not x.is_new())
+
+    def _replay(self, entry, actions):
+        for action in actions:
+            if action[0] == 'create':
+                self._create_point(entry)
+                continue
+            node = self.osmdb.get(*_parse_osmid(action[1]))
+            if action[0] == 'update':
+                self._update_node(node, entry)
+            elif action[0] == 'state':
+                self.set_state(node, action[2])
+            elif action[0] == 'fixme':
+                self._record('fixme', node, action[2])
+                node.addFixme(action[2])
+            elif action[0] == 'housenumber':
+                self._record('housenumber', node, action[2])
+                node.housenumber = action[2]
+                self.osmdb.reindex(node)
+            else:
+                raise ValueError("Unknown action in merge state: %s" % (action[0],))
+
+    def _get_state_config(self):
+        """returns values, that need to be the same as in saved state to reuse it"""
+        return {
+            'format': _state_format,
+            'area': hashlib.sha1(self._import_area_shape.wkb).hexdigest(),
+            'projected': self._projected,
+            'pre_func': [getattr(x, '__qualname__', type(x).__name__) for x in self.pre_func],
+        }
+
+    def _load_state(self, config):
+        try:
+            with open(self._incremental_state, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            self.__log.info("No merge state in %s, merging all addresses", self._incremental_state)
+            return None
+        if state.get('config') != config:
+            self.__log.warning("Merge state in %s was saved with different area or settings, merging all addresses",
+                               self._incremental_state)
+            return None
+        return state
+
+    def _save_state(self, state):
+        # write next to final location and swap, so partially written state is never read
+        path = self._incremental_state + '.tmp'
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.replace(path, self._incremental_state)
+
+    def _get_entries_near(self, positions):
+        """returns indexes of import entries within CandidateContext.radius from any of positions (bounding boxes)"""
+        if not positions:
+            return set()
+        index = self._spatial_index(range(len(self.impdata)), [x.getLatLon() * 2 for x in self.impdata])
+        ret = set()
+        for (minlat, minlon, maxlat, maxlon) in positions:
+            # a bit more, than radius, distance is computed from bounding box
+            dlat = (CandidateContext.radius + 1) * _degrees_per_meter
+            dlon = dlat / math.cos(math.radians(max(abs(minlat), abs(maxlat))))
+            ret.update(index.intersection((minlat - dlat, minlon - dlon, maxlat + dlat, maxlon + dlon)))
+        return ret
+
+    def _incremental_merge(self):
+        def mark_changed(osmids):
+            for osmid in osmids - changed:
+                changed.add(osmid)
+                if osmid in versions:
+                    changed_keys.add(self.osmdb.get(*_parse_osmid(osmid)).get_index_key())
+
+        def affected(i, record):
+            return i in dirty or not record.deps.isdisjoint(changed) or self.impdata[i].get_index_key() in changed_keys
+
+        def differ(record, old, phase):
+            return old is None or record.actions[phase] != old.actions[phase]
+
+        versions = dict(("%s:%s" % key, [version, geometry] + list(bounds))
+                        for (key, (version, geometry, bounds)) in self.osmdb.get_versions().items())
+        config = self._get_state_config()
+        state = self._load_state(config)
+        keys = _get_entry_keys(self.impdata)
+        # OSM objects changed since saved state, or by entries merged again, and their addresses
+        changed = set()
+        changed_keys = set()
+        if state is None:
+            old = {}
+            dirty = set(range(len(self.impdata)))
+        else:
+            old = dict((x['key'], EntryRecord.from_JSON(x)) for x in state['entries'])
+            old_versions = state['osm']
+            # moved objects are looked up at old and new position
+            modified = [k for (k, v) in versions.items() if old_versions.get(k) != v]
+            modified.extend(k for k in old_versions if k not in versions)
+            dirty = self._get_entries_near(
+                [versions[k][2:] for k in modified if k in versions] + [old_versions[k][2:] for k in modified if k in old_versions]
+            )
+            mark_changed(set(modified))
+            # changes made for entries, that are no longer imported
+            current = set(key for (key, _) in keys)
+            for record in old.values():
+                if record.key not in current:
+                    mark_changed(record.touched())
+            dirty.update(i for (i, (key, fingerprint)) in enumerate(keys)
+                         if key not in old or old[key].fingerprint != fingerprint or not old[key].replayable)
+
+        records = [EntryRecord(key, fingerprint) for (key, fingerprint) in keys]
+        for (i, (entry, record)) in enumerate(zip(self.impdata, records)):
+            previous = old.get(record.key)
+            self._recording = (record, 'pre')
+            if previous and not affected(i, previous):
+                record.deps.update(previous.deps)
+                entry.street = previous.street
+                for fixme in previous.fixmes[len(entry.fixmes):]:
+                    entry.addFixme(fixme)
+                self._replay(entry, previous.actions['pre'])
+            else:
+                dirty.add(i)
+                self._pre_merge_one(entry)
+            self._recording = None
+            (record.street, record.fixmes) = (entry.street, list(entry.fixmes))
+            if i in dirty and differ(record, previous, 'pre'):
+                mark_changed(record.touched() | (previous.touched() if previous else set()))
+
+        for (i, (entry, record)) in enumerate(zip(self.impdata, records)):
+            previous = old.get(record.key)
+            self._recording = (record, 'merge')
+            if previous and not affected(i, previous) and not affected(i, record):
+                self._replay(entry, previous.actions['merge'])
+            else:
+                dirty.add(i)
+                self._do_merge_one(entry)
+            self._recording = None
+            if i in dirty and differ(record, previous, 'merge'):
+                mark_changed(record.touched() | (previous.touched() if previous else set()))
+
+        self.__log.info("Merged %d of %d addresses, reused merge state for the rest", len(dirty), len(self.impdata))
+        self._save_state({'config': config, 'osm': versions, 'entries': [x.to_JSON() for x in records]})
+
+    def _tiled_merge(self):
+        # pre-merge changes addresses of import entries and OSM objects, so OSM data for each tile is chosen after it
+        with self.profile.measure('pre_merge'):
+            self._pre_merge()
+        # entries are merged in other processes
+        self._contexts.clear()
+        tiles = _split_tiles(list(enumerate(self.impdata)), self._processes * self.__tiles_per_process)
+        self.__log.info("Merging %d addresses in %d tiles", len(self.impdata), len(tiles))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._processes) as executor:
+            # results are applied in tile order, so outcome does not depend on process timing
+            for (tile, result) in zip(tiles, executor.map(_merge_tile, map(self._get_tile_task, tiles))):
+                self._apply_tile_result(tile, result)
+
+    def _get_tile_task(self, tile):
+        """returns arguments for _merge_tile for list of (index, entry) tuples"""
+        entries = [x[1] for x in tile]
+        lats = [float(x.location['lat']) for x in entries]
+        lons = [float(x.location['lon']) for x in entries]
+        dlat = self._tile_margin * _degrees_per_meter
+        dlon = dlat / math.cos(math.radians(max(map(abs, lats))))
+        found = list(self.osmdb.intersecting((min(lats) - dlat, min(lons) - dlon, max(lats) + dlat, max(lons) + dlon)))
+        # same addresses are looked up in whole area
+        found.extend(itertools.chain.from_iterable(self.osmdb.getbyaddress(x.get_index_key()) for x in entries))
+        elements = [x for x in self._get_all_reffered_by(found) if not x.is_new()]
+        asis = dict((k, v) for (k, v) in self.asis.items() if k != 'elements')
+        asis['elements'] = [x._raw for x in elements]
+        # state and fixmes set by pre-merge are not kept in raw elements
+        premerged = [((x.objtype, x['id']), x.state, list(x.fixmes), x.location) for x in elements if x.state or x.fixmes]
+        pending = [self.profile.take_pending(x) for x in entries]
+        kwargs = {'columnar': self._columnar, 'spatial_index': self._spatial_index, 'import_area_shape': self._import_area_shape,
+                  'projected': self._projected, 'profile': getattr(self.profile, 'top', None)}
+        return (entries, asis, premerged, pending, kwargs)
+
+    def _get_tile_state(self):
+        """returns values of OSM entries, that are changed during merge, to find changes made in tile"""
+        return dict(
+            ((x.objtype, x['id']), (dict(x['tags']), x.state, len(x.fixmes), x.location))
+            for x in self.osmdb.get_all_values()
+        )
+
+    def _get_tile_result(self, original):
+        def ref(x):
+            if x.is_new():
+                return ('new', new_nodes[x['id']])
+            return ('osm', x.objtype, x['id'])
+
+        new_nodes = dict((x['id'], i) for (i, x) in enumerate(self._new_nodes))
+        changed = []
+        for (key, (tags, state, fixmes, location)) in sorted(original.items()):
+            entry = self.osmdb.get(*key)
+            if (entry['tags'], entry.state, len(entry.fixmes), entry.location) != (tags, state, fixmes, location):
+                changed.append((
+                    key,
+                    dict((k, entry['tags'].get(k)) for k in set(tags) | set(entry['tags']) if tags.get(k) != entry['tags'].get(k)),
+                    entry.state,
+                    entry.fixmes[fixmes:],
+                    entry.location if entry.location != location else None
+                ))
+        return {
+            'impdata': self.impdata,
+            'new': [(x['lat'], x['lon'], x['tags'], x.state, x.fixmes) for x in self._new_nodes],
+            'changed': changed,
+            'updated': list(map(ref, self._updated_nodes)),
+            'state_changes': list(map(ref, self._state_changes)),
+            'profile': self.profile.get_state(),
+        }
 
-    def _fix_similar_addr(self, entry):
+    def _apply_tile_result(self, tile, result):
+        for ((i, _), entry) in zip(tile, result['impdata']):
+            self.impdata[i] = entry
+
+        new_nodes = []
+        for (lat, lon, tags, state, fixmes) in result['new']:
+            node = self.osmdb.add_new({'type': 'node', 'id': self._get_node_id(), 'lat': lat, 'lon': lon, 'tags': tags})
+            node.entry.state = state
+            for fixme in fixmes:
+                node.addFixme(fixme)
+            self.osmdb.reindex(node)
+            self._new_nodes.add(node)
+            new_nodes.append(node)
+
+        for (key, tags, state, fixmes, location) in result['changed']:
+            # entries in tile margins may be changed by more than one tile, tiles are applied in order
+            entry = self.osmdb.get(*key)
+            for (k, v) in tags.items():
+                if v is None:
+                    entry['tags'].pop(k, None)
+                else:
+                    entry['tags'][k] = v
+            if state:
+                entry.set_state(state)
+            for fixme in fixmes:
+                entry.addFixme(fixme)
+            if location:
+                entry.entry.location = location
+            self.osmdb.reindex(entry)
+
+        def get(ref):
+            if ref[0] == 'new':
+                return new_nodes[ref[1]]
+            return self.osmdb.get(*ref[1:])
+        self._updated_nodes.update(map(get, result['updated']))
+        self._state_changes.update(map(get, result['state_changes']))
+        if result['profile']:
+            self.profile.update(result['profile'])
+
+    def get_context(self, entry):
+        """
+        returns CandidateContext for import entry. It is kept from pre-merge until the entry is merged,
+        functions in pre_func should use it instead of querying self.osmdb
+        """
+        try:
+            return self._contexts[id(entry)]
+        except KeyError:
+            ret = self._contexts[id(entry)] = CandidateContext(self, entry)
+            return ret
+
+    def _pre_merge(self):
+        self._parallel_process_func(self._pre_merge_one, self.impdata)
+
+    def _pre_merge_one(self, entry):
+        start = time.perf_counter()
+        with self.profile.measure('pre_merge/_fix_similar_addr'):
+            self._fix_similar_addr(entry, self.get_context(entry))
+        for func in self.pre_func:
+            with self.profile.measure('pre_merge/' + getattr(func, '__name__', type(func).__name__)):
+                func(self, entry)
+        self.profile.entry_time(entry, time.perf_counter() - start)
+
+    def _fix_similar_addr(self, entry, context):
         # look for near same address
         # change street names to values from OSM
         # change housenumbers to values from import
         try:
-            node = next(filter(lambda x: entry.similar_to(x), self.osmdb.nearest(entry.center, num_results=10)))
-            how_far = node.distance(entry)
+            # only nodes within 5m and ways within 10m or containing the address are taken into account
+            node = next(iter(context.candidates(10.0, filter=context.similar)))
+            how_far = context.distance(node, approx=True)
             if node and node.street and entry.street and node.street != entry.street and \
-                ((node.objtype == 'node' and how_far < 5.0) or (node.objtype == 'way' and (node.contains(entry.center) or how_far < 10.0))):
+                ((node.objtype == 'node' and how_far < 5.0) or (node.objtype == 'way' and (context.contains(node) or how_far < 10.0))):
                 # there is some similar address nearby but with different street name
                 self.__log.warning("Changing street name from %s in import to %s as in OSM (%s), distance=%.2fm",
                         entry.street, node.street, node.osmid, how_far)
@@ -289,10 +901,12 @@ class Merger(object):
                 entry.addFixme('Street name in import source: %s' % (entry.street,))
                 entry.street = node.street
             if node and node.street == entry.street and node.city == entry.city and node.housenumber != entry.housenumber and \
-                ((node.objtype == 'node' and how_far < 5.0) or (node.objtype == 'way' and (node.contains(entry.center) or how_far < 10.0))):
+                ((node.objtype == 'node' and how_far < 5.0) or (node.objtype == 'way' and (context.contains(node) or how_far < 10.0))):
                 # there is only difference in housenumber, that is similiar
                 self.__log.info("Updating housenumber from %s to %s", node.housenumber, entry.housenumber)
+                self._record('housenumber', node, entry.housenumber)
                 node.housenumber = entry.housenumber
+                self.osmdb.reindex(node)
         except StopIteration: pass
 
     def _fix_obsolete_emuia(self, entry):
@@ -300,7 +914,9 @@ class Merger(object):
         if existing:
             # we have something with this address in db
             # sort by distance
-            emuia_nodes = sorted(tuple(filter(lambda x: x.isEMUiAAddr() and x.only_address_node(), existing)), lambda x: x.distance(entry))
+            emuia_nodes = [x for x in existing if x.isEMUiAAddr() and x.only_address_node()]
+            emuia_nodes = [x for (_, x) in sorted(zip(self.osmdb.distances(entry.center, emuia_nodes).tolist(), emuia_nodes),
+                                                  key=lambda x: x[0])]
 
             # update location of first node if from EMUiA
             if emuia_nodes:
@@ -316,21 +932,35 @@ class Merger(object):
 
     def _do_merge_one(self, entry):
         self.__log.debug("Processing address: %s", entry)
-        return any(map(lambda x: x(entry),
-            (
+        context = self.get_context(entry)
+        del self._contexts[id(entry)]
+        # addresses in OSM were changed by pre-merge and merge of other entries
+        context.forget_addresses()
+        start = time.perf_counter()
+        for strategy in (
                 # first returning true will stop exection of the chain
                 self._do_merge_by_existing,
                 self._do_merge_by_within,
                 self._do_merge_by_nearest,
                 self._do_merge_create_point,
-            )
-        ))
+            ):
+            with self.profile.measure('merge/' + strategy.__name__):
+                found = strategy(entry, context)
+                if found:
+                    self.profile.count('hits')
+            if found:
+                self.profile.entry_time(entry, time.perf_counter() - start, strategy.__name__)
+                return True
+        return False
 
-    def _do_merge_by_existing(self, entry):
-        existing = tuple(filter(lambda x: self._import_area_shape.contains(x.center), self.osmdb.getbyaddress(entry.get_index_key())))
+    def _do_merge_by_existing(self, entry, context):
+        # points created during merge are merged with buildings in post-merge, skip them here
+        existing = self.osmdb.getbyaddress(entry.get_index_key())
+        self._add_deps(existing)
+        existing = tuple(x for (x, in_area) in zip(existing, self.osmdb.in_area(existing)) if in_area and not x.is_new())
         self.__log.debug("Found %d same addresses", len(existing))
         # create tuples (distance, entry) sorted by distance
-        existing = sorted(map(lambda x: (x.distance(entry), x), existing), key=lambda x: x[0])
+        existing = sorted(zip(context.distances(existing), existing), key=lambda x: x[0])
         if existing:
             # report duplicates
             if len(existing) > 1:
@@ -342,13 +972,14 @@ class Merger(object):
             if max(x[0] for x in existing) > 100:
                 for (dist, node) in existing:
                     if dist > 100:
-                        if not (node.objtype in ( 'way', 'relation') and node.contains(entry.center)):
+                        if not (node.objtype in ( 'way', 'relation') and context.contains(node)):
                             # ignore the distance, if the point is within the node
                             self.__log.warning("Address (id=%s) %s is %d meters from imported point", node.osmid, entry, dist)
+                            self._record('fixme', node, "Node is %d meters away from imported point"  % dist)
                             node.addFixme("Node is %d meters away from imported point"  % dist)
                     self.set_state(node, 'visible')
                 if min(x[0] for x in existing) > 50:
-                    if any(map(lambda x: x[1].objtype in ('way', 'relation') and x[1].contains(entry.center), existing)):
+                    if any(map(lambda x: x[1].objtype in ('way', 'relation') and context.contains(x[1]), existing)):
                         # if any of existing addreses is a way/relation within which we have our address
                         # then skip
                         pass
@@ -361,10 +992,10 @@ class Merger(object):
             return True
         return False
 
-    def _do_merge_by_within(self, entry):
+    def _do_merge_by_within(self, entry, context):
         # look for building nearby
-        candidates = list(self.osmdb.nearest(entry.center, num_results=10))
-        candidates_within = list(filter(lambda x: x.objtype in ('way', 'relation') and x.contains(entry.center), candidates))
+        candidates = context.candidates(0, filter=lambda x: x.objtype in ('way', 'relation'))
+        candidates_within = list(itertools.compress(candidates, context.containing(candidates)))
         self.__log.debug("Found %d buildings containing address", len(candidates_within))
 
         if candidates_within:
@@ -377,12 +1008,12 @@ class Merger(object):
                 return True
             else:
                 # WARNING - candidate has an address
-                if c.similar_to(entry) and c.street == entry.street:
+                if context.similar(c) and c.street == entry.street:
                     self.__log.debug("Updating OSM address: %s with import %s", c.entry, entry)
                     self._update_node(c, entry)
                     return True
                 else:
-                    if c.similar_to(entry):
+                    if context.similar(c):
                         self.__log.info("Different street names - import: %s, OSM: %s, address: %s, OSM: %s", entry.street, c.street, entry, c.osmid)
                     # address within a building that has different address, add a point, maybe building needs spliting
                     self.__log.debug("Adding new node within building with address: %s", entry)
@@ -390,16 +1021,15 @@ class Merger(object):
                     return True
         return False
 
-    def _do_merge_by_nearest(self, entry):
-        candidates = list(self.osmdb.nearest(entry.center, num_results=10))
-        candidates_same = list(filter(lambda x: x.housenumber == entry.housenumber and \
-            x.distance(entry) < 2.0, candidates))
+    def _do_merge_by_nearest(self, entry, context):
+        candidates = context.candidates(2.0, filter=lambda x: not x.is_new() and x.housenumber == entry.housenumber)
+        candidates_same = list(x for (x, dist) in zip(candidates, context.distances(candidates, approx=True)) if dist < 2.0)
         if len(candidates_same) > 0:
             # same location, both are an address, and have same housenumber, can't be coincidence,
             # probably mapper changed something
             for node in candidates_same:
                 found = False
-                if node.similar_to(entry):
+                if context.similar(node):
                     found = True
                     self.__log.debug("Updating near node from: %s to %s", node.entry, entry)
                     self._update_node(node, entry)
@@ -412,17 +1042,20 @@ class Merger(object):
                 return True
         return False
 
-    def _do_merge_create_point(self, entry):
+    def _do_merge_create_point(self, entry, context):
         self._create_point(entry)
         return True
 
     def _update_node(self, node, entry):
+        self._record('update', node)
         if node.updateFrom(entry):
             self.__log.debug("Updating node %s using %s", node.osmid, entry)
-            self._updated_nodes.append(node)
+            self._updated_nodes.add(node)
+            self.osmdb.reindex(node)
 
     def _create_point(self, entry):
         self.__log.debug("Creating new point")
+        self._record('create')
         soup =  {
             'type': 'node',
             'id': self._get_node_id(),
@@ -431,24 +1064,24 @@ class Merger(object):
         }
         new = self.osmdb.add_new(soup)
         new.updateFrom(entry)
-        self._new_nodes.append(new)
+        self.osmdb.reindex(new)
+        self._new_nodes.add(new)
         # TODO: check that soup gets address tags
         #self.asis['elements'].append(soup)
 
     def _mark_soup_visible(self, obj):
-        self._soup_visible.append(obj)
+        self._soup_visible.add(obj)
 
     def _get_node_id(self):
         self._node_id -= 1
         return self._node_id
 
     def _get_all_changed_nodes(self):
-        ret = dict((x.osmid,x) for x in self._updated_nodes)
-        ret.update(dict((x.osmid, x) for x in self._new_nodes))
+        ret = ChangeSet(itertools.chain(self._updated_nodes, self._new_nodes))
         self.__log.info("Modified objects: %d", len(ret))
-        ret.update(dict((x.osmid, x) for x in self._state_changes))
+        ret.update(self._state_changes)
 
-        for (_id, i) in ret.items():
+        for i in ret:
             if i in self._updated_nodes:
                 self.__log.debug("Processing updated node: %s", str(i.entry))
             elif i in self._new_nodes:
@@ -456,77 +1089,75 @@ class Merger(object):
             elif i.state in ('modify', 'delete'):
                 self.__log.debug("Processing node - changed: %s, %s", i.state, str(i.entry))
 
-        return tuple(ret.values())
+        return tuple(ret)
 
     def _get_all_visible(self):
         return tuple(self._soup_visible)
 
     def _get_all_reffered_by(self, lst):
-        ret = set()
-        def getbyid(key):
-            ret = self.osmdb.getbyid(key)
-            if not ret:
-                raise ValueError("No object found for key: %s" % (key,))
-            return ret
-        def get_reffered(node):
-            if node['type'] == 'node':
-                return set((('node', node['id']),))
-            if node['type'] == 'nd':
-                return set((('node', node['ref']),))
-            if node['type'] == 'way':
-                return itertools.chain(
-                    itertools.chain.from_iterable(map(get_reffered, (getbyid("node:%s" % (x,))[0] for x in node['nodes']))),
-                    (('way', node['id']),)
-                )
-            if node['type'] == 'member':
-                return get_reffered(getbyid("%s:%s" % (node['type'], node['ref']))[0])
-            if node['type'] == 'relation':
-                return itertools.chain(
-                    itertools.chain.from_iterable(map(get_reffered, (getbyid("%s:%s" % (x['type'], x['ref']))[0] for x in node['members']))),
-                    (('relation', node['id']),)
-                )
-            raise ValueError("Unkown node type: %s" % (node.name))
+        """
+        returns entries in lst and all entries they refer to. Each entry is visited once, so this takes
+        time linear to the size of result. Referred entries come before entries referring to them
+        """
+        ret = ChangeSet()
+        seen = set()
+        def get(objtype, id_):
+            try:
+                return self.osmdb.get(objtype, id_)
+            except KeyError:
+                raise ValueError("No object found for key: %s:%s" % (objtype, id_))
+        def visit(objtype, id_, node=None):
+            if (objtype, id_) in seen:
+                return
+            # mark before visiting members, relations may refer to each other
+            seen.add((objtype, id_))
+            node = node or get(objtype, id_)
+            if objtype == 'way':
+                for x in node['nodes']:
+                    visit('node', x)
+            elif objtype == 'relation':
+                for x in node['members']:
+                    visit(x['type'], x['ref'])
+            elif objtype != 'node':
+                raise ValueError("Unkown node type: %s" % (objtype,))
+            ret.add(node)
 
         for i in lst:
-            ret = ret.union(get_reffered(i))
-
-        return tuple(map(
-            lambda x: getbyid("%s:%s" % (x[0], x[1]))[0],
-            ret
-        ))
+            visit(i.objtype, i['id'], i)
+        return tuple(ret)
 
     def _post_merge(self):
-        # recreate index
-        self._create_index()
-
         for i in self.post_func:
-            i()
-        self._create_index()
-        self.mark_not_existing()
-        self._create_index()
+            with self.profile.measure('post_merge/' + getattr(i, '__name__', type(i).__name__)):
+                i()
+        with self.profile.measure('post_merge/mark_not_existing'):
+            self.mark_not_existing()
 
     def mark_not_existing(self):
         imp_addr = set(map(lambda x: x.get_index_key(), self.impdata))
-        # from all addresses in OsmDb remove those imported
-        to_delete = set(filter(
-            lambda x: any(
-                map(lambda y: self._import_area_shape.contains(y.center), self.osmdb.getbyaddress(x))
-            ),
-            self.osmdb.getalladdress())) - imp_addr
-
-        self.__log.debug("Marking %d not existing addresses", len(to_delete))
-        for addr in filter(any, to_delete): # at least on addr field is filled in
-            for node in filter(lambda x: self._import_area_shape.contains(x.center), self.osmdb.getbyaddress(addr)):
-                if self._import_area_shape.contains(node.center):
-                    # report only points within area of interest
-                    self.__log.debug("Marking node to delete - address %s does not exist: %s, %s", addr, node.osmid, str(node.entry))
-                    node.addFixme('Check address existance')
-                    self.set_state(node, 'visible')
+        # from all addresses in OsmDb within area of interest remove those imported
+        in_area = {}
+        for addr in self.osmdb.getalladdress():
+            nodes = self.osmdb.getbyaddress(addr)
+            nodes = list(itertools.compress(nodes, self.osmdb.in_area(nodes)))
+            if nodes and addr not in imp_addr:
+                in_area[addr] = nodes
+
+        self.__log.debug("Marking %d not existing addresses", len(in_area))
+        for (addr, nodes) in in_area.items():
+            if not any(addr):
+                # at least on addr field is filled in
+                continue
+            for node in nodes:
+                # report only points within area of interest
+                self.__log.debug("Marking node to delete - address %s does not exist: %s, %s", addr, node.osmid, str(node.entry))
+                node.addFixme('Check address existance')
+                self.set_state(node, 'visible')
 
     def merge_addresses(self):
-        self._merge_addresses_buffer(0)
-        self._merge_addresses_buffer(2)
-        self._merge_addresses_buffer(5)
+        matches = self._match_address_nodes(self.__merge_buffers)
+        for (i, buf) in enumerate(self.__merge_buffers):
+            self._merge_addresses_buffer(buf, [(addr, buildings[i]) for (addr, buildings) in matches if buildings[i]])
 
     def _merge_one_address(self, building, addr):
         # as we merge only address nodes, do not pass anything else
@@ -534,87 +1165,151 @@ class Merger(object):
         fixme = building['tags'].get('fixme', '')
         fixme += addr.getFixme()
         building['tags']['fixme'] = fixme
-        self.osmdb.getbyid("%s:%s" % (building['type'], building['id']))[0].set_state('modify')
+        self.osmdb.reindex(building)
+        building.set_state('modify')
         self.set_state(addr, 'delete')
-        self._updated_nodes.append(self.osmdb.getbyid("%s:%s" % (building['type'], building['id']))[0])
+        self._updated_nodes.add(building)
 
-    def _merge_addresses_buffer(self, buf=0):
+    def _merge_addresses_buffer(self, buf, matches):
         self.__log.info("Merging building with buffer: %d", buf)
-        to_merge = self._prepare_merge_list(buf)
-        buildings = dict(
-            ("%s:%s" % (x['type'], x['id']), x) for x in self.asis['elements'] if x['type'] in ('way', 'relation')
-        )
+        to_merge = self._prepare_merge_list(matches)
 
         self.__log.info("Merging %d addresses with buildings", len(tuple(filter(lambda x: len(x[1]) == 1, to_merge.items()))))
 
         for (_id, nodes) in to_merge.items():
-            building = buildings[_id]
+            building = self.osmdb.get(*_id)
             if len(nodes) > 0:
-                self._mark_soup_visible(self.osmdb.getbyid(_id)[0])
+                self._mark_soup_visible(building)
 
             if len(nodes) == 1:
                 if building['tags'].get('addr:housenumber'):
-                    self.__log.info("Skipping merging address: %s, as building already has an address: %s.", str(nodes[0].entry), OsmAddress.from_soup(building))
+                    self.__log.info("Skipping merging address: %s, as building already has an address: %s.", str(nodes[0].entry), str(building.entry))
                     self._mark_soup_visible(nodes[0])
                 else:
-                    self.__log.debug("Merging address %s with building %s", str(nodes[0].entry), _id)
+                    self.__log.debug("Merging address %s with building %s", str(nodes[0].entry), building.osmid)
                     self._merge_one_address(building, nodes[0])
 
             if len(nodes) > 1:
                 for node in nodes:
                     self._mark_soup_visible(node)
 
-    def _prepare_merge_list(self, buf):
+    def _get_address_nodes(self):
+        # all nodes with housenumber, as found in address index
+        return filter(lambda x: x.objtype == 'node',
+            itertools.chain.from_iterable(map(self.osmdb.getbyaddress, filter(lambda x: x[2], self.osmdb.getalladdress())))
+        )
+
+    def _match_address_nodes(self, buffers):
+        """
+        returns list of (address node, buildings) tuples, where buildings has a building containing the
+        address node with each of buffers, or None. Address nodes outside of buildings are skipped.
+        All address nodes are joined with buffered buildings at once, each building is buffered only once
+        """
+        addrs = [x for x in self._get_address_nodes() if x.only_address_node() and x.state != 'delete']
+        addrs = list(itertools.compress(addrs, self.osmdb.in_area(addrs)))
+        # buffered buildings never reach further than the largest buffer
+        candidates = [
+            self.osmdb.within_radius(x.center, max(buffers), filter=lambda y: y.objtype in ('way', 'relation'), with_distances=True)
+            for x in addrs
+        ]
+        self.__log.debug("Looking for buildings containing %d address nodes", len(addrs))
+
+        buffered = {}
+        def get_buffered(building, buf):
+            key = (building.objtype, building['id'], buf)
+            try:
+                return buffered[key]
+            except KeyError:
+                if self._projected:
+                    ret = buffered[key] = self.osmdb.get_projected_shape(building._raw).buffer(buf)
+                else:
+                    ret = buffered[key] = buffer(building.shape, buf)
+                shapely.prepare(ret)
+                return ret
+
+        found = []
+        for buf in buffers:
+            pairs = [(i, c) for (i, lst) in enumerate(candidates) for (c, dist) in lst if dist <= buf]
+            shapes = np.empty(len(pairs), dtype=object)
+            shapes[:] = [get_buffered(c, buf) for (_, c) in pairs]
+            if self._projected:
+                points = np.array([self.osmdb.get_projected_center(addrs[i]._raw) for (i, _) in pairs], dtype=np.float64).reshape((-1, 2))
+            else:
+                points = shapely.get_coordinates([addrs[i].center for (i, _) in pairs])
+            within = shapely.contains_xy(shapes, points[:, 0], points[:, 1]).tolist()
+            # relations take precedence over ways, otherwise the nearest one is taken
+            relations = {}
+            ways = {}
+            for ((i, c), flag) in zip(pairs, within):
+                if flag:
+                    (relations if c.objtype == 'relation' else ways).setdefault(i, c)
+            found.append([relations.get(i, ways.get(i)) for i in range(len(addrs))])
+        return [(addr, buildings) for (addr, buildings) in zip(addrs, zip(*found)) if any(buildings)]
+
+    def _prepare_merge_list(self, matches):
         ret = {}
-        for node in filter(lambda x: x['type'] == 'node' and x.get('tags', {}).get('addr:housenumber'), self.asis['elements']):
-            addr = self.osmdb.getbyid("%s:%s" % (node['type'], node['id']))[0]
-            self.__log.debug("Looking for candidates for: %s", str(addr.entry))
-            if addr.only_address_node() and addr.state != 'delete' and self._import_area_shape.contains(addr.center):
-                candidates = list(self.osmdb.nearest(addr.center, num_results=10))
-                candidates_within = list(
-                    filter(
-                        lambda x: addr.osmid != x.osmid and x.objtype == 'relation' and addr.center.within(buffer(x.shape, buf)),
-                        candidates
-                    )
-                )
-                if not candidates_within:
-                    candidates_within = list(
-                        filter(
-                            lambda x: addr.osmid != x.osmid and x.objtype == 'way' and addr.center.within(buffer(x.shape, buf)),
-                            candidates
-                        )
-                   )
-                if candidates_within:
-                    c = candidates_within[0]
-                    if c.housenumber:
-                        self.set_state(c, 'visible')
-                        self.set_state(addr, 'visible')
-                    else:
-                        try:
-                            lst = ret[c.osmid]
-                        except KeyError:
-                            lst = []
-                            ret[c.osmid] = lst
-                        lst.append(addr)
-                        self.__log.debug("Found: %s", c.osmid)
+        for (addr, c) in matches:
+            # address nodes merged with smaller buffer are already marked for deletion
+            if addr.state == 'delete':
+                continue
+            self.__log.debug("Found: %s for %s", c.osmid, str(addr.entry))
+            if c.housenumber:
+                self.set_state(c, 'visible')
+                self.set_state(addr, 'visible')
+            else:
+                try:
+                    lst = ret[(c.objtype, c['id'])]
+                except KeyError:
+                    lst = []
+                    ret[(c.objtype, c['id'])] = lst
+                lst.append(addr)
         return ret
 
-    def _get_osm_xml(self, nodes, logIO=None):
-        return E.osm(
-                        E.note('The data included in this document is from www.openstreetmap.org. The data is made available under ODbL.' + ('\n' + logIO.getvalue() if logIO else '')),
-                        E.meta(osm_base=self.asis['osm3s']['timestamp_osm_base']),
-                        *tuple(map(OsmAddress.to_osm_soup, nodes)),
-                    version='0.6', generator='import adresy merger.py'
-        )
+    def _iter_osm_xml(self, nodes, logIO=None):
+        """
+        yields OSM XML document with nodes as chunks of bytes. Elements are built and serialized one by one,
+        so memory used does not depend on number of nodes
+        """
+        def drain():
+            xf.flush()
+            ret = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return ret
 
-    def get_incremental_result(self, logIO=None):
+        buf = io.BytesIO()
+        header = (
+            E.note('The data included in this document is from www.openstreetmap.org. The data is made available under ODbL.' + ('\n' + logIO.getvalue() if logIO else '')),
+            E.meta(osm_base=self.asis['osm3s']['timestamp_osm_base']),
+        )
+        with lxml.etree.xmlfile(buf, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            with xf.element('osm', version='0.6', generator='import adresy merger.py'):
+                for elem in itertools.chain(header, map(OsmAddress.to_osm_soup, nodes)):
+                    # same layout as pretty printed document
+                    lxml.etree.indent(elem, level=1)
+                    xf.write('\n  ', elem)
+                    yield drain()
+                xf.write('\n')
+        buf.write(b'\n')
+        yield buf.getvalue()
+
+    def iter_incremental_result(self, logIO=None):
+        """returns iterator over chunks of OSM XML with changed objects and objects they refer to"""
         changes = self._get_all_changed_nodes()
         self.__log.info("Generated %d changes", len(changes))
         nodes = self._get_all_reffered_by(changes + self._get_all_visible())
-        return lxml.etree.tostring(self._get_osm_xml(nodes, logIO), pretty_print=True, xml_declaration=True, encoding='UTF-8')
+        return self._iter_osm_xml(nodes, logIO)
+
+    def iter_full_result(self, logIO=None):
+        """returns iterator over chunks of OSM XML with all changed objects"""
+        return self._iter_osm_xml(self._get_all_changed_nodes(), logIO)
+
+    def get_incremental_result(self, logIO=None):
+        return b''.join(self.iter_incremental_result(logIO))
 
     def get_full_result(self, logIO=None):
-        return lxml.etree.tostring(self._get_osm_xml(self._get_all_changed_nodes(), logIO), pretty_print=True, xml_declaration=True, encoding='UTF-8')
+        return b''.join(self.iter_full_result(logIO))
 
 
 def getAddresses(bbox):
@@ -649,7 +1344,7 @@ out meta bb qt;
 >>;
 out meta bb qt;
 """ % (bbox, bbox, bbox, bbox, bbox,)
-    return json.loads(overpass.query(query))
+    return overpass.query_json(query)
 
 def get_boundary_shape(terc):
     query = """
@@ -661,15 +1356,100 @@ out bb;
 >;
 out bb;
 """ % (terc,)
-    soup = json.loads(overpass.query(query))
+    soup = overpass.query_json(query)
     osmdb = OsmDb(soup)
     rel = tuple(x for x in soup['elements'] if x['type'] == 'relation')[0]
     return osmdb.get_shape(rel)
 
+def get_fresh_snapshot(path, max_age, bbox):
+    """
+    returns OSM data from snapshot saved in path, if its Overpass timestamp is not older than max_age (timedelta)
+    and it was saved for area containing bbox (south, west, north, east).
+    Returns None if there is no such snapshot
+    """
+    try:
+        ret = load_snapshot(path)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        # saved in older format, it is replaced by the caller
+        __log.info("Can't use snapshot %s: %s", path, e)
+        return None
+    if not snapshot_covers(ret, bbox):
+        __log.info("Snapshot %s doesn't cover requested area", path)
+        return None
+    base = ret.get('osm3s', {}).get('timestamp_osm_base')
+    if not base:
+        return None
+    age = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.strptime(base, '%Y-%m-%dT%H:%M:%S%z')
+    if age > max_age:
+        __log.info("Snapshot %s is too old: %s", path, age)
+        return None
+    __log.info("Using snapshot %s with OSM data from %s", path, base)
+    return ret
+
+
+# length of 1m in arc degrees of great circle
+_degrees_per_meter = 0.0000089831528
+# version of incremental merge state file, state in other version is not used
+_state_format = 2
+
+def _split_tiles(entries, count):
+    """
+    splits list of (index, address) tuples into count lists of similar size, covering compact areas,
+    by splitting recursively along longer side
+    """
+    if count <= 1 or len(entries) <= 1:
+        return [entries]
+    lats = [float(x[1].location['lat']) for x in entries]
+    lons = [float(x[1].location['lon']) for x in entries]
+    if (max(lons) - min(lons)) * math.cos(math.radians(max(map(abs, lats)))) > max(lats) - min(lats):
+        entries = sorted(entries, key=lambda x: (float(x[1].location['lon']), x[0]))
+    else:
+        entries = sorted(entries, key=lambda x: (float(x[1].location['lat']), x[0]))
+    split = len(entries) * (count // 2) // count
+    return _split_tiles(entries[:split], count // 2) + _split_tiles(entries[split:], count - count // 2)
+
+
+def _get_entry_keys(impdata):
+    """returns (key, fingerprint) of each import entry for incremental merge, key is import id when there is one"""
+    ret = []
+    seen = {}
+    for entry in impdata:
+        fingerprint = hashlib.sha1(json.dumps(entry.to_JSON(), sort_keys=True).encode('utf-8')).hexdigest()
+        key = entry.id_ or fingerprint
+        # duplicates are told apart by order
+        seen[key] = seen.get(key, -1) + 1
+        if seen[key]:
+            key = "%s#%d" % (key, seen[key])
+        ret.append((key, fingerprint))
+    return ret
+
+
+def _parse_osmid(osmid):
+    (objtype, id_) = osmid.split(':')
+    return (objtype, int(id_))
+
+
+def _merge_tile(args):
+    """runs merge for one tile in worker process, pre-merge was already done"""
+    (impdata, asis, premerged, pending, kwargs) = args
+    m = Merger(impdata, asis, None, **kwargs)
+    for (key, state, fixmes, location) in premerged:
+        entry = m.osmdb.get(*key).entry
+        entry.state = state
+        entry.fixmes[:] = fixmes
+        entry.location = location
+    for (entry, seconds) in zip(impdata, pending):
+        m.profile.entry_time(entry, seconds)
+    original = m._get_tile_state()
+    with m.profile.measure('merge'):
+        m._do_merge()
+    return m._get_tile_result(original)
+
 
 def buffer(shp, meters=0):
-    # 0.0000089831528 is the 1m length in arc degrees of great circle
-    return shp.buffer(meters*0.0000089831528)
+    return shp.buffer(meters*_degrees_per_meter)
 
 def main():
     # TODO: create mode where no unchanged data are returned (as addresses to be merged with buildings)
@@ -688,6 +1468,21 @@ def main():
     parser.add_argument('--output', type=argparse.FileType('w+b'), help='output file with merged data (default: result.osm)', default='result.osm')
     parser.add_argument('--full', help='Use to output all address data for region, not only modified address data as per default', action='store_const', const=True, dest='full_mode', default=False)
     parser.add_argument('--no-merge', help='Do not merger addresses with buildings', action='store_const', const=True, dest='no_merge', default=False)
+    parser.add_argument('--spatial-index', choices=sorted(spatialindex.backends.keys()), default='rtree', dest='spatial_index',
+                        help='spatial index used for OSM data (default: rtree)')
+    parser.add_argument('--low-memory', help='Keep OSM data in compact, array based storage. Use for large areas', action='store_const', const=True, dest='low_memory', default=False)
+    parser.add_argument('--snapshot', help='directory with snapshot of OSM data for imported area. Snapshot is used if it is fresh enough, ' +
+                        'otherwise OSM data are downloaded and saved there. Implies --low-memory', dest='snapshot')
+    parser.add_argument('--snapshot-max-age', help='maximum age of OSM data in snapshot in hours (default: 24)', dest='snapshot_max_age', default=24, type=float)
+    parser.add_argument('--projected', help='compute distances and buffers in EPSG:2180 meters, buffers are then the same in all directions',
+                        action='store_const', const=True, dest='projected', default=False)
+    parser.add_argument('--incremental-state', help='file with merge state. Only addresses, that changed or are near OSM data that ' +
+                        'changed since the state was saved, are merged again, decisions for the rest are reused. Implies --processes 1',
+                        dest='incremental_state')
+    parser.add_argument('--processes', help='number of processes used to merge, import is split into spatial tiles (default: 1)', dest='processes', default=1, type=int)
+    parser.add_argument('--profile-merge', help='measure time, strategy hits and distance and contains computations of merge phases ' +
+                        'and strategies, and write them with N (default: 20) slowest addresses to JSON file next to output file',
+                        dest='profile_merge', nargs='?', const=20, type=int, metavar='N')
     parser.add_argument('--log-level', help='Set logging level (debug=10, info=20, warning=30, error=40, critical=50), default: 20', dest='log_level', default=20, type=int)
     parser.add_argument('--import-wms', help='WMS address for address layer, ex: ' +
         'http://www.punktyadresowe.pl/cgi-bin/mapserv?map=/home/www/impa2/wms/luban.map . Bounding box is still fetched via iMPA', dest='wms')
@@ -719,15 +1514,23 @@ def main():
         terc = args.terc
 
     __log.info("Working with TERC: %s", terc)
-    if args.addresses_file:
-        addrFunc = lambda: args.addresses_file.read()
-    else:
+    bbox = None
+    if data:
         # union with bounds of administrative boundary
         s = min(map(lambda x: x.center.y, data))
         w = min(map(lambda x: x.center.x, data))
         n = max(map(lambda x: x.center.y, data))
         e = max(map(lambda x: x.center.x, data))
-        addrFunc = lambda: getAddresses(map(str,(s, w, n, e)))
+        bbox = (s, w, n, e)
+    snapshot = None
+    if args.snapshot and bbox:
+        snapshot = get_fresh_snapshot(args.snapshot, datetime.timedelta(hours=args.snapshot_max_age), bbox)
+    if snapshot:
+        addrFunc = lambda: snapshot
+    elif args.addresses_file:
+        addrFunc = lambda: overpass.load_json(args.addresses_file)
+    else:
+        addrFunc = lambda: getAddresses(map(str, bbox))
 
     addr = addrFunc()
 
@@ -735,21 +1538,31 @@ def main():
         __log.warning("Warning - import data is empty. Check your import")
     __log.info('Processing %d addresses', len(data))
 
-    if len(addr['elements']) == 0:
-        __log.warning("Warning - address data is empty. Check your file/terc code")
-
     #m = Merger(data, addr, terc, parallel_process_func=parallel_map)
-    m = Merger(data, addr, terc)
+    m = Merger(data, addr, terc, columnar=args.low_memory or bool(args.snapshot), spatial_index=spatialindex.backends[args.spatial_index],
+               processes=args.processes, projected=args.projected, incremental_state=args.incremental_state,
+               profile=args.profile_merge)
+    if args.snapshot and bbox and not snapshot and not args.addresses_file:
+        m.osmdb.save_snapshot(args.snapshot, bbox)
+    if len(m.osmdb) == 0:
+        __log.warning("Warning - address data is empty. Check your file/terc code")
     if not args.no_merge:
         m.post_func.append(m.merge_addresses)
     m.merge()
 
     if args.full_mode:
-        ret = m.get_full_result(logIO)
+        ret = m.iter_full_result(logIO)
     else:
-        ret = m.get_incremental_result(logIO)
+        ret = m.iter_incremental_result(logIO)
+
+    with m.profile.measure('output'):
+        args.output.writelines(ret)
 
-    args.output.write(ret)
+    if args.profile_merge is not None:
+        path = args.output.name + '.profile.json'
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(m.profile.report(), f, indent=2)
+        __log.info("Merge profile written to %s", path)
 
 if __name__ == '__main__':
     main()
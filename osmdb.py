@@ -1,10 +1,21 @@
-from rtree import index
 from bs4 import BeautifulSoup
 from shapely.geometry import Point, Polygon, LineString
+import array
+import bisect
+import hashlib
+import itertools
+import json
+import math
+import os
+import shutil
+import tempfile
+import numpy as np
 import shapely
+from shapely.strtree import STRtree
 import utils
 import logging
 import pyproj
+from spatialindex import RtreeIndex
 
 
 
@@ -18,17 +29,12 @@ def _get_id(soup):
     """Converts overlapping identifiers for node, ways and relations in single integer space"""
     return __multipliers[soup['type']](int(soup['id']))
 
+# type codes consistent with _get_id: key = id*3 + type code
+_type_codes = {'node': 0, 'way': 1, 'relation': 2}
+_type_names = ('node', 'way', 'relation')
 
-__position_cache = {}
-def get_soup_position(soup):
-    try:
-        return __position_cache[soup['id']]
-    except KeyError:
-        ret = get_soup_position_cached(soup)
-        __position_cache[soup['id']] = ret
-        return ret
 
-def get_soup_position_cached(soup):
+def get_soup_position(soup):
     """Extracts position for way/node as bounding box"""
     if soup['type'] == 'node':
         return (float(soup['lat']), float(soup['lon'])) * 2
@@ -45,6 +51,13 @@ def get_soup_position_cached(soup):
             raise TypeError("No bounds for ways and relations!")
     raise TypeError("%s not supported" % (soup['type'],))
 
+def _shape_size(shape):
+    """approximate memory used by shapely geometry, in bytes"""
+    return 200 + 16 * shapely.get_num_coordinates(shape)
+
+# tuple of 4 floats with key in cache
+_position_size = 250
+
 def get_soup_center(soup):
     # lat, lon
     pos = get_soup_position(soup)
@@ -59,6 +72,72 @@ def distance(a, b):
         b = (b.y, b.x)
     return __geod.inv(a[1], a[0], b[1], b[0])[2]
 
+# mean Earth radius in meters
+_earth_radius = 6371008.8
+# smallest radius of curvature of WGS84 ellipsoid (meridian at equator), gives boxes never smaller than a radius
+_min_curvature_radius = 6335439.0
+
+def _latlon_array(points):
+    """converts sequence of shapely points or (lat, lon) tuples to (n, 2) array of lat, lon"""
+    return np.array(
+        [(x.y, x.x) if isinstance(x, shapely.geometry.base.BaseGeometry) else x for x in points],
+        dtype=np.float64
+    ).reshape((-1, 2))
+
+def _distances(lat_a, lon_a, lat_b, lon_b, approx=False):
+    if approx:
+        # equirectangular projection, error well below 1% for distances up to few kilometers
+        x = np.radians(lon_b - lon_a) * np.cos(np.radians((lat_a + lat_b) / 2))
+        y = np.radians(lat_b - lat_a)
+        return np.hypot(x, y) * _earth_radius
+    if not lat_a.size:
+        return np.zeros(lat_a.shape)
+    return np.asarray(__geod.inv(lon_a, lat_a, lon_b, lat_b)[2]).reshape(lat_a.shape)
+
+def distances(point, points, approx=False):
+    """
+    returns array of distances in meters between point and each of points, calculated in one call.
+    Points are shapely points or (lat, lon) tuples. With approx=True uses fast local
+    approximation, good for checks below one kilometer
+    """
+    ((lat, lon),) = _latlon_array((point,))
+    other = _latlon_array(points)
+    return _distances(np.full(len(other), lat), np.full(len(other), lon), other[:, 0], other[:, 1], approx)
+
+# PUWG-1992, planar coordinates in meters, used for metric geometry within Poland
+_to_2180 = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:2180', always_xy=True)
+_from_2180 = pyproj.Transformer.from_crs('EPSG:2180', 'EPSG:4326', always_xy=True)
+
+def project(lons, lats):
+    """returns (x, y) EPSG:2180 coordinates in meters for WGS84 coordinates, arrays are transformed in one call"""
+    return _to_2180.transform(lons, lats)
+
+def unproject(xs, ys):
+    """returns (lon, lat) WGS84 coordinates for EPSG:2180 coordinates, arrays are transformed in one call"""
+    return _from_2180.transform(xs, ys)
+
+def _project_positions(positions):
+    """returns (n, 2) array of EPSG:2180 coordinates of centers of bounding boxes (minlat, minlon, maxlat, maxlon)"""
+    pos = np.asarray(positions, dtype=np.float64).reshape((-1, 4))
+    return np.column_stack(project((pos[:, 1] + pos[:, 3]) / 2, (pos[:, 0] + pos[:, 2]) / 2)).reshape((-1, 2))
+
+def _project_point(point):
+    """returns (x, y) EPSG:2180 coordinates of shapely point or (lat, lon) tuple"""
+    ((lat, lon),) = _latlon_array((point,))
+    return project(lon, lat)
+
+def _project_geometry(geometry):
+    """returns shapely geometry transformed to EPSG:2180, all coordinates in one call"""
+    return shapely.transform(geometry, lambda x: np.column_stack(project(x[:, 0], x[:, 1])))
+
+def distance_matrix(points_a, points_b, approx=False):
+    """returns array of shape (len(points_a), len(points_b)) with distances in meters between all pairs of points"""
+    a = _latlon_array(points_a)
+    b = _latlon_array(points_b)
+    (lat_a, lat_b) = np.broadcast_arrays(a[:, 0:1], b[:, 0])
+    (lon_a, lon_b) = np.broadcast_arrays(a[:, 1:2], b[:, 1])
+    return _distances(lat_a, lon_a, lat_b, lon_b, approx)
+
 
 class OsmDbEntry(object):
     def __init__(self, entry, raw, osmdb):
@@ -85,204 +164,1134 @@ class OsmDbEntry(object):
         return self._entry[attr]
 
     def within(self, other):
+        if self._osmdb._projected:
+            return self._osmdb.get_projected_shape(self._raw).within(_project_geometry(other))
         return self.shape.within(other)
 
     def contains(self, other):
-        return self.shape.contains(other)
+        """other is shapely geometry in WGS84, with projected database it is checked in EPSG:2180"""
+        if self._osmdb._projected:
+            return self._osmdb.get_projected_shape(self._raw).contains(_project_geometry(other))
+        return self._osmdb.get_prepared_shape(self._raw).contains(other)
 
 class OsmDb(object):
     __log = logging.getLogger(__name__).getChild('OsmDb')
-    def __init__(self, osmdata, valuefunc=lambda x: x, indexes={}):
+    def __init__(self, osmdata, valuefunc=lambda x: x, indexes={}, spatial_index=RtreeIndex,
+                 shape_cache_size=64*1024*1024, position_cache_size=16*1024*1024, projected=False):
+        """
+        osmdata - parsed Overpass JSON. osmdata['elements'] may be any iterable, like from overpass.load_json(),
+                  elements are then loaded while they are parsed
+        spatial_index - spatial index backend class, one of spatialindex.backends
+        shape_cache_size, position_cache_size - memory budget in bytes for cached shapes and positions.
+                        Least recently used values are evicted above the budget
+        projected - transform all elements to EPSG:2180 at load time. Distances and containment checks
+                    are then planar in meters, see get_projected_shape()
+        """
         # assume osmdata is a BeautifulSoup object already
         # do it an assert
         self._osmdata = osmdata
-        self.__custom_indexes = dict((x, {}) for x in indexes.keys())
         self._valuefunc=valuefunc
-        self.__custom_indexes_conf = indexes
-        self.__cached_shapes = {}
+        self._spatial_index = spatial_index
+        self._custom_indexes_conf = indexes
+        self._shape_cache = utils.LRUCache(shape_cache_size, _shape_size)
+        self._position_cache = utils.LRUCache(position_cache_size, lambda x: _position_size)
+        self._projected = projected
+        self._projected_cache = utils.LRUCache(shape_cache_size, _shape_size)
+        self._projected_centers = {}
+        self._area = None
+        self._area_flags = {}
 
         def makegetfromindex(i):
             def getfromindex(key):
-                return self.__custom_indexes[i].get(key, [])
+                return self._get_from_index(i, key)
             return getfromindex
         def makegetallindexed(i):
             def getallindexed():
-                return tuple(self.__custom_indexes[i].keys())
+                return self._get_all_indexed(i)
             return getallindexed
 
         for i in indexes.keys():
             setattr(self, 'getby' + i, makegetfromindex(i))
             setattr(self, 'getall' + i, makegetallindexed(i))
 
-        self.__osm_obj = dict(((x['type'], x['id']), OsmDbEntry(self._valuefunc(x), x, self)) for x in self._osmdata['elements'])
+        self._load(self._osmdata['elements'])
+        if projected:
+            self._project_all()
         self.update_index()
 
+    def _load(self, elements):
+        if isinstance(elements, _Snapshot):
+            raise ValueError("Snapshots can be opened only with ColumnarOsmDb")
+        if not isinstance(elements, list):
+            # streamed elements, keep them as a list for add_new and remove
+            self._osmdata['elements'] = elements = list(elements)
+        # position of each element in osmdata['elements'] by its identity, so remove() doesn't scan the list
+        self.__element_rows = dict((id(x), i) for (i, x) in enumerate(elements))
+        self.__osm_obj = dict(((x['type'], x['id']), OsmDbEntry(self._valuefunc(x), x, self)) for x in elements)
+
+    def _project_all(self):
+        centers = _project_positions([get_soup_position(x._raw) for x in self.__osm_obj.values()])
+        self._projected_centers = dict(zip(self.__osm_obj.keys(), map(tuple, centers.tolist())))
+
+    def __len__(self):
+        return len(self.__osm_obj)
+
+    def _get_from_index(self, name, key):
+        return list(self._custom_indexes[name].get(key, {}).values())
+
+    def _get_all_indexed(self, name):
+        return tuple(self._custom_indexes[name].keys())
+
+    def _clear_custom_indexes(self):
+        self._custom_indexes = dict((x, {}) for x in self._custom_indexes_conf.keys())
+        # keys under which each element is stored in custom indexes, needed for removal
+        self._custom_index_keys = {}
+
+    def _add_to_custom_indexes(self, _id, val, stored):
+        """adds val to custom indexes, under _id. stored is the value kept in index"""
+        keys = {}
+        for (j, func) in self._custom_indexes_conf.items():
+            custom_index = self._custom_indexes[j]
+            key = func(val)
+            try:
+                entry = custom_index[key]
+            except KeyError:
+                entry = {}
+                custom_index[key] = entry
+            entry[_id] = stored
+            keys[j] = key
+        self._custom_index_keys[_id] = keys
+
+    def _remove_from_custom_indexes(self, _id):
+        for (j, key) in self._custom_index_keys.pop(_id, {}).items():
+            entry = self._custom_indexes[j][key]
+            del entry[_id]
+            if not entry:
+                del self._custom_indexes[j][key]
+
     def update_index(self):
         self.__log.debug("Recreating index")
 
-        self.__index = index.Index()
         self.__index_entries = {}
-        self.__custom_indexes = dict((x, {}) for x in self.__custom_indexes_conf.keys())
-
-        for (key, val) in self.__osm_obj.items():
-            pos = get_soup_position(val._raw)
-            if pos:
-                _id = _get_id(val._raw)
-                self.__index.insert(_id, pos)
-
-                self.__index_entries[_id] = val
-
-                for j in self.__custom_indexes_conf.keys():
-                    custom_index = self.__custom_indexes[j]
-                    key = self.__custom_indexes_conf[j](val)
-                    try:
-                        entry = custom_index[key]
-                    except KeyError:
-                        entry = []
-                        custom_index[key] = entry
-                    entry.append(val)
+        self.__index_positions = {}
+        self._clear_custom_indexes()
+
+        for val in self.__osm_obj.values():
+            self.__add_to_index(val)
+        self.__index = self._spatial_index(tuple(self.__index_positions.keys()), tuple(self.__index_positions.values()))
+
+    def __add_to_index(self, val):
+        """adds val to all indexes except spatial one, returns id and position for spatial index"""
+        pos = self.get_position(val._raw)
+        _id = _get_id(val._raw)
+        self.__index_entries[_id] = val
+        self.__index_positions[_id] = pos
+        self._add_to_custom_indexes(_id, val, val)
+        return (_id, pos)
 
     def add_new(self, new):
+        """adds new element to database and all indexes"""
+        self.__element_rows[id(new)] = len(self._osmdata['elements'])
         self._osmdata['elements'].append(new)
         ret = OsmDbEntry(self._valuefunc(new), new, self)
         self.__osm_obj[(new['type'], new['id'])] = ret
+        self.__index.insert(*self.__add_to_index(ret))
         return ret
 
+    def remove(self, entry):
+        """removes entry from database and all indexes"""
+        _id = _get_id(entry._raw)
+        del self.__osm_obj[(entry._raw['type'], entry._raw['id'])]
+        self.__index.delete(_id, self.__index_positions.pop(_id))
+        del self.__index_entries[_id]
+        self._remove_from_custom_indexes(_id)
+        self._forget_cached(entry._raw)
+        # move last element into the freed slot, order of osmdata['elements'] is not preserved
+        elements = self._osmdata['elements']
+        row = self.__element_rows.pop(id(entry._raw))
+        last = elements.pop()
+        if last is not entry._raw:
+            elements[row] = last
+            self.__element_rows[id(last)] = row
+
+    def update_position(self, entry):
+        """updates spatial index after entry location was changed"""
+        _id = _get_id(entry._raw)
+        self._forget_cached(entry._raw)
+        pos = self.get_position(entry._raw)
+        self.__index.delete(_id, self.__index_positions[_id])
+        self.__index.insert(_id, pos)
+        self.__index_positions[_id] = pos
+
+    def reindex(self, entry):
+        """updates custom indexes after entry values, that custom indexes are based on, were changed"""
+        _id = _get_id(entry._raw)
+        self._remove_from_custom_indexes(_id)
+        self._add_to_custom_indexes(_id, entry, entry)
+
+    def get(self, objtype, id_):
+        """returns entry for given object type and id, raises KeyError if not found"""
+        return self.__osm_obj[(objtype, id_)]
+
     def get_all_values(self):
         return self.__index_entries.values()
 
-    def nearest(self, point, num_results=1):
+    def get_versions(self):
+        """
+        returns dict (type, id) -> (version, geometry hash, bounding box) for all ways and relations and for tagged
+        nodes, as loaded. Version is None when data has no metadata. Geometry hash is None for nodes, see
+        _get_geometry_hash(). New elements are skipped
+        """
+        def geometry(soup):
+            if soup['type'] == 'way':
+                return self._get_geometry_hash('way', soup['nodes'])
+            if soup['type'] == 'relation':
+                return self._get_geometry_hash('relation', [(x['type'], x['ref']) for x in soup['members']])
+            return None
+
+        return dict(
+            (key, (x._raw.get('version'), geometry(x._raw), tuple(get_soup_position(x._raw))))
+            for (key, x) in self.__osm_obj.items()
+            if key[1] >= 0 and (key[0] != 'node' or x._raw.get('tags'))
+        )
+
+    def _get_way_nodes(self, way_id):
+        """returns list of node ids of way"""
+        return self.get('way', way_id)._raw['nodes']
+
+    def _get_geometry_hash(self, objtype, refs):
+        """
+        returns hash of coordinates of nodes of way, or of member nodes and ways of relation. Untagged nodes
+        are not versioned, but moving one changes shape of its ways, while their versions stay the same.
+        refs - node ids of way, or (type, ref) tuples of relation members
+        """
+        if objtype == 'way':
+            node_lists = [refs]
+        else:
+            node_lists = ([ref] if kind == 'node' else ref for (kind, ref) in refs if kind in ('node', 'way'))
+        ret = hashlib.sha1()
+        for nodes in node_lists:
+            try:
+                if not isinstance(nodes, list):
+                    nodes = self._get_way_nodes(nodes)
+                ret.update(np.array(self._get_node_coords(nodes), dtype=np.float64).tobytes())
+            except KeyError:
+                # incomplete data, member is not loaded
+                ret.update(b'missing')
+            ret.update(b'|')
+        return ret.hexdigest()
+
+    def _nearest(self, bounds, num_results):
+        return map(self.__index_entries.get, self.__index.nearest(bounds, num_results))
+
+    def _intersection(self, bounds):
+        return map(self.__index_entries.get, self.__index.intersection(bounds))
+
+    def nearest(self, point, num_results=1, max_distance=None):
+        """
+        returns num_results entries nearest to point (shapely Point or (lat, lon) tuple). With max_distance,
+        only entries within that many meters are returned, see within_radius()
+        """
         if isinstance(point, Point):
             point = (point.y, point.x)
-        return map(self.__index_entries.get, 
-                   self.__index.nearest(point * 2, num_results)
-               )
+        if max_distance is not None:
+            return iter(self.within_radius(point, max_distance)[:num_results])
+        return self._nearest(tuple(point) * 2, num_results)
+
+    def intersecting(self, bounds):
+        """returns entries, which bounding boxes intersect bounds (minlat, minlon, maxlat, maxlon)"""
+        return self._intersection(tuple(bounds))
+
+    def within_radius(self, point, meters, filter=None, with_distances=False):
+        """
+        returns list of entries, which bounding boxes are within meters from point, ordered by distance.
+        filter - function called on each candidate, returns False for entries to skip.
+        with_distances - return list of (entry, distance) tuples instead.
+        Spatial index is queried with bounding box of the radius and candidates are checked with geodesic distance
+        """
+        if isinstance(point, Point):
+            point = (point.y, point.x)
+        (lat, lon) = point
+        dlat = math.degrees(meters / _min_curvature_radius)
+        dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 90))), 1e-9)
+        candidates = list(self._intersection((lat - dlat, lon - dlon, lat + dlat, lon + dlon)))
+        if filter:
+            candidates = [x for x in candidates if filter(x)]
+        if not candidates:
+            return []
+        # distance to the nearest point of the bounding box
+        pos = np.array([self.get_position(x._raw) for x in candidates], dtype=np.float64)
+        dist = distances(point, np.column_stack((np.clip(lat, pos[:, 0], pos[:, 2]), np.clip(lon, pos[:, 1], pos[:, 3]))))
+        order = np.lexsort((np.array([_get_id(x._raw) for x in candidates]), dist))
+        order = order[dist[order] <= meters].tolist()
+        if with_distances:
+            return [(candidates[i], float(dist[i])) for i in order]
+        return [candidates[i] for i in order]
+
+    def _get_node_coords(self, node_ids):
+        """returns list of (lon, lat) tuples for given node ids"""
+        return [(float(x['lon']), float(x['lat'])) for x in (self.get('node', y)._raw for y in node_ids)]
+
+    def _get_node_xy(self, node_ids):
+        """returns list of EPSG:2180 (x, y) tuples for given node ids"""
+        return [self.get_projected_center(self.get('node', y)._raw) for y in node_ids]
+
+    def set_area(self, shape):
+        """
+        sets area checked by in_area(). The shape is prepared and flags for all nodes are computed
+        at once, for ways and relations when they are first needed
+        """
+        shapely.prepare(shape)
+        self._area = shape
+        self._area_flags = {}
+        self._compute_area_flags()
+
+    def _compute_area_flags(self):
+        nodes = [x._raw for x in self.__osm_obj.values() if x._raw['type'] == 'node']
+        flags = shapely.contains_xy(self._area, [float(x['lon']) for x in nodes], [float(x['lat']) for x in nodes])
+        self._area_flags.update(zip(((x['type'], x['id']) for x in nodes), flags.tolist()))
+
+    def _get_area_flag(self, soup):
+        return self._area_flags.get((soup['type'], soup['id']))
+
+    def _set_area_flag(self, soup, flag):
+        self._area_flags[(soup['type'], soup['id'])] = flag
+
+    def in_area(self, entries):
+        """
+        returns list telling which of entries have center within area set by set_area(). Flags are kept
+        until entry is moved, missing ones are computed in one call
+        """
+        if self._area is None:
+            raise ValueError("No area set, call set_area() first")
+        entries = list(entries)
+        ret = [self._get_area_flag(x._raw) for x in entries]
+        missing = [i for (i, flag) in enumerate(ret) if flag is None]
+        if missing:
+            centers = shapely.get_coordinates([entries[i].center for i in missing])
+            for (i, flag) in zip(missing, shapely.contains_xy(self._area, centers[:, 0], centers[:, 1]).tolist()):
+                self._set_area_flag(entries[i]._raw, flag)
+                ret[i] = flag
+        return ret
+
+    def _forget_cached(self, soup):
+        key = (soup['type'], soup['id'])
+        self._position_cache.pop(key)
+        self._shape_cache.pop(key)
+        self._projected_cache.pop(key)
+        self._projected_centers.pop(key, None)
+        self._area_flags.pop(key, None)
+
+    def cache_stats(self):
+        return {
+            'shapes': self._shape_cache.stats(),
+            'positions': self._position_cache.stats(),
+            'projected_shapes': self._projected_cache.stats(),
+        }
+
+    def get_position(self, soup):
+        """returns bounding box of soup as (minlat, minlon, maxlat, maxlon)"""
+        key = (soup['type'], soup['id'])
+        ret = self._position_cache.get(key)
+        if ret is None:
+            ret = get_soup_position(soup)
+            self._position_cache[key] = ret
+        return ret
+
+    def get_projected_center(self, soup):
+        """returns center of bounding box of soup as EPSG:2180 (x, y) tuple"""
+        key = (soup['type'], soup['id'])
+        try:
+            return self._projected_centers[key]
+        except KeyError:
+            ret = self._projected_centers[key] = tuple(_project_positions(self.get_position(soup))[0].tolist())
+            return ret
+
+    def distances(self, point, entries, approx=False):
+        """
+        returns array of distances in meters between point and center of bounding box of each entry.
+        See distances() for details. With projected=True distances are planar in EPSG:2180, they differ from
+        geodesic ones by less than 0.1% within Poland
+        """
+        if self._projected:
+            xy = np.array([self.get_projected_center(x._raw) for x in entries], dtype=np.float64).reshape((-1, 2))
+            (x, y) = _project_point(point)
+            return np.hypot(xy[:, 0] - x, xy[:, 1] - y)
+        pos = np.array([self.get_position(x._raw) for x in entries], dtype=np.float64).reshape((-1, 4))
+        return distances(point, np.column_stack(((pos[:, 0] + pos[:, 2]) / 2, (pos[:, 1] + pos[:, 3]) / 2)), approx)
 
     def get_shape(self, soup):
-        id_ = soup['id']
-        ret = self.__cached_shapes.get(id_)
-        if not ret:
+        key = (soup['type'], soup['id'])
+        ret = self._shape_cache.get(key)
+        if ret is None:
             ret = self.get_shape_cached(soup)
-            self.__cached_shapes[id_] = ret
+            self._shape_cache[key] = ret
         return ret
 
-    def get_shape_cached(self, soup):
+    def get_prepared_shape(self, soup):
+        """
+        returns shape with prepared geometry, for repeated predicates like contains. Shapes of ways
+        and relations are prepared on first use and stay prepared as long as they are cached
+        """
+        ret = self.get_shape(soup)
+        if soup['type'] != 'node' and not shapely.is_prepared(ret):
+            shapely.prepare(ret)
+        return ret
+
+    def get_projected_shape(self, soup):
+        """
+        returns shape of soup in EPSG:2180 meters, prepared for repeated predicates. Shapes are built
+        from projected coordinates, kept for all elements when database is created with projected=True
+        """
+        key = (soup['type'], soup['id'])
+        ret = self._projected_cache.get(key)
+        if ret is None:
+            ret = self.get_shape_cached(soup, projected=True)
+            if ret is not None and soup['type'] != 'node':
+                shapely.prepare(ret)
+            self._projected_cache[key] = ret
+        return ret
+
+    def contains_points(self, entry, points):
+        """returns boolean array telling which of points (shapely points) are within entry shape"""
+        coords = shapely.get_coordinates(points)
+        if self._projected:
+            (xs, ys) = project(coords[:, 0], coords[:, 1])
+            return shapely.contains_xy(self.get_projected_shape(entry._raw), xs, ys)
+        return shapely.contains_xy(self.get_prepared_shape(entry._raw), coords[:, 0], coords[:, 1])
+
+    def containing_point(self, entries, point):
+        """returns boolean array telling which of entries shapes contain point"""
+        shapes = np.empty(len(entries), dtype=object)
+        if self._projected:
+            shapes[:] = [self.get_projected_shape(x._raw) for x in entries]
+            return shapely.contains_xy(shapes, *_project_point(point))
+        shapes[:] = [self.get_prepared_shape(x._raw) for x in entries]
+        return shapely.contains_xy(shapes, point.x, point.y)
+
+    def get_shape_cached(self, soup, projected=False):
+        """builds shape of soup, in EPSG:2180 meters when projected is True"""
+        (node_coords, get_shape) = (self._get_node_xy, self.get_projected_shape) if projected else \
+            (self._get_node_coords, self.get_shape)
         if soup['type'] == 'node':
+            if projected:
+                return Point(self.get_projected_center(soup))
             return Point(float(soup['lon']), float(soup['lat']))
 
         if soup['type'] == 'way':
-            nodes = tuple(self.__osm_obj[('node', y)] for y in soup['nodes'])
+            nodes = node_coords(soup['nodes'])
             if len(nodes) < 3:
                 self.__log.warning("Way has less than 3 nodes. Check geometry. way:%s" % (soup['id'],))
                 self.__log.warning("Returning geometry as a point")
-                return Point(sum(x.center.x for x in nodes)/len(nodes), sum(x.center.y for x in nodes)/len(nodes))
-            return Polygon((x.center.x, x.center.y) for x in nodes)
+                return Point(sum(x[0] for x in nodes)/len(nodes), sum(x[1] for x in nodes)/len(nodes))
+            return Polygon(nodes)
 
         if soup['type'] == 'relation':
             if soup['tags'].get('type') in ('network', 'level'):
                 # shortcut for stupid relations with addresses
                 return LineString(
                     map(
-                        lambda x: x.center,
-                        (self.__osm_obj[(x['type'], x['ref'])] for x in soup['members'])
+                        lambda x: get_shape(x._raw).centroid,
+                        (self.get(x['type'], x['ref']) for x in soup['members'])
                     )
                 ).centroid
-            # returns only outer ways, no exclusion for inner ways
-            # hardest one
-            # outer ways
-            # TODO: handle multiple outer ways, and inner ways
-            # multiple outer: terc=1019042
-            # inner ways: terc=1014082
             outer = []
             inner = []
             for member in filter(lambda x: x['type'] == 'way', soup['members']):
-                obj = self.__osm_obj[(member['type'], member['ref'])]
+                obj = self.get(member['type'], member['ref'])
                 if member['role'] == 'outer' or not member.get('role'):
                     outer.append(obj)
                 if member['role'] == 'inner':
                     inner.append(obj)
 
             try:
-                inner = self.get_closed_ways(inner)
-                outer = self.get_closed_ways(outer)
+                inner = self.get_closed_ways(inner, node_coords)
+                outer = self.get_closed_ways(outer, node_coords)
             except ValueError:
                 raise ValueError("Broken geometry for relation: %s" % (soup['id'],))
-            ret = None
-            for out in outer:
-                val = out
-                for inn in filter(out.contains, inner):
-                    val = val.difference(inn)
-                if not ret:
-                    ret = val
-                else:
-                    ret = ret.union(val)
-            return ret
+            if not outer:
+                return None
+            # find inner rings within each outer ring in one query, and cut all of them at once
+            if inner:
+                (outer_idx, inner_idx) = STRtree(inner).query(outer, predicate='contains').tolist()
+            else:
+                (outer_idx, inner_idx) = ([], [])
+            holes = utils.groupby(zip(outer_idx, inner_idx), lambda x: x[0], lambda x: inner[x[1]])
+            parts = [out.difference(shapely.unary_union(holes[i])) if i in holes else out for (i, out) in enumerate(outer)]
+            if len(parts) == 1:
+                return parts[0]
+            return shapely.unary_union(parts)
+
+    def get_closed_ways(self, ways, node_coords=None):
+        """
+        returns list of Polygons made of ways joined by their end nodes, in time linear to number of ways.
+        node_coords - function returning coordinates for node ids, default: _get_node_coords.
+        Raises ValueError if ways do not form closed rings
+        """
+        node_coords = node_coords or self._get_node_coords
+        nodes = [x._raw['nodes'] for x in ways]
+        # unused ways by their first and last node
+        by_end = {}
+        for (i, ids) in enumerate(nodes):
+            for end in (ids[0], ids[-1]):
+                try:
+                    by_end[end].add(i)
+                except KeyError:
+                    by_end[end] = set((i,))
+
+        def _take(i):
+            for end in (nodes[i][0], nodes[i][-1]):
+                by_end[end].discard(i)
+            return nodes[i]
+
+        def _take_adjacent(node_id):
+            """returns nodes of unused way that ends with node_id, starting with node_id, or None"""
+            candidates = by_end.get(node_id)
+            if not candidates:
+                return None
+            ids = _take(min(candidates))
+            return ids if ids[0] == node_id else ids[::-1]
 
-    def get_closed_ways(self, ways):
-        if not ways:
-            return []
-        ways = list(ways)
-        way_by_first_node = utils.groupby(ways, lambda x: x._raw['nodes'][0])
-        way_by_last_node = utils.groupby(ways, lambda x: x._raw['nodes'][-1])
         ret = []
-        cur_elem = ways[0]
-        node_ids = []
+        for i in range(len(nodes)):
+            if i not in by_end[nodes[i][0]]:
+                # already part of some ring
+                continue
+            node_ids = list(_take(i))
+            while node_ids[0] != node_ids[-1]:
+                ids = _take_adjacent(node_ids[-1])
+                if ids is None:
+                    # try to continue from the other end
+                    node_ids.reverse()
+                    ids = _take_adjacent(node_ids[-1])
+                    if ids is None:
+                        raise ValueError
+                node_ids.extend(ids[1:])
+            ret.append(Polygon(node_coords(node_ids)))
+        return ret
 
-        def _get_ids(elem):
-            return elem['nodes']
 
-        def _get_way(id_, dct):
-            if id_ in dct:
-                ret = tuple(filter(lambda x: x in ways, dct[id_]))
-                if ret:
-                    return ret[0]
-            return None
+_snapshot_format = 2
 
-        ids = _get_ids(cur_elem)
-        while ways:
-            #ids = list(y['ref'] for y in cur_elem._raw.find_all('nd', recursive=False))
-            node_ids.extend(ids)
-            ways.remove(cur_elem)
-            if node_ids[0] == node_ids[-1]:
-                # full circle, append to Polygons in ret
-                ret.append(
-                    Polygon(
-                        (x.center.x, x.center.y) for x in (self.__osm_obj[('node', y)] for y in node_ids)
-                    )
+def _class_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__qualname__)
+
+
+class _Snapshot(object):
+    """elements of snapshot saved by ColumnarOsmDb.save_snapshot(), as returned by load_snapshot()"""
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+
+    def array(self, name, mode='c'):
+        # copy on write by default, so the snapshot can be changed in memory, as any other OsmDb
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode=mode)
+
+    def custom_indexes(self, element_keys, rows):
+        """
+        returns (custom indexes, custom index keys) of ColumnarOsmDb, read from memory mapped arrays.
+        element_keys - array of element keys by row, rows - function returning rows of element keys
+        """
+        indexes = {}
+        for (i, name) in enumerate(self.meta['indexes']):
+            prefix = 'index%d_' % (i,)
+            arrays = dict((x, self.array(prefix + x, 'r')) for x in ('key_offsets', 'key_data', 'order', 'offsets', 'rows', 'row_keys'))
+            indexes[name] = _SnapshotIndex(_StringTable(arrays['key_offsets'], arrays['key_data']), arrays['order'],
+                                           arrays['offsets'], arrays['rows'], arrays['row_keys'], element_keys)
+        return (indexes, _SnapshotIndexKeys(indexes, rows))
+
+
+def _encode_key(key):
+    return json.dumps(key, ensure_ascii=False, separators=(',', ':'))
+
+
+def _decode_key(value):
+    """returns index key from JSON, lists are converted back to tuples, so keys are hashable"""
+    def freeze(x):
+        return tuple(map(freeze, x)) if isinstance(x, list) else x
+    return freeze(json.loads(value))
+
+
+def _string_arrays(strings):
+    """returns (offsets, data) arrays of UTF-8 encoded strings, for _StringTable"""
+    strings = [x.encode('utf-8') for x in strings]
+    return (np.cumsum([0] + list(map(len, strings)), dtype=np.int64), np.frombuffer(b''.join(strings), dtype=np.uint8))
+
+
+class _SnapshotIndex(object):
+    """
+    custom index of ColumnarOsmDb opened from a snapshot, used as dict key -> {element key: row}. Keys are JSON
+    strings in order of insertion, found through their sorted order, with buckets of rows in memory mapped
+    arrays. Buckets changed after opening are kept in memory
+    """
+    def __init__(self, keys, order, offsets, rows, row_keys, element_keys):
+        self._keys = keys
+        self._order = order
+        self._offsets = offsets
+        self._rows = rows
+        self.row_keys = row_keys
+        self._element_keys = element_keys
+        self._changed = {}
+        self._deleted = set()
+        # keys added after opening, in order of insertion
+        self._added = {}
+
+    def key(self, i):
+        """returns key stored at position i"""
+        return _decode_key(self._keys[i])
+
+    def _find(self, key):
+        encoded = _encode_key(key)
+        sorted_keys = _SortedView(self._keys, self._order)
+        i = bisect.bisect_left(sorted_keys, encoded)
+        if i < len(sorted_keys) and sorted_keys[i] == encoded:
+            return int(self._order[i])
+        return -1
+
+    def get(self, key, default=None):
+        try:
+            return self._changed[key]
+        except KeyError:
+            pass
+        if key in self._deleted:
+            return default
+        i = self._find(key)
+        if i < 0:
+            return default
+        rows = self._rows[self._offsets[i]:self._offsets[i+1]].tolist()
+        return dict(zip(self._element_keys[rows].tolist(), rows))
+
+    def __getitem__(self, key):
+        ret = self.get(key)
+        if ret is None:
+            raise KeyError(key)
+        # bucket is changed by the caller
+        self._changed[key] = ret
+        return ret
+
+    def __setitem__(self, key, value):
+        if self.get(key) is None:
+            self._added[key] = True
+        self._changed[key] = value
+
+    def __delitem__(self, key):
+        self._changed.pop(key, None)
+        self._added.pop(key, None)
+        self._deleted.add(key)
+
+    def keys(self):
+        # same order as keys of dict changed the same way
+        return [x for x in map(self.key, range(len(self._keys))) if x not in self._deleted] + list(self._added)
+
+
+class _SortedView(object):
+    """read only view of sequence in given order, for bisect"""
+    def __init__(self, seq, order):
+        self._seq = seq
+        self._order = order
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, i):
+        return self._seq[int(self._order[i])]
+
+
+class _SnapshotIndexKeys(object):
+    """keys under which each element is stored in custom indexes opened from a snapshot, used as dict element key -> {name: key}"""
+    def __init__(self, indexes, rows):
+        self._indexes = indexes
+        self._get_rows = rows
+        self._changed = {}
+        self._removed = set()
+
+    def __setitem__(self, key, value):
+        self._changed[key] = value
+        self._removed.add(key)
+
+    def pop(self, key, default=None):
+        try:
+            return self._changed.pop(key)
+        except KeyError:
+            pass
+        if key in self._removed:
+            return default
+        self._removed.add(key)
+        row = int(self._get_rows(key))
+        if row < 0:
+            return default
+        ret = {}
+        for (name, index) in self._indexes.items():
+            i = int(index.row_keys[row])
+            if i >= 0:
+                ret[name] = index.key(i)
+        return ret or default
+
+
+class _StringTable(object):
+    """read only list of strings kept as one UTF-8 buffer with offsets, strings are decoded on access"""
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        (start, end) = self._offsets[i:i+2].tolist()
+        return self._data[start:end].tobytes().decode('utf-8')
+
+
+def load_snapshot(path):
+    """
+    opens snapshot saved with ColumnarOsmDb.save_snapshot(). Returns osmdata to be passed to ColumnarOsmDb,
+    with Overpass header, so osmdata['osm3s']['timestamp_osm_base'] tells how fresh the data is.
+    Arrays are memory mapped, so this takes constant time.
+    """
+    with open(os.path.join(path, 'snapshot.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta['format'] != _snapshot_format:
+        raise ValueError("Unsupported snapshot format: %s" % (meta['format'],))
+    ret = dict(meta['osmdata'])
+    ret['elements'] = _Snapshot(path, meta)
+    return ret
+
+
+def snapshot_covers(osmdata, bbox):
+    """returns True if osmdata from load_snapshot() were downloaded for area containing bbox (south, west, north, east)"""
+    saved = osmdata['elements'].meta.get('bbox')
+    if not saved:
+        return False
+    bbox = list(map(float, bbox))
+    return saved[0] <= bbox[0] and saved[1] <= bbox[1] and saved[2] >= bbox[2] and saved[3] >= bbox[3]
+
+
+def _drain(lst):
+    """yields elements of the list removing them, so they can be freed as soon as processed"""
+    while lst:
+        yield lst.pop()
+
+
+class ColumnarOsmDb(OsmDb):
+    """
+    OsmDb keeping elements in NumPy arrays instead of parsed JSON dicts.
+
+    Node positions and way/relation bounds are kept in one float array, way nodes and relation
+    members in a flat offsets + refs buffer and tags as indexes into a table of interned strings.
+    OsmDbEntry objects are built only when an element is returned to the caller and are kept
+    from then on, so changes done through them are preserved. Loaded data take about 7 times less
+    memory than in OsmDb (138 MB instead of 949 MB for 100k addresses generated by benchmark-merge.py),
+    but merge materializes most elements, so peak memory of whole merge is only about 1.2 times lower
+    (1558 MB instead of 1844 MB).
+
+    Elements are consumed from osmdata['elements'], which is left empty. Custom indexes cover only
+    elements with tags, new elements and elements already returned to the caller. Use get() to
+    look up untagged elements, such as way nodes fetched by recursion.
+
+    Loaded data can be saved with save_snapshot() and reopened by passing load_snapshot() result
+    as osmdata.
+    """
+    __log = logging.getLogger(__name__).getChild('ColumnarOsmDb')
+    __meta_int = (('version', 'i'), ('changeset', 'q'), ('uid', 'i'))
+    __meta_str = ('timestamp', 'user')
+    __meta_order = ('timestamp', 'version', 'changeset', 'user', 'uid')
+
+    __arrays = ('keys', 'bounds', 'tag_offsets', 'tag_kv', 'ref_offsets', 'refs', 'ref_types', 'ref_roles',
+                'sorted_keys', 'order')
+
+    def _load(self, elements):
+        self._materialized = {}
+        self._new = {}
+        self._new_positions = {}
+        self._removed = set()
+        self._snapshot = None
+        self._xy = None
+        if isinstance(elements, _Snapshot):
+            self._load_snapshot(elements)
+            return
+        if isinstance(elements, list):
+            elements = _drain(elements)
+        self._strings = []
+        string_ids = {}
+
+        def intern(value):
+            try:
+                return string_ids[value]
+            except KeyError:
+                string_ids[value] = len(self._strings)
+                self._strings.append(value)
+                return string_ids[value]
+
+        keys = array.array('q')
+        bounds = array.array('d')
+        tag_offsets = array.array('q', (0,))
+        tag_kv = array.array('i')
+        ref_offsets = array.array('q', (0,))
+        refs = array.array('q')
+        ref_types = array.array('b')
+        ref_roles = array.array('i')
+        meta = dict((name, array.array(typecode)) for (name, typecode) in self.__meta_int)
+        meta.update((name, array.array('i')) for name in self.__meta_str)
+
+        for soup in elements:
+            keys.append(_get_id(soup))
+            if soup['type'] == 'node':
+                bounds.extend((soup['lat'], soup['lon']) * 2)
+            else:
+                b = soup['bounds']
+                bounds.extend((b['minlat'], b['minlon'], b['maxlat'], b['maxlon']))
+            if soup['type'] == 'way':
+                refs.extend(soup['nodes'])
+                ref_types.extend(itertools.repeat(_type_codes['node'], len(soup['nodes'])))
+                ref_roles.extend(itertools.repeat(-1, len(soup['nodes'])))
+            elif soup['type'] == 'relation':
+                for member in soup['members']:
+                    refs.append(member['ref'])
+                    ref_types.append(_type_codes[member['type']])
+                    ref_roles.append(intern(member.get('role', '')))
+            ref_offsets.append(len(refs))
+            for (k, v) in soup.get('tags', {}).items():
+                tag_kv.extend((intern(k), intern(v)))
+            tag_offsets.append(len(tag_kv) // 2)
+            for (name, _) in self.__meta_int:
+                meta[name].append(soup.get(name, -1))
+            for name in self.__meta_str:
+                meta[name].append(intern(soup[name]) if name in soup else -1)
+
+        self._keys = np.frombuffer(keys, dtype=np.int64)
+        self._bounds = np.frombuffer(bounds, dtype=np.float64).reshape((-1, 4))
+        self._tag_offsets = np.frombuffer(tag_offsets, dtype=np.int64)
+        self._tag_kv = np.frombuffer(tag_kv, dtype=np.int32).reshape((-1, 2))
+        self._ref_offsets = np.frombuffer(ref_offsets, dtype=np.int64)
+        self._refs = np.frombuffer(refs, dtype=np.int64)
+        self._ref_types = np.frombuffer(ref_types, dtype=np.int8)
+        self._ref_roles = np.frombuffer(ref_roles, dtype=np.int32)
+        self._meta = dict((name, np.frombuffer(val, dtype=np.int64 if val.typecode == 'q' else np.int32))
+                          for (name, val) in meta.items())
+
+        # Overpass returns some elements twice (ex. address node being also a building node), keep one
+        order = np.argsort(self._keys, kind='stable')
+        (self._sorted_keys, first) = np.unique(self._keys[order], return_index=True)
+        self._order = order[first]
+        self.__log.debug("Loaded %d elements, %d strings", len(self._order), len(self._strings))
+
+    def _load_snapshot(self, snapshot):
+        if snapshot.meta['indexes'] != sorted(self._custom_indexes_conf.keys()):
+            raise ValueError("Snapshot has indexes: %s, expected: %s" % (
+                snapshot.meta['indexes'], sorted(self._custom_indexes_conf.keys())))
+        for name in self.__arrays:
+            setattr(self, '_' + name, snapshot.array(name))
+        self._meta = dict((name, snapshot.array('meta_' + name)) for name in snapshot.meta['meta'])
+        self._strings = _StringTable(snapshot.array('string_offsets'), snapshot.array('string_data'))
+        self._snapshot = snapshot
+        self.__log.debug("Opened snapshot %s with %d elements", snapshot.path, len(self._order))
+
+    def save_snapshot(self, path, bbox=None):
+        """
+        saves loaded elements with custom and spatial indexes to directory path, for load_snapshot().
+        Changes done through entries are not saved, so save the snapshot before making any.
+        Existing snapshot in path is replaced, databases opened from it are not affected. Other existing
+        directory is never replaced.
+        bbox - (south, west, north, east) of area, for which OSM data were downloaded, see snapshot_covers()
+        """
+        if self._new or self._removed:
+            raise ValueError("Snapshot can't be saved after elements were added or removed")
+        if os.path.exists(path) and not os.path.exists(os.path.join(path, 'snapshot.json')):
+            raise ValueError("%s exists and is not a snapshot" % (path,))
+        final_path = path
+        # write next to final location and swap, so partially written snapshot is never opened
+        path = tempfile.mkdtemp(prefix='.snapshot-', dir=os.path.dirname(os.path.abspath(final_path)))
+
+        arrays = dict((name, getattr(self, '_' + name)) for name in self.__arrays)
+        arrays.update(('meta_' + name, val) for (name, val) in self._meta.items())
+        (arrays['string_offsets'], arrays['string_data']) = _string_arrays(self._strings[i] for i in range(len(self._strings)))
+        # custom indexes as keys with buckets of rows, opened by _Snapshot.custom_indexes()
+        for (i, name) in enumerate(sorted(self._custom_indexes_conf.keys())):
+            prefix = 'index%d_' % (i,)
+            custom_index = self._custom_indexes[name]
+            keys = list(custom_index.keys())
+            buckets = [list(custom_index.get(x).values()) for x in keys]
+            encoded = list(map(_encode_key, keys))
+            (arrays[prefix + 'key_offsets'], arrays[prefix + 'key_data']) = _string_arrays(encoded)
+            arrays[prefix + 'order'] = np.array(sorted(range(len(keys)), key=encoded.__getitem__), dtype=np.int64)
+            arrays[prefix + 'offsets'] = np.cumsum([0] + list(map(len, buckets)), dtype=np.int64)
+            arrays[prefix + 'rows'] = np.fromiter(itertools.chain.from_iterable(buckets), dtype=np.int64)
+            row_keys = np.full(len(self._keys), -1, dtype=np.int64)
+            for (j, rows) in enumerate(buckets):
+                row_keys[rows] = j
+            arrays[prefix + 'row_keys'] = row_keys
+        for (name, val) in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), val)
+        if self._spatial_index.persistent:
+            self._spatial_index.save(os.path.join(path, 'spatial'), self._keys[self._order], self._bounds[self._order])
+
+        meta = {
+            'format': _snapshot_format,
+            'osmdata': dict((k, v) for (k, v) in self._osmdata.items() if k != 'elements'),
+            'indexes': sorted(self._custom_indexes_conf.keys()),
+            'meta': sorted(self._meta.keys()),
+            'spatial_index': _class_name(self._spatial_index) if self._spatial_index.persistent else None,
+            'bbox': list(map(float, bbox)) if bbox is not None else None,
+        }
+        with open(os.path.join(path, 'snapshot.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        if os.path.exists(final_path):
+            os.rename(final_path, path + '.old')
+            os.rename(path, final_path)
+            shutil.rmtree(path + '.old')
+        else:
+            os.rename(path, final_path)
+        self.__log.info("Saved snapshot of %d elements to %s", len(self._order), final_path)
+
+    def _rows(self, keys):
+        """returns row numbers for array of keys, -1 when key is not found"""
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(self._sorted_keys):
+            return np.full(keys.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+        return np.where(self._sorted_keys[pos] == keys, self._order[pos], -1)
+
+    def _get_soup(self, row):
+        # keys in the same order as in Overpass output
+        key = int(self._keys[row])
+        objtype = _type_names[key % 3]
+        ret = {'type': objtype, 'id': key // 3}
+        b = self._bounds[row].tolist()
+        if objtype == 'node':
+            (ret['lat'], ret['lon']) = b[:2]
+        else:
+            ret['bounds'] = dict(zip(('minlat', 'minlon', 'maxlat', 'maxlon'), b))
+        for name in self.__meta_order:
+            val = int(self._meta[name][row])
+            if val >= 0:
+                ret[name] = self._strings[val] if name in self.__meta_str else val
+        (start, end) = self._ref_offsets[row:row+2]
+        if objtype == 'way':
+            ret['nodes'] = self._refs[start:end].tolist()
+        elif objtype == 'relation':
+            ret['members'] = [
+                {'type': _type_names[t], 'ref': ref, 'role': self._strings[role]}
+                for (ref, t, role) in zip(
+                    self._refs[start:end].tolist(),
+                    self._ref_types[start:end].tolist(),
+                    self._ref_roles[start:end].tolist()
                 )
-                if ways:
-                    cur_elem = ways[0]
-                    node_ids = []
-                    ids = _get_ids(cur_elem)
+            ]
+        (start, end) = self._tag_offsets[row:row+2]
+        if end > start:
+            ret['tags'] = dict((self._strings[k], self._strings[v]) for (k, v) in self._tag_kv[start:end].tolist())
+        return ret
+
+    def _get_transient(self, row):
+        """returns entry for row without keeping it, unless it is already materialized"""
+        try:
+            return self._materialized[row]
+        except KeyError:
+            soup = self._get_soup(row)
+            return OsmDbEntry(self._valuefunc(soup), soup, self)
+
+    def _get_entry(self, row):
+        try:
+            return self._materialized[row]
+        except KeyError:
+            ret = self._get_transient(row)
+            self._materialized[row] = ret
+            return ret
+
+    def _get_by_key(self, key):
+        try:
+            return self._new[key]
+        except KeyError:
+            row = int(self._rows(key))
+            if row < 0 or row in self._removed:
+                raise KeyError(key)
+            return self._get_entry(row)
+
+    def _get_from_index(self, name, key):
+        return [x if isinstance(x, OsmDbEntry) else self._get_entry(x) for x in self._custom_indexes[name].get(key, {}).values()]
+
+    def _project_all(self):
+        self._xy = _project_positions(self._bounds)
+
+    def _compute_area_flags(self):
+        # -1 - not computed yet
+        self._area_rows = np.full(len(self._keys), -1, dtype=np.int8)
+        nodes = self._keys % 3 == _type_codes['node']
+        self._area_rows[nodes] = shapely.contains_xy(self._area, self._bounds[nodes, 1], self._bounds[nodes, 0])
+
+    def _get_area_flag(self, soup):
+        key = _get_id(soup)
+        if key in self._new:
+            return super(ColumnarOsmDb, self)._get_area_flag(soup)
+        flag = int(self._area_rows[int(self._rows(key))])
+        return None if flag < 0 else bool(flag)
+
+    def _set_area_flag(self, soup, flag):
+        key = _get_id(soup)
+        if key in self._new:
+            super(ColumnarOsmDb, self)._set_area_flag(soup, flag)
+        else:
+            self._area_rows[int(self._rows(key))] = flag
+
+    def get_projected_center(self, soup):
+        key = _get_id(soup)
+        if self._xy is None or key in self._new:
+            return super(ColumnarOsmDb, self).get_projected_center(soup)
+        return tuple(self._xy[int(self._rows(key))].tolist())
+
+    def _build_spatial_index(self, rows):
+        return self._spatial_index(
+            np.concatenate((self._keys[rows], np.fromiter(self._new_positions.keys(), dtype=np.int64))),
+            np.concatenate((self._bounds[rows], np.array(list(self._new_positions.values())).reshape((-1, 4))))
+        )
+
+    def update_index(self):
+        if self._snapshot:
+            # use indexes saved in snapshot, spatial index only if it was saved for the same backend
+            snapshot = self._snapshot
+            self._snapshot = None
+            (self._custom_indexes, self._custom_index_keys) = snapshot.custom_indexes(self._keys, self._rows)
+            if snapshot.meta['spatial_index'] == _class_name(self._spatial_index):
+                self.__index = self._spatial_index.load(os.path.join(snapshot.path, 'spatial'))
             else:
-                # not full circle
-                if ways: # check if there is something to work on
-                    last_id = node_ids[-1]
-                    first_id = node_ids[0]
-                    if _get_way(last_id, way_by_first_node):
-                        cur_elem = _get_way(last_id, way_by_first_node)
-                        ids = _get_ids(cur_elem)
-
-                    elif _get_way(last_id, way_by_last_node):
-                        cur_elem = _get_way(last_id, way_by_last_node)
-                        ids = list(reversed(_get_ids(cur_elem)))
-
-                    elif _get_way(first_id, way_by_first_node):
-                        cur_elem = _get_way(first_id, way_by_first_node)
-                        node_ids = list(reversed(node_ids))
-                        ids = _get_ids(cur_elem)
-
-                    elif _get_way(first_id, way_by_last_node):
-                        cur_elem = _get_way(first_id, way_by_last_node)
-                        node_ids = list(reversed(node_ids))
-                        ids = list(reversed(_get_ids(cur_elem)))
-                    else:
-                        raise ValueError
-                else: # if ways
-                    raise ValueError
-        # end while
+                self.__index = self._build_spatial_index(self._order)
+            return
+
+        self.__log.debug("Recreating index")
+
+        rows = self._order[~np.isin(self._order, list(self._removed))]
+        self.__index = self._build_spatial_index(rows)
+
+        self._clear_custom_indexes()
+        indexed = self._tag_offsets[1:] > self._tag_offsets[:-1]
+        indexed[list(self._materialized.keys())] = True
+        # rows are stored in the index as ints, new elements as entries
+        for row in rows[indexed[rows]].tolist():
+            self._add_to_custom_indexes(int(self._keys[row]), self._get_transient(row), row)
+        for (key, val) in self._new.items():
+            self._add_to_custom_indexes(key, val, val)
+
+    def add_new(self, new):
+        """adds new element to database and all indexes"""
+        ret = OsmDbEntry(self._valuefunc(new), new, self)
+        key = _get_id(new)
+        self._new[key] = ret
+        self._new_positions[key] = self.get_position(new)
+        self.__index.insert(key, self._new_positions[key])
+        self._add_to_custom_indexes(key, ret, ret)
+        return ret
+
+    def _get_position(self, key):
+        if key in self._new:
+            return self._new_positions[key]
+        return self._bounds[int(self._rows(key))].tolist()
+
+    def remove(self, entry):
+        """removes entry from database and all indexes"""
+        key = _get_id(entry._raw)
+        self.__index.delete(key, self._get_position(key))
+        self._remove_from_custom_indexes(key)
+        self._forget_cached(entry._raw)
+        if key in self._new:
+            del self._new[key]
+            del self._new_positions[key]
+        else:
+            row = int(self._rows(key))
+            self._removed.add(row)
+            self._materialized.pop(row, None)
+
+    def update_position(self, entry):
+        """updates spatial index after entry location was changed"""
+        key = _get_id(entry._raw)
+        self._forget_cached(entry._raw)
+        pos = self.get_position(entry._raw)
+        self.__index.delete(key, self._get_position(key))
+        self.__index.insert(key, pos)
+        if key in self._new:
+            self._new_positions[key] = pos
+        else:
+            row = int(self._rows(key))
+            self._bounds[row] = pos
+            if self._xy is not None:
+                self._xy[row] = _project_positions(pos)[0]
+            if self._area is not None:
+                self._area_rows[row] = -1
+
+    def reindex(self, entry):
+        """updates custom indexes after entry values, that custom indexes are based on, were changed"""
+        key = _get_id(entry._raw)
+        self._remove_from_custom_indexes(key)
+        self._add_to_custom_indexes(key, entry, entry if key in self._new else int(self._rows(key)))
+
+    def get(self, objtype, id_):
+        """returns entry for given object type and id, raises KeyError if not found"""
+        return self._get_by_key(id_ * 3 + _type_codes[objtype])
+
+    def __len__(self):
+        return len(self._order) - len(self._removed) + len(self._new)
+
+    def get_all_values(self):
+        """returns all entries. This creates entries for all elements, so avoid it on large datasets"""
+        rows = filter(lambda x: x not in self._removed, self._order.tolist())
+        return itertools.chain(map(self._get_entry, rows), self._new.values())
+
+    def get_versions(self):
+        rows = self._order[~np.isin(self._order, list(self._removed))]
+        rows = rows[(self._tag_offsets[rows + 1] > self._tag_offsets[rows]) | (self._keys[rows] % 3 != _type_codes['node'])]
+        versions = self._meta['version'][rows].tolist() if 'version' in self._meta else [-1] * len(rows)
+
+        def geometry(key, row):
+            objtype = _type_names[key % 3]
+            if objtype == 'node':
+                return None
+            (start, end) = self._ref_offsets[row:row+2]
+            refs = self._refs[start:end].tolist()
+            if objtype == 'relation':
+                refs = list(zip(map(_type_names.__getitem__, self._ref_types[start:end].tolist()), refs))
+            return self._get_geometry_hash(objtype, refs)
+
+        keys = self._keys[rows].tolist()
+        return dict(
+            ((_type_names[key % 3], key // 3), (version if version >= 0 else None, geometry(key, row), tuple(bounds)))
+            for (key, row, version, bounds) in zip(keys, rows.tolist(), versions, self._bounds[rows].tolist())
+        )
+
+    def _get_way_nodes(self, way_id):
+        row = int(self._rows(way_id * 3 + _type_codes['way']))
+        if row < 0 or row in self._removed:
+            return super(ColumnarOsmDb, self)._get_way_nodes(way_id)
+        (start, end) = self._ref_offsets[row:row+2]
+        return self._refs[start:end].tolist()
+
+    def _nearest(self, bounds, num_results):
+        return map(self._get_by_key, self.__index.nearest(bounds, num_results))
+
+    def _intersection(self, bounds):
+        return map(self._get_by_key, self.__index.intersection(bounds))
+
+    def _get_node_coords(self, node_ids):
+        """returns list of (lon, lat) tuples for given node ids"""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        rows = self._rows(node_ids * 3 + _type_codes['node'])
+        ret = list(map(tuple, self._bounds[rows][:, (1, 0)].tolist()))
+        for i in np.flatnonzero(rows < 0).tolist():
+            # not in columns, might be a new node
+            c = self.get('node', int(node_ids[i])).center
+            ret[i] = (c.x, c.y)
         return ret
 
+    def _get_node_xy(self, node_ids):
+        if self._xy is None:
+            return super(ColumnarOsmDb, self)._get_node_xy(node_ids)
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        rows = self._rows(node_ids * 3 + _type_codes['node'])
+        ret = list(map(tuple, self._xy[rows].tolist()))
+        for i in np.flatnonzero(rows < 0).tolist():
+            # not in columns, might be a new node
+            ret[i] = self.get_projected_center(self.get('node', int(node_ids[i]))._raw)
+        return ret
+
+
                 
 def main():
     odb = OsmDb(open("adresy.osm").read())
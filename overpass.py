@@ -1,6 +1,8 @@
 from urllib.request import urlopen
 from urllib.parse import urlencode
 import argparse
+import codecs
+import json
 import logging
 
 __log = logging.getLogger(__name__)
@@ -87,11 +89,127 @@ def getNodesWaysWithTag(tagname, format="xml"):
 __overpassurl = "http://overpass.osm.rambler.ru/cgi/interpreter"
 __overpassurl = "http://overpass-api.de/api/interpreter"
 
-def query(qry):
+def _open(qry):
     # TODO - check if the query succeeded
     __log.debug("Query %s , server: %s", qry, __overpassurl)
     url = __overpassurl + '?' + urlencode({'data': qry.replace('\t', '').replace('\n', '')})
-    return urlopen(url).read().decode('utf-8')
+    return urlopen(url)
+
+def query(qry):
+    return _open(qry).read().decode('utf-8')
+
+def query_json(qry):
+    """runs [out:json] query and returns its result as from load_json(), elements are parsed while downloading"""
+    return load_json(_open(qry))
+
+
+class _JsonReader(object):
+    """reads JSON values one by one from file object, keeping in memory only the part not parsed yet"""
+    __whitespace = ' \t\n\r'
+
+    def __init__(self, fileobj, chunk_size):
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        # json.loads() shares equal keys within one document, do the same across values parsed separately
+        keys = {}
+        self._decoder = json.JSONDecoder(object_pairs_hook=lambda pairs: dict((keys.setdefault(k, k), v) for (k, v) in pairs))
+
+    def _fill(self, size):
+        """reads at least size more characters or until end of file. Returns False at end of file"""
+        if self._eof:
+            return False
+        parts = [self._buf[self._pos:]]
+        read = 0
+        while read < size:
+            data = self._fileobj.read(self._chunk_size)
+            if not data:
+                self._eof = True
+                break
+            if isinstance(data, bytes):
+                data = self._utf8.decode(data)
+            parts.append(data)
+            read += len(data)
+        self._buf = ''.join(parts)
+        self._pos = 0
+        return read > 0
+
+    def peek(self):
+        """returns next non-whitespace character, or empty string at end of file"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in self.__whitespace:
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill(1):
+                return self._buf[self._pos:self._pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %s at: %s" % (chars, self._buf[self._pos:self._pos + 50]))
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        size = self._chunk_size
+        while True:
+            try:
+                (ret, end) = self._decoder.raw_decode(self._buf, self._pos)
+                # any value is followed by , : ] or }, otherwise it might be truncated (ex. a number)
+                following = end
+                while following < len(self._buf) and self._buf[following] in self.__whitespace:
+                    following += 1
+                if self._buf[following:following + 1] in (',', ':', ']', '}') or self._eof:
+                    self._pos = end
+                    return ret
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill(size)
+            # value is larger than expected, read more at once to avoid parsing it too many times
+            size *= 2
+
+
+def load_json(fileobj, chunk_size=1024*1024):
+    """
+    parses Overpass JSON from file object (binary or text). Returns dict, where 'elements' is
+    an iterator yielding elements as they are parsed, so whole response never needs to be kept in memory.
+    Keys preceding elements (like osm3s) are available at once, keys following elements (like remark)
+    are added when the iterator is exhausted
+    """
+    reader = _JsonReader(fileobj, chunk_size)
+    ret = {'elements': iter(())}
+    reader.expect('{')
+    if reader.peek() == '}':
+        return ret
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'elements':
+            break
+        ret[key] = reader.value()
+        if reader.expect(',}') == '}':
+            return ret
+
+    def elements():
+        reader.expect('[')
+        if reader.peek() != ']':
+            while True:
+                yield reader.value()
+                if reader.expect(',]') == ']':
+                    break
+        else:
+            reader.expect(']')
+        while reader.expect(',}') == ',':
+            key = reader.value()
+            reader.expect(':')
+            ret[key] = reader.value()
+
+    ret['elements'] = elements()
+    return ret
 
 def main():
     parser = argparse.ArgumentParser(description='Fetches addresses for given teryt:terc from OSM')
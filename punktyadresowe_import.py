@@ -20,32 +20,35 @@
 import sys
 if sys.version_info.major == 2:
     from urllib import urlencode
-    from urllib2 import urlparse, urlopen
+    from urllib2 import urlparse
     import urllib2 as urequest
     str_normalize = lambda x: x.decode('utf-8')
 else:
     from urllib.parse import urlencode, urlparse
     import urllib.request as urequest
-    from urllib.request import urlopen
     str_normalize = lambda x: x
 
 import argparse
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
 from collections import namedtuple
 from functools import partial
+import html
+import io
 import json
 import logging
 import math
-import pyproj
+import os
 import re
 from shapely.geometry import Point
 
-from osmdb import OsmDb, distance
+from osmdb import OsmDb, distance, project, unproject
+from fetcher import Fetcher, HttpCache
 import overpass
 from mapping import mapstreet, mapcity
 from utils import parallel_execution, groupby
-import lxml.html
 import lxml.etree
+import numpy as np
+import shapely
 
 
 # stałe
@@ -63,16 +66,17 @@ __opener.addheaders = __headers.items()
 # setup
 urequest.install_opener(__opener)
 
-__WGS84 = pyproj.Proj(proj='latlong',datum='WGS84')
-__EPSG2180 = pyproj.Proj(init="epsg:2180")
+# concurrent downloads of tiles and iMPA responses, cache is set up by main()
+_fetcher = Fetcher(headers=__headers)
+_default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'punktyadresowe_import')
 
 def wgsTo2180(lon, lat):
     # returns lon,lat
-    return pyproj.transform(__WGS84, __EPSG2180, lon, lat)
+    return project(lon, lat)
 
 def e2180toWGS(lon, lat):
     # returns lon,lat
-    return pyproj.transform(__EPSG2180, __WGS84, lon, lat)
+    return unproject(lon, lat)
 
 def _filterOnes(lst):
     return list(filter(lambda x: x > 0, lst))
@@ -256,7 +260,8 @@ out bb;
 >;
 out bb;
             """ % (terc,)
-            data = json.loads(overpass.query(query))
+            data = overpass.query_json(query)
+            osmdb = OsmDb(data)
             relation  = tuple(x for x in data['elements'] if x['type'] == 'relation')[0]
             bounds = relation['bounds']
             self.bbox = (
@@ -265,7 +270,6 @@ out bb;
                 bounds['maxlon'],
                 bounds['maxlat'],
             )
-            osmdb = OsmDb(data)
             self.shape = osmdb.get_shape(relation)
 
     def getBbox():
@@ -340,7 +344,7 @@ class iMPA(AbstractImport):
     def _initFromIMPA(self, gmina):
         url = 'http://%s.e-mapa.net/application/system/init.php' % (gmina,)
         self.__log.info(url)
-        data = urlopen(url).read().decode('utf-8')
+        data = _fetcher.fetch(url).decode('utf-8')
         init_data = json.loads(data)
 
         self.setBboxFrom2180(init_data['spatialExtent'])
@@ -357,7 +361,7 @@ class iMPA(AbstractImport):
             self.__log.debug(data)
             url = 'http://%s.punktyadresowe.pl' % (gmina,)
             self.__log.info(url)
-            data = urlopen(url).read().decode('utf-8')
+            data = _fetcher.fetch(url).decode('utf-8')
             def extract(begin, end):
                 start_pos = data.rfind(begin)
                 end_pos = data.find(end, start_pos)
@@ -411,14 +415,19 @@ class iMPA(AbstractImport):
             url = "%s?%s" % (wms_addr, urlencode(params))
             self.__log.warning("JOSM layer: %s?%s&SRS={proj}&WIDTH={width}&HEIGHT={height}&BBOX={bbox}" % (wms_addr, urlencode(josm_wms)))
         self.__log.info(url)
-        data = urlopen(url).read()
+        data = _fetcher.fetch(url)
         return data
 
-    def _convertToAddress(self, soup):
-        kv = dict(zip(
-            map(lambda x: str(x.text), soup.find_all('th')),
-            map(lambda x: str(x.text), soup.find_all('td'))
+    @staticmethod
+    def _tableToDict(table):
+        """returns dict of th and td texts of GetFeatureInfo table, paired in document order"""
+        return dict(zip(
+            (''.join(x.itertext()) for x in table.iter('th')),
+            (''.join(x.itertext()) for x in table.iter('td'))
         ))
+
+    def _convertToAddress(self, soup):
+        kv = self._tableToDict(soup)
         try:
             (lon, lat) = map(lambda x: x[2:], kv[str_normalize('GPS (WGS 84)')].split(', ', 1))
             if '(' in kv[str_normalize('Nazwa ulicy(Id GUS)')]:
@@ -443,31 +452,62 @@ class iMPA(AbstractImport):
                 kv.get(str_normalize('idIIP'), ''),
             )
         except KeyError:
-            self.__log.error(soup)
+            self.__log.error(lxml.etree.tostring(soup, encoding='unicode'))
             self.__log.error(kv)
             self.__log.error("Exception during point analysis", exc_info=True)
             raise
         except ValueError:
-            self.__log.error(soup)
+            self.__log.error(lxml.etree.tostring(soup, encoding='unicode'))
             self.__log.error(kv)
             self.__log.error("Exception during point analysis", exc_info=True)
             raise
 
+    def _parseFeatureInfo(self, data):
+        """converts each table of GetFeatureInfo HTML response to Address, one table at a time without building whole tree"""
+        # the same encoding, that BeautifulSoup would use
+        encoding = UnicodeDammit(data, is_html=True).original_encoding
+        ret = []
+        for (_, elem) in lxml.etree.iterparse(io.BytesIO(data), events=('end',), tag='table', html=True, encoding=encoding):
+            ret.append(self._convertToAddress(elem))
+            # drop converted tables
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return ret
+
     def fetchTiles(self):
-        html = self.fetchPoint(
+        data = self.fetchPoint(
             self.wms,
             *self.getBbox2180(),
             pointx=0, pointy=0 # sprawdź punkt (0,0) i tak powinno zostać zwrócone wszystko
         )
-        ret = list(map(self._convertToAddress, BeautifulSoup(html).find_all('table')))
-        return ret
+        return self._parseFeatureInfo(data)
+
+class _IncompleteTile(Exception):
+    """raised for GUGiK tile, that has to be fetched again in smaller parts"""
+    def __init__(self, reason, addresses=()):
+        super(_IncompleteTile, self).__init__(reason)
+        self.addresses = list(addresses)
+
 
 class GUGiK(AbstractImport):
     # parametry do EPSG 2180
     __MAX_BBOX_X = 20000
     __MAX_BBOX_Y = 45000
     __PRECISION = 10
+    # tiles with that many Placemarks are assumed to be truncated by server and are split
+    __MAX_TILE_FEATURES = 10000
+    # smallest tile size in meters, that is still split
+    __MIN_TILE_SIZE = 500
+    # at most that many tiles are split during one import
+    __MAX_TILE_SPLITS = 256
     __base_url = "http://emuia.gugik.gov.pl/wmsproxy/emuia/wms?SERVICE=WMS&FORMAT=application/vnd.google-earth.kml+xml&VERSION=1.1.1&SERVICE=WMS&REQUEST=GetMap&LAYERS=emuia:layer_adresy_labels&STYLES=&SRS=EPSG:2180&WIDTH=16000&HEIGHT=16000&BBOX="
+    __KML = '{http://www.opengis.net/kml/2.2}'
+    # Placemark description is HTML list of attributes: <li><strong><span>NAME</span>:</strong> <span>VALUE</span></li>
+    __DESC_ITEM = re.compile('<li\\b[^>]*>', re.I)
+    __DESC_ITEM_END = re.compile('</li>|</ul>', re.I)
+    __DESC_NAME = re.compile('<strong\\b[^>]*>.*?<span\\b[^>]*>(.*?)</span>.*?</strong>', re.I | re.S)
+    __DESC_VALUE = re.compile('<span\\b[^>]*>(.*?)</span>', re.I | re.S)
     __log = logging.getLogger(__name__).getChild('GUGiK')
 
     def __init__(self, terc):
@@ -475,9 +515,9 @@ class GUGiK(AbstractImport):
         self.terc = terc
 
     @staticmethod
-    def divideBbox(minx, miny, maxx, maxy):
-        """divides bbox to tiles of maximum supported size by EUiA WMS"""
-        return [
+    def divideBbox(minx, miny, maxx, maxy, shape=None):
+        """divides bbox to tiles of maximum supported size by EUiA WMS, skips tiles outside of shape (EPSG:2180), if given"""
+        ret = [
             (x / GUGiK.__PRECISION,
              y / GUGiK.__PRECISION,
             min(x / GUGiK.__PRECISION + GUGiK.__MAX_BBOX_X, maxx),
@@ -485,18 +525,47 @@ class GUGiK(AbstractImport):
             for x in range(math.floor(minx * GUGiK.__PRECISION), math.ceil(maxx * GUGiK.__PRECISION), GUGiK.__MAX_BBOX_X * GUGiK.__PRECISION)
             for y in range(math.floor(miny * GUGiK.__PRECISION), math.ceil(maxy * GUGiK.__PRECISION), GUGiK.__MAX_BBOX_Y * GUGiK.__PRECISION)
         ]
+        if shape is not None:
+            ret = GUGiK._intersecting(ret, shape)
+        return ret
+
+    @staticmethod
+    def splitTile(minx, miny, maxx, maxy):
+        """divides tile into four quarters"""
+        (midx, midy) = ((minx + maxx) / 2, (miny + maxy) / 2)
+        return [
+            (minx, miny, midx, midy),
+            (midx, miny, maxx, midy),
+            (minx, midy, midx, maxy),
+            (midx, midy, maxx, maxy),
+        ]
+
+    @staticmethod
+    def _intersecting(tiles, shape):
+        """returns tiles, that intersect shape"""
+        if not tiles:
+            return []
+        mask = shapely.intersects(shape, shapely.box(*np.array(tiles).T))
+        return [tile for (tile, keep) in zip(tiles, mask) if keep]
 
 
+    @staticmethod
+    def _parseDescription(desc):
+        """returns dict of attribute names and values from HTML description of Placemark, without parsing HTML"""
+        ret = {}
+        for item in GUGiK.__DESC_ITEM.split(desc)[1:]:
+            item = GUGiK.__DESC_ITEM_END.split(item, 1)[0]
+            name = GUGiK.__DESC_NAME.search(item)
+            if not name:
+                continue
+            value = GUGiK.__DESC_VALUE.search(item[:name.start()] + item[name.end():])
+            ret[html.unescape(name.group(1))] = html.unescape(value.group(1)) if value else ''
+        return ret
+
     def _convertToAddress(self, soup):
-        desc_soup = lxml.html.fromstring(str(soup.find('{http://www.opengis.net/kml/2.2}description').text))
-        addr_kv = dict(
-            (
-             str(x.find('strong').find('span').text),
-             str(x.find('span').text)
-            ) for x in desc_soup.find('ul').iterchildren()
-        )
+        addr_kv = self._parseDescription(soup.findtext(GUGiK.__KML + 'description'))
 
-        coords = soup.find('{http://www.opengis.net/kml/2.2}Point').find('{http://www.opengis.net/kml/2.2}coordinates').text.split(',')
+        coords = soup.find(GUGiK.__KML + 'Point').findtext(GUGiK.__KML + 'coordinates').split(',')
         ret = Address(
                 addr_kv[str_normalize('NUMER_PORZADKOWY')],
                 addr_kv.get(str_normalize('KOD_POCZTOWY')),
@@ -555,22 +624,79 @@ class GUGiK(AbstractImport):
 
 
 
+    def _parseTile(self, body):
+        """
+        parses KML from file-like body one Placemark at a time, so memory use does not depend on tile size.
+        Returns eligible addresses and number of all Placemarks in tile. Raises _IncompleteTile when KML
+        Document is cut short
+        """
+        ret = []
+        count = 0
+        started = False
+        found = False
+        document = GUGiK.__KML + 'Document' # be namespace aware
+        try:
+            for (event, elem) in lxml.etree.iterparse(body, events=('start', 'end'), tag=(document, GUGiK.__KML + 'Placemark')):
+                if elem.tag == document:
+                    started = True
+                    found = event == 'end'
+                    continue
+                if event == 'start':
+                    continue
+                if elem.getparent().tag == document:
+                    count += 1
+                    addr = self._convertToAddress(elem)
+                    if self._isEligible(addr):
+                        ret.append(addr)
+                # drop parsed Placemarks
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        except lxml.etree.XMLSyntaxError as e:
+            if not started:
+                raise
+            raise _IncompleteTile('truncated after %d placemarks: %s' % (count, e), ret)
+        if not found:
+            raise ValueError('No data returned from GUGiK possibly to wrong scale. Check __MAX_BBOX_X, __MAX_BBOX_Y, HEIGHT and WIDTH')
+        return (ret, count)
+
+    def _parseTileChecked(self, body):
+        """
+        returns addresses from tile, raises _IncompleteTile when tile was truncated or has as many placemarks
+        as server returns, so should be split. Response is stored in cache only when addresses are returned
+        """
+        (ret, count) = self._parseTile(body)
+        if count >= GUGiK.__MAX_TILE_FEATURES:
+            raise _IncompleteTile('%d placemarks returned' % (count,), ret)
+        return ret
+
     def fetchTiles(self):
-        bbox = self.getBbox2180()
+        shape = shapely.transform(self.shape, lambda x: np.column_stack(wgsTo2180(x[:, 0], x[:, 1])))
+        # bounds of projected shape, as corners of projected bbox do not cover whole area
+        tiles = self.divideBbox(*shape.bounds, shape=shape)
         ret = []
-        for i in self.divideBbox(*bbox):
-            url = GUGiK.__base_url+",".join(map(str, i))
-            self.__log.info("Fetching from EMUIA: %s", url)
-            soup = lxml.etree.fromstring(urlopen(url).read())
-            doc = soup.find('{http://www.opengis.net/kml/2.2}Document') # be namespace aware
-            if doc is not None:
-                ret.extend(filter(
-                    self._isEligible,
-                    map(self._convertToAddress, doc.iterchildren('{http://www.opengis.net/kml/2.2}Placemark'))
-                    )
-                )
-            else:
-                raise ValueError('No data returned from GUGiK possibly to wrong scale. Check __MAX_BBOX_X, __MAX_BBOX_Y, HEIGHT and WIDTH')
+        splits = 0
+        while tiles:
+            urls = [GUGiK.__base_url+",".join(map(str, i)) for i in tiles]
+            self.__log.info("Fetching %d tiles from EMUIA", len(urls))
+            split = []
+            # tiles are downloaded concurrently and parsed as they arrive
+            for (tile, result) in zip(tiles, _fetcher.map(self._parseTileChecked, urls, errors=(_IncompleteTile,))):
+                if not isinstance(result, _IncompleteTile):
+                    ret.extend(result)
+                elif max(tile[2] - tile[0], tile[3] - tile[1]) < 2 * GUGiK.__MIN_TILE_SIZE:
+                    if not result.addresses:
+                        raise ValueError('Incomplete tile %s, that is too small to split: %s' % (tile, result))
+                    self.__log.warning('Incomplete tile %s, that is too small to split: %s', tile, result)
+                    ret.extend(result.addresses)
+                else:
+                    # dense tiles are fetched again in quarters, that are inside the area
+                    splits += 1
+                    if splits > GUGiK.__MAX_TILE_SPLITS:
+                        raise ValueError('More than %d tiles had to be split, last one %s: %s' % (GUGiK.__MAX_TILE_SPLITS, tile, result))
+                    self.__log.info('Splitting tile %s: %s', tile, result)
+                    split.extend(self._intersecting(self.splitTile(*tile), shape))
+            tiles = split
         # take latest version for each point (version is last element after dot in id_)
         ret = [max(v, key=lambda z: z.id_) for  v in groupby(ret, lambda z: z.id_.rsplit('.', 1)[0]).values()]
         return ret
@@ -589,10 +715,18 @@ def main():
     parser.add_argument('--no-mapping', help='Disable mapping of streets and cities', dest='no_mapping', default=False, action='store_const', const=True)
     parser.add_argument('--wms', help='Override WMS address with address points', dest='wms', default=None)
     parser.add_argument('--terc', help='teryt:terc code which defines area of operation', dest='terc', default=None)
+    parser.add_argument('--connections', help='maximum number of concurrent connections to one server, default: 4', dest='connections', default=4, type=int)
+    parser.add_argument('--cache-dir', help='directory for cache of downloaded responses, default: %s' % (_default_cache_dir,), dest='cache_dir', default=_default_cache_dir)
+    parser.add_argument('--no-cache', help='Disable cache of downloaded responses', dest='no_cache', default=False, action='store_const', const=True)
+    parser.add_argument('--cache-ttl', help='hours, for which cached responses are used without asking server if they changed, default: 24', dest='cache_ttl', default=24, type=float)
+    parser.add_argument('--cache-size', help='maximum size of cache in MB, least recently used responses are removed, default: 1024', dest='cache_size', default=1024, type=int)
     parser.add_argument('gmina', nargs='*',  help='list of iMPA services to download, it will use at most 4 concurrent threads to download and analyse')
     args = parser.parse_args()
 
     logging.basicConfig(level=args.log_level)
+    _fetcher.max_per_host = args.connections
+    if not args.no_cache:
+        _fetcher.cache = HttpCache(args.cache_dir, ttl=args.cache_ttl * 3600, max_size=args.cache_size * 1024 * 1024)
 
     if args.no_mapping:
         global mapstreet, mapcity
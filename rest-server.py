@@ -1,15 +1,22 @@
-from flask import Flask, make_response as _make_response
-from merger import Merger, getAddresses
+from flask import Flask
+from merger import Merger, getAddresses, get_fresh_snapshot
 from punktyadresowe_import import iMPA
+import datetime
+import hashlib
 import utils
 import logging
+import os
+import threading
 
 app = Flask(__name__)
+# set SNAPSHOT_DIR to keep snapshots of OSM data for each iMPA service, and reuse them for SNAPSHOT_MAX_AGE
+app.config.setdefault('SNAPSHOT_DIR', None)
+app.config.setdefault('SNAPSHOT_MAX_AGE', datetime.timedelta(hours=1))
+__snapshot_lock = threading.Lock()
 
 def make_response(ret, code):
-    resp = _make_response(ret, code)
-    resp.mimetype ='text/xml; charset=utf-8'
-    return resp
+    # ret may be an iterator over chunks, they are then sent as they are generated
+    return app.response_class(ret, status=code, mimetype='text/xml; charset=utf-8')
 
 def get_IMPA_Merger(name):
     imp = iMPA(name)
@@ -19,10 +26,21 @@ def get_IMPA_Merger(name):
     w = min(map(lambda x: x.center.x, data))
     n = max(map(lambda x: x.center.y, data))
     e = max(map(lambda x: x.center.x, data))
-    addr =  getAddresses(map(str,(s, w, n, e)))
+    snapshot = None
+    if app.config['SNAPSHOT_DIR']:
+        # name comes from URL, so it is never used as path directly
+        key = hashlib.sha1(('%s/%s' % (terc, name)).encode('utf-8')).hexdigest()
+        path = os.path.join(app.config['SNAPSHOT_DIR'], key)
+        snapshot = get_fresh_snapshot(path, app.config['SNAPSHOT_MAX_AGE'], (s, w, n, e))
+    if snapshot:
+        addr = snapshot
+    else:
+        addr =  getAddresses(map(str,(s, w, n, e)))
 
-    
-    m = Merger(data, addr, terc)
+    m = Merger(data, addr, terc, columnar=bool(app.config['SNAPSHOT_DIR']))
+    if app.config['SNAPSHOT_DIR'] and not snapshot:
+        with __snapshot_lock:
+            m.osmdb.save_snapshot(path, (s, w, n, e))
     m.post_func.append(m.merge_addresses)
     m.merge()
     return m
@@ -30,14 +48,13 @@ def get_IMPA_Merger(name):
 @app.route("/osm/adresy/iMPA/<name>.osm", methods=["GET", ])
 def differentialImport(name):
     m = get_IMPA_Merger(name)
-    ret = m.get_incremental_result()
-    
+    ret = m.iter_incremental_result()
     return make_response(ret, 200)
 
 @app.route("/osm/adresy/iMPA_full/<name>.osm", methods=["GET", ])
 def fullImport(name):
     m = get_IMPA_Merger(name)
-    ret = m.get_full_result()
+    ret = m.iter_full_result()
     return make_response(ret, 200)
 
 if __name__ == '__main__':
@@ -0,0 +1,347 @@
+"""
+Spatial index backends for OsmDb.
+
+All backends keep integer ids with bounding boxes (minx, miny, maxx, maxy) and return ids ordered
+by distance between query box and indexed box, same as rtree does. When there are ties on the last
+place, more than num_results ids are returned.
+"""
+from rtree import index
+import logging
+import math
+import numpy as np
+import os
+import shapely
+from shapely.strtree import STRtree
+
+
+def _box_distances(bounds, query):
+    """returns array of distances between each box in bounds array and query box"""
+    dx = np.maximum(np.maximum(bounds[:, 0] - query[2], query[0] - bounds[:, 2]), 0)
+    dy = np.maximum(np.maximum(bounds[:, 1] - query[3], query[1] - bounds[:, 3]), 0)
+    return np.hypot(dx, dy)
+
+
+def _as_arrays(ids, bounds):
+    return (
+        np.asarray(ids, dtype=np.int64).reshape(-1),
+        np.asarray(bounds, dtype=np.float64).reshape((-1, 4))
+    )
+
+
+class SpatialIndex(object):
+    """
+    Base class for spatial index backends. Subclasses are created with all ids and their bounds
+    at once, so they can use bulk loading. Backends with persistent set to True can be saved to
+    disk with save() and opened with load()
+    """
+    persistent = False
+
+    def __init__(self, ids=(), bounds=()):
+        raise NotImplementedError
+
+    def insert(self, id_, bounds):
+        raise NotImplementedError
+
+    def delete(self, id_, bounds):
+        raise NotImplementedError
+
+    def nearest(self, bounds, num_results=1):
+        raise NotImplementedError
+
+    def intersection(self, bounds):
+        """returns ids of boxes intersecting bounds"""
+        raise NotImplementedError
+
+    @classmethod
+    def save(cls, basename, ids, bounds):
+        """builds index of ids and bounds in files starting with basename"""
+        raise NotImplementedError
+
+    @classmethod
+    def load(cls, basename):
+        """opens index saved with save(). Changes to opened index are not written back to the files"""
+        raise NotImplementedError
+
+
+class _PageStorage(index.CustomStorage):
+    """
+    libspatialindex storage of R-tree pages. Pages saved by RtreeIndex.save() are read from memory mapped arrays:
+    pages - (n, 3) array of page id, start and end in data, sorted by page id, data - array of bytes.
+    Stored pages are kept in memory, so the saved files are never written
+    """
+    def __init__(self, pages=None, data=None):
+        self._pages = pages
+        self._data = data
+        self._changed = {}
+        self._deleted = set()
+        self._next = int(pages[-1, 0]) + 1 if pages is not None and len(pages) else 0
+        # header is written last, when the index is closed
+        self.last_stored = None
+
+    @property
+    def hasData(self):
+        return self._pages is not None or bool(self._changed)
+
+    def create(self, returnError):
+        pass
+
+    def destroy(self, returnError):
+        pass
+
+    def flush(self, returnError):
+        pass
+
+    def clear(self):
+        (self._pages, self._data) = (None, None)
+        self._changed.clear()
+        self._deleted.clear()
+
+    def loadByteArray(self, page, returnError):
+        try:
+            return self._changed[page]
+        except KeyError:
+            pass
+        if self._pages is not None and page not in self._deleted:
+            i = int(np.searchsorted(self._pages[:, 0], page))
+            if i < len(self._pages) and self._pages[i, 0] == page:
+                (start, end) = self._pages[i, 1:].tolist()
+                return self._data[start:end].tobytes()
+        returnError.contents.value = self.InvalidPageError
+
+    def storeByteArray(self, page, data, returnError):
+        if page == self.NewPage:
+            page = self._next
+            self._next += 1
+        self._changed[page] = data
+        self.last_stored = page
+        return page
+
+    def deleteByteArray(self, page, returnError):
+        self._changed.pop(page, None)
+        self._deleted.add(page)
+
+    def items(self):
+        """returns (page id, bytes) for all pages stored, in order of page ids"""
+        return sorted(self._changed.items())
+
+
+class RtreeIndex(SpatialIndex):
+    """libspatialindex R-tree, built using STR bulk loading"""
+    persistent = True
+    # page table (header id in the first row, then page id, start, end) and page data
+    __extensions = ('.pages.npy', '.data.npy')
+
+    def __init__(self, ids=(), bounds=()):
+        (ids, bounds) = _as_arrays(ids, bounds)
+        if len(ids):
+            self._index = index.Index((int(i), b.tolist(), None) for (i, b) in zip(ids, bounds))
+        else:
+            # rtree does not accept empty stream
+            self._index = index.Index()
+
+    def insert(self, id_, bounds):
+        self._index.insert(id_, bounds)
+
+    def delete(self, id_, bounds):
+        self._index.delete(id_, bounds)
+
+    def nearest(self, bounds, num_results=1):
+        return self._index.nearest(bounds, num_results)
+
+    def intersection(self, bounds):
+        return self._index.intersection(bounds)
+
+    @classmethod
+    def save(cls, basename, ids, bounds):
+        (ids, bounds) = _as_arrays(ids, bounds)
+        storage = _PageStorage()
+        if len(ids):
+            idx = index.Index(storage, ((int(i), b.tolist(), None) for (i, b) in zip(ids, bounds)))
+        else:
+            idx = index.Index(storage)
+        idx.close()
+        pages = storage.items()
+        lengths = np.array([len(x) for (_, x) in pages], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        table = np.column_stack((np.array([x for (x, _) in pages], dtype=np.int64), ends - lengths, ends))
+        np.save(basename + cls.__extensions[0], np.vstack(([[-1, storage.last_stored, 0]], table)))
+        np.save(basename + cls.__extensions[1], np.frombuffer(b''.join(x for (_, x) in pages), dtype=np.uint8))
+
+    @classmethod
+    def load(cls, basename):
+        """opens index in place: pages are memory mapped and read on demand, so this takes constant time"""
+        ret = cls.__new__(cls)
+        table = np.load(basename + cls.__extensions[0], mmap_mode='r')
+        storage = _PageStorage(table[1:], np.load(basename + cls.__extensions[1], mmap_mode='r'))
+        ret._index = index.Index(storage, properties=index.Property(index_id=int(table[0, 1]), overwrite=False))
+        return ret
+
+
+class _ExpandingSearchIndex(SpatialIndex):
+    """
+    Base for backends without k-nearest search. Query box is expanded until it has at least
+    num_results boxes within its distance.
+    """
+    def _query(self, bounds):
+        """returns (ids, bounds) arrays of all boxes that may intersect bounds"""
+        raise NotImplementedError
+
+    def _init_extent(self, bounds):
+        if len(bounds):
+            self._extent = (bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max())
+            area = max((self._extent[2] - self._extent[0]) * (self._extent[3] - self._extent[1]), 1e-12)
+            # average distance between neighbouring objects
+            self._spacing = math.sqrt(area / len(bounds))
+        else:
+            self._extent = None
+            self._spacing = 1e-4
+
+    def _expand_extent(self, bounds):
+        if self._extent:
+            self._extent = (
+                min(self._extent[0], bounds[0]), min(self._extent[1], bounds[1]),
+                max(self._extent[2], bounds[2]), max(self._extent[3], bounds[3])
+            )
+        else:
+            self._extent = tuple(bounds)
+
+    def nearest(self, bounds, num_results=1):
+        bounds = tuple(bounds)
+        if len(bounds) == 2:
+            bounds = bounds * 2
+        if not self._extent:
+            return []
+        radius = self._spacing * math.sqrt(num_results)
+        while True:
+            query = (bounds[0] - radius, bounds[1] - radius, bounds[2] + radius, bounds[3] + radius)
+            (ids, boxes) = self._query(query)
+            dists = _box_distances(boxes, bounds)
+            order = np.lexsort((ids, dists))
+            covers_all = query[0] <= self._extent[0] and query[1] <= self._extent[1] and \
+                query[2] >= self._extent[2] and query[3] >= self._extent[3]
+            if (dists <= radius).sum() >= num_results or covers_all:
+                if len(order) > num_results:
+                    # keep ties on last place
+                    order = order[dists[order] <= dists[order[num_results - 1]]]
+                return ids[order].tolist()
+            radius *= 2
+
+    def intersection(self, bounds):
+        bounds = tuple(bounds)
+        (ids, boxes) = self._query(bounds)
+        return ids[_box_distances(boxes, bounds) == 0].tolist()
+
+
+class STRtreeIndex(_ExpandingSearchIndex):
+    """
+    shapely STRtree. The tree is immutable, so changes are kept aside and the tree is rebuilt
+    when they grow above a fraction of the tree size.
+    """
+    __log = logging.getLogger(__name__).getChild('STRtreeIndex')
+    __rebuild_ratio = 0.1
+
+    def __init__(self, ids=(), bounds=()):
+        self._build(*_as_arrays(ids, bounds))
+
+    def _build(self, ids, bounds):
+        self._ids = ids
+        self._bounds = bounds
+        self._tree = STRtree(shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]))
+        self._inserted = {}
+        self._deleted = set()
+        self._init_extent(bounds)
+
+    def _rebuild_if_needed(self):
+        if len(self._inserted) + len(self._deleted) > max(1000, len(self._ids) * self.__rebuild_ratio):
+            self.__log.debug("Rebuilding STRtree")
+            keep = ~np.isin(self._ids, list(self._deleted))
+            new_ids = np.fromiter(self._inserted.keys(), dtype=np.int64, count=len(self._inserted))
+            new_bounds = np.array(list(self._inserted.values()), dtype=np.float64).reshape((-1, 4))
+            self._build(np.concatenate((self._ids[keep], new_ids)), np.concatenate((self._bounds[keep], new_bounds)))
+
+    def insert(self, id_, bounds):
+        self._deleted.discard(id_)
+        self._inserted[id_] = tuple(bounds)
+        self._expand_extent(bounds)
+        self._rebuild_if_needed()
+
+    def delete(self, id_, bounds):
+        if self._inserted.pop(id_, None) is None:
+            self._deleted.add(id_)
+            self._rebuild_if_needed()
+
+    def _query(self, bounds):
+        found = self._tree.query(shapely.box(*bounds))
+        ids = self._ids[found]
+        boxes = self._bounds[found]
+        if self._deleted:
+            keep = ~np.isin(ids, list(self._deleted))
+            (ids, boxes) = (ids[keep], boxes[keep])
+        if self._inserted:
+            (new_ids, new_boxes) = _as_arrays(list(self._inserted.keys()), list(self._inserted.values()))
+            (ids, boxes) = (np.concatenate((ids, new_ids)), np.concatenate((boxes, new_boxes)))
+        return (ids, boxes)
+
+
+class GridIndex(_ExpandingSearchIndex):
+    """
+    Uniform grid hash. Cell size is chosen from data density, so each cell holds about
+    items_per_cell boxes on average.
+    """
+    items_per_cell = 8
+
+    def __init__(self, ids=(), bounds=()):
+        (ids, bounds) = _as_arrays(ids, bounds)
+        self._init_extent(bounds)
+        self._cell = self._spacing * math.sqrt(self.items_per_cell)
+        self._cells = {}
+        self._boxes = {}
+        for (id_, b) in zip(ids.tolist(), bounds.tolist()):
+            self.insert(id_, b)
+
+    def _cell_range(self, bounds):
+        return (
+            range(math.floor(bounds[0] / self._cell), math.floor(bounds[2] / self._cell) + 1),
+            range(math.floor(bounds[1] / self._cell), math.floor(bounds[3] / self._cell) + 1),
+        )
+
+    def insert(self, id_, bounds):
+        bounds = tuple(bounds)
+        self._boxes[id_] = bounds
+        self._expand_extent(bounds)
+        (xs, ys) = self._cell_range(bounds)
+        for x in xs:
+            for y in ys:
+                try:
+                    self._cells[(x, y)].add(id_)
+                except KeyError:
+                    self._cells[(x, y)] = set((id_,))
+
+    def delete(self, id_, bounds):
+        bounds = self._boxes.pop(id_)
+        (xs, ys) = self._cell_range(bounds)
+        for x in xs:
+            for y in ys:
+                cell = self._cells[(x, y)]
+                cell.discard(id_)
+                if not cell:
+                    del self._cells[(x, y)]
+
+    def _query(self, bounds):
+        (xs, ys) = self._cell_range(bounds)
+        if len(xs) * len(ys) > len(self._cells):
+            # query is larger than populated area, check all cells
+            cells = self._cells.values()
+        else:
+            cells = filter(None, (self._cells.get((x, y)) for x in xs for y in ys))
+        ids = set()
+        for cell in cells:
+            ids.update(cell)
+        return _as_arrays(list(ids), [self._boxes[x] for x in ids])
+
+
+backends = {
+    'rtree': RtreeIndex,
+    'strtree': STRtreeIndex,
+    'grid': GridIndex,
+}
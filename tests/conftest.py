@@ -0,0 +1,44 @@
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+
+# modules are kept in top directory of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        (status, headers, body) = self.server.respond(self.path)
+        self.send_response(status)
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def http_server():
+    """
+    local HTTP server, set server.respond to function returning (status, headers, body) for path.
+    Requested paths are collected in server.requests
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.respond = lambda path: (404, {}, b'')
+    server.url = 'http://127.0.0.1:%d' % (server.server_port,)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from fetcher import Fetcher, HttpCache
+
+
+def _files(directory):
+    return sorted(os.listdir(directory))
+
+
+def test_valid_response_is_cached(http_server, tmp_path):
+    http_server.respond = lambda path: (200, {'ETag': '"1"'}, b'data')
+    fetcher = Fetcher(cache=HttpCache(str(tmp_path)))
+    assert fetcher.fetch(http_server.url + '/a?x=1&y=2') == b'data'
+    assert fetcher.fetch(http_server.url + '/a?y=2&x=1') == b'data'
+    assert len(http_server.requests) == 1
+
+
+def test_invalid_response_is_not_cached(http_server, tmp_path):
+    def validate(body):
+        body.read(2)
+        raise ValueError('malformed response')
+
+    http_server.respond = lambda path: (200, {}, b'<kml><Document>')
+    cache = HttpCache(str(tmp_path))
+    fetcher = Fetcher(cache=cache)
+    with pytest.raises(ValueError):
+        fetcher.fetch(http_server.url + '/tile', validate)
+    assert cache.get(http_server.url + '/tile') is None
+    assert _files(str(tmp_path)) == []
+    # next fetch goes to the server again
+    assert fetcher.fetch(http_server.url + '/tile') == b'<kml><Document>'
+    assert len(http_server.requests) == 2
+
+
+def test_map_returns_listed_errors(http_server):
+    def parse(body):
+        data = body.read()
+        if data == b'bad':
+            raise ValueError(data)
+        return data
+
+    http_server.respond = lambda path: (200, {}, path[1:].encode('utf-8'))
+    ret = Fetcher().map(parse, [http_server.url + '/good', http_server.url + '/bad'], errors=(ValueError,))
+    assert ret[0] == b'good'
+    assert isinstance(ret[1], ValueError)
@@ -0,0 +1,244 @@
+import copy
+import datetime
+import importlib.util
+import io
+import logging
+import os
+
+import lxml.etree
+from lxml.builder import E
+import pytest
+import shapely.geometry
+
+import merger
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_script(name):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(_root, name + '.py'))
+    ret = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ret)
+    return ret
+
+
+@pytest.fixture(scope='module')
+def synthetic():
+    """synthetic gmina with many duplicate and mismatched addresses, merged offline"""
+    benchmark = _load_script('benchmark-merge')
+    benchmark.work_offline({})
+    (osm, boundary, addresses) = benchmark.generate(2000, seed=1, duplicate_ratio=0.3, mismatch_ratio=0.3, offset_ratio=0.3)
+    benchmark.work_offline({benchmark._terc: boundary})
+    return (osm, addresses, benchmark._terc, merger.get_boundary_shape(benchmark._terc))
+
+
+def _canonical(xml):
+    """returns elements of OSM XML in sorted order, new nodes are identified by position, as their ids depend on order"""
+    ret = []
+    for elem in lxml.etree.fromstring(xml):
+        if elem.tag == 'note':
+            continue
+        attrs = dict(elem.attrib)
+        if int(attrs.get('id', 0)) < 0:
+            attrs['id'] = 'new@%s,%s' % (attrs['lat'], attrs['lon'])
+        tags = sorted(tuple(sorted(x.attrib.items())) for x in elem if x.tag == 'tag')
+        members = [tuple(sorted(x.attrib.items())) for x in elem if x.tag != 'tag']
+        ret.append((elem.tag, sorted(attrs.items()), tags, members))
+    return sorted(ret)
+
+
+def _merge(synthetic, **kwargs):
+    (osm, addresses, terc, shape) = synthetic
+    m = merger.Merger(copy.deepcopy(addresses), copy.deepcopy(osm), terc, import_area_shape=shape, **kwargs)
+    m.post_func.append(m.merge_addresses)
+    m.merge()
+    return _canonical(m.get_incremental_result())
+
+
+def _incremental_merge(synthetic, osm, path, caplog, **kwargs):
+    """returns number of addresses merged again by incremental merge and its result"""
+    (_, addresses, terc, shape) = synthetic
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger='merger'):
+        m = merger.Merger(copy.deepcopy(addresses), copy.deepcopy(osm), terc, import_area_shape=shape,
+                          incremental_state=path, **kwargs)
+        m.post_func.append(m.merge_addresses)
+        m.merge()
+    (merged,) = [x.args[0] for x in caplog.records if x.getMessage().startswith('Merged ')]
+    return (merged, _canonical(m.get_incremental_result()))
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_tiled_merge_equals_sequential(synthetic, columnar):
+    sequential = _merge(synthetic, columnar=columnar)
+    tiled = _merge(synthetic, columnar=columnar, processes=3)
+    assert len(tiled) == len(sequential)
+    assert tiled == sequential
+
+
+def test_snapshot_is_reused_only_for_covered_area(synthetic, tmp_path):
+    (osm, addresses, terc, shape) = synthetic
+    osm = copy.deepcopy(osm)
+    osm['osm3s'] = {'timestamp_osm_base': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+    path = str(tmp_path / 'snapshot')
+    merger.Merger(copy.deepcopy(addresses), osm, terc, columnar=True).osmdb.save_snapshot(path, (50, 19, 51, 20))
+    max_age = datetime.timedelta(hours=1)
+
+    assert merger.get_fresh_snapshot(path, max_age, (50.2, 19.2, 50.8, 19.8)) is not None
+    assert merger.get_fresh_snapshot(path, max_age, (50.2, 19.2, 51.2, 19.8)) is None
+    assert merger.get_fresh_snapshot(path, datetime.timedelta(0), (50.2, 19.2, 50.8, 19.8)) is None
+
+
+def test_snapshot_does_not_replace_other_directory(synthetic, tmp_path):
+    (osm, addresses, terc, shape) = synthetic
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'data' / 'file').write_text('keep')
+    m = merger.Merger(copy.deepcopy(addresses), copy.deepcopy(osm), terc, columnar=True)
+    with pytest.raises(ValueError):
+        m.osmdb.save_snapshot(str(tmp_path / 'data'), (50, 19, 51, 20))
+    assert (tmp_path / 'data' / 'file').read_text() == 'keep'
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_incremental_merge_detects_changes(synthetic, tmp_path, caplog, columnar):
+    (osm, addresses, terc, shape) = synthetic
+    path = str(tmp_path / 'state.json')
+    (merged, result) = _incremental_merge(synthetic, osm, path, caplog, columnar=columnar)
+    assert merged == len(addresses)
+    assert result == _merge(synthetic, columnar=columnar)
+
+    # unchanged input, all decisions are reused
+    (merged, result) = _incremental_merge(synthetic, osm, path, caplog, columnar=columnar)
+    assert merged == 0
+    assert result == _merge(synthetic, columnar=columnar)
+
+    # changed tag of an address node, with new version as in OSM
+    osm = copy.deepcopy(osm)
+    node = next(x for x in osm['elements'] if x['type'] == 'node' and x.get('tags', {}).get('addr:housenumber'))
+    node['tags']['addr:housenumber'] += 'A'
+    node['version'] += 1
+    (merged, result) = _incremental_merge(synthetic, osm, path, caplog, columnar=columnar)
+    assert 0 < merged < len(addresses)
+    assert result == _merge((osm,) + synthetic[1:], columnar=columnar)
+
+    # untagged node of a building moved inside its bounding box, version and bounds of the way stay the same
+    osm = copy.deepcopy(osm)
+    nodes = dict((x['id'], x) for x in osm['elements'] if x['type'] == 'node')
+    way = next(x for x in osm['elements'] if x['type'] == 'way' and x['tags'].get('building'))
+    b = way['bounds']
+    node = nodes[way['nodes'][0]]
+    (node['lat'], node['lon']) = ((b['minlat'] + b['maxlat']) / 2, (b['minlon'] + b['maxlon']) / 2)
+    node['version'] += 1
+    (merged, result) = _incremental_merge(synthetic, osm, path, caplog, columnar=columnar)
+    assert 0 < merged < len(addresses)
+    assert result == _merge((osm,) + synthetic[1:], columnar=columnar)
+
+
+@pytest.fixture
+def offline_mapping(monkeypatch):
+    import punktyadresowe_import
+    monkeypatch.setattr(punktyadresowe_import, 'mapstreet', lambda name, sym_ul: name)
+    monkeypatch.setattr(punktyadresowe_import, 'mapcity', lambda name, simc: name)
+
+
+def _small_merger(elements):
+    shape = shapely.geometry.box(19.0, 50.0, 19.1, 50.1)
+    for elem in elements:
+        if elem['type'] != 'node':
+            elem['bounds'] = {'minlat': 50.01, 'minlon': 19.01, 'maxlat': 50.03, 'maxlon': 19.03}
+    asis = {'elements': elements, 'osm3s': {'timestamp_osm_base': '2020-01-01T00:00:00Z'}}
+    return merger.Merger([], asis, '0000000', import_area_shape=shape)
+
+
+def test_change_set_keeps_first_entry_once(offline_mapping):
+    elements = [
+        {'type': 'node', 'id': 1, 'lat': 50.01, 'lon': 19.01},
+        {'type': 'node', 'id': 2, 'lat': 50.02, 'lon': 19.02},
+        {'type': 'node', 'id': 3, 'lat': 50.03, 'lon': 19.03},
+        {'type': 'way', 'id': 1, 'nodes': [1, 2]},
+    ]
+    m = _small_merger(copy.deepcopy(elements))
+    # entries of other OsmDb, with the same keys
+    other = _small_merger(elements).osmdb
+    (node1, node2, way) = (m.osmdb.get('node', 1), m.osmdb.get('node', 2), m.osmdb.get('way', 1))
+    changes = merger.ChangeSet([node2, way, node2])
+    changes.add(node1)
+    changes.add(other.get('node', 2))
+    assert len(changes) == 3
+    assert [id(x) for x in changes] == [id(node2), id(way), id(node1)]
+    assert other.get('node', 1) in changes
+    assert other.get('way', 1) in changes
+    assert other.get('node', 3) not in changes
+
+
+def test_referred_entries_are_collected_once(offline_mapping):
+    m = _small_merger([
+        {'type': 'node', 'id': 1, 'lat': 50.01, 'lon': 19.01},
+        {'type': 'node', 'id': 2, 'lat': 50.02, 'lon': 19.01},
+        {'type': 'node', 'id': 3, 'lat': 50.02, 'lon': 19.02},
+        {'type': 'node', 'id': 4, 'lat': 50.03, 'lon': 19.03},
+        {'type': 'way', 'id': 10, 'nodes': [1, 2, 3, 1]},
+        {'type': 'way', 'id': 11, 'nodes': [3, 4]},
+        {'type': 'relation', 'id': 20, 'members': [
+            {'type': 'way', 'ref': 10, 'role': 'outer'},
+            {'type': 'way', 'ref': 11, 'role': ''},
+            {'type': 'relation', 'ref': 21, 'role': ''},
+        ]},
+        {'type': 'relation', 'id': 21, 'members': [
+            {'type': 'relation', 'ref': 20, 'role': ''},
+            {'type': 'node', 'ref': 4, 'role': ''},
+        ]},
+    ])
+    ret = m._get_all_reffered_by([m.osmdb.get('relation', 20), m.osmdb.get('way', 10), m.osmdb.get('node', 4)])
+    keys = [(x.objtype, x['id']) for x in ret]
+    assert sorted(keys) == sorted(set(keys))
+    assert set(keys) == {('node', 1), ('node', 2), ('node', 3), ('node', 4), ('way', 10), ('way', 11),
+                         ('relation', 20), ('relation', 21)}
+    # referred entries come first, except for relations referring to each other
+    assert keys.index(('way', 10)) > max(keys.index(('node', x)) for x in (1, 2, 3))
+    assert keys.index(('way', 11)) > max(keys.index(('node', x)) for x in (3, 4))
+    assert keys.index(('relation', 20)) > max(keys.index(('way', x)) for x in (10, 11))
+    assert keys.index(('relation', 21)) > keys.index(('node', 4))
+
+
+def test_referred_entries_missing_member(offline_mapping):
+    m = _small_merger([
+        {'type': 'node', 'id': 1, 'lat': 50.01, 'lon': 19.01},
+        {'type': 'relation', 'id': 20, 'members': [{'type': 'node', 'ref': 2, 'role': ''}]},
+    ])
+    with pytest.raises(ValueError):
+        m._get_all_reffered_by([m.osmdb.get('relation', 20)])
+
+
+def test_streamed_xml_equals_pretty_printed(offline_mapping):
+    m = _small_merger([
+        {'type': 'node', 'id': 1, 'lat': 50.01, 'lon': 19.01, 'version': 2,
+         'tags': {'addr:housenumber': '1a', 'addr:street': 'Ulica "Zażółć" & <gęślą>'}},
+        {'type': 'node', 'id': 2, 'lat': 50.02, 'lon': 19.01},
+        {'type': 'way', 'id': 10, 'nodes': [1, 2], 'tags': {'building': 'yes'}},
+        {'type': 'relation', 'id': 20, 'members': [{'type': 'way', 'ref': 10, 'role': 'outer'}],
+         'tags': {'type': 'multipolygon'}},
+    ])
+    nodes = [m.osmdb.get(*x) for x in (('node', 1), ('node', 2), ('way', 10), ('relation', 20))]
+    log = io.StringIO('merge log\nwith two lines')
+    # document as built before result was streamed
+    expected = lxml.etree.tostring(
+        E.osm(
+            E.note('The data included in this document is from www.openstreetmap.org. The data is made available under ODbL.\n' + log.getvalue()),
+            E.meta(osm_base=m.asis['osm3s']['timestamp_osm_base']),
+            *tuple(map(merger.OsmAddress.to_osm_soup, nodes)),
+            version='0.6', generator='import adresy merger.py'
+        ),
+        pretty_print=True, xml_declaration=True, encoding='UTF-8'
+    )
+    chunks = list(m._iter_osm_xml(nodes, log))
+    assert len(chunks) > len(nodes)
+    assert b''.join(chunks) == expected
+    assert b''.join(m._iter_osm_xml([])) == lxml.etree.tostring(
+        E.osm(
+            E.note('The data included in this document is from www.openstreetmap.org. The data is made available under ODbL.'),
+            E.meta(osm_base=m.asis['osm3s']['timestamp_osm_base']),
+            version='0.6', generator='import adresy merger.py'
+        ),
+        pretty_print=True, xml_declaration=True, encoding='UTF-8'
+    )
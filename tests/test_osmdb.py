@@ -0,0 +1,298 @@
+import copy
+import hashlib
+import io
+import json
+import os
+import random
+
+import numpy as np
+import pytest
+import shapely
+import shapely.ops
+from shapely.geometry import Point, Polygon
+
+import osmdb
+import overpass
+import spatialindex
+import utils
+
+
+def _node(i):
+    return {'type': 'node', 'id': i, 'lat': 50 + (i % 20) * 1e-4, 'lon': 19 + (i // 20) * 1e-4, 'tags': {}}
+
+
+def test_remove_keeps_elements_in_sync():
+    osmdata = {'elements': [_node(i) for i in range(200)]}
+    db = osmdb.OsmDb(osmdata)
+    expected = set(range(200))
+    rnd = random.Random(1)
+    for i in range(200, 300):
+        db.add_new(_node(i))
+        expected.add(i)
+        for key in rnd.sample(sorted(expected), 2):
+            db.remove(db.get('node', key))
+            expected.remove(key)
+    assert sorted(x['id'] for x in osmdata['elements']) == sorted(expected)
+    assert len(db) == len(expected)
+
+
+def test_batched_distances_match_pairwise():
+    rnd = random.Random(1)
+    a = [(52 + rnd.uniform(0, 0.005), 21 + rnd.uniform(0, 0.005)) for _ in range(5)]
+    b = [(52 + rnd.uniform(0, 0.005), 21 + rnd.uniform(0, 0.005)) for _ in range(7)]
+    expected = np.array([[osmdb.distance(x, y) for y in b] for x in a])
+    np.testing.assert_allclose(osmdb.distance_matrix(a, b), expected, rtol=1e-9)
+    np.testing.assert_allclose(osmdb.distances(a[0], b), expected[0], rtol=1e-9)
+    # approximation is used for thresholds below one kilometer
+    np.testing.assert_allclose(osmdb.distance_matrix(a, b, approx=True), expected, rtol=5e-3)
+
+
+@pytest.mark.parametrize('projected', [False, True])
+def test_entry_contains_uses_projected_shape(projected, monkeypatch):
+    nodes = [{'type': 'node', 'id': i + 1, 'lat': lat, 'lon': lon}
+             for (i, (lat, lon)) in enumerate(((52.0, 21.0), (52.001, 21.0), (52.001, 21.001), (52.0, 21.001)))]
+    way = {'type': 'way', 'id': 10, 'nodes': [1, 2, 3, 4, 1], 'tags': {'building': 'yes'},
+           'bounds': {'minlat': 52.0, 'minlon': 21.0, 'maxlat': 52.001, 'maxlon': 21.001}}
+    db = osmdb.OsmDb({'elements': nodes + [way]}, projected=projected)
+    if projected:
+        # predicates are planar, WGS84 shapes are not used
+        monkeypatch.setattr(db, 'get_prepared_shape', None)
+    building = db.get('way', 10)
+    inside = Point(21.0005, 52.0005)
+    outside = Point(21.0015, 52.0005)
+    assert building.contains(inside) and not building.contains(outside)
+    assert building.contains(inside) == bool(db.containing_point([building], inside)[0])
+    assert building.within(Polygon([(20.9, 51.9), (21.1, 51.9), (21.1, 52.1), (20.9, 52.1)]))
+
+
+def _street(x):
+    return (x._raw.get('tags', {}).get('addr:street', ''),)
+
+
+def _town(count=300):
+    """address nodes on a grid, streets named after rows, with untagged nodes in between"""
+    ret = []
+    for i in range(count):
+        node = _node(i + 1)
+        if i % 3:
+            node['tags'] = {'addr:street': 'Ulica %d' % (i % 20,), 'addr:housenumber': str(i)}
+        ret.append(node)
+    return ret
+
+
+def _state(db):
+    streets = db.getallstreet()
+    return (
+        streets,
+        [sorted(x['id'] for x in db.getbystreet(y)) for y in streets],
+        [x['id'] for x in db.within_radius(Point(19.0005, 50.0005), 30.0)],
+        [x['id'] for x in db.nearest(Point(19.0005, 50.0005), 3)],
+    )
+
+
+@pytest.mark.parametrize('spatial_index', ['rtree', 'strtree'])
+def test_snapshot_is_opened_in_place(tmp_path, spatial_index):
+    backend = spatialindex.backends[spatial_index]
+    fresh = osmdb.ColumnarOsmDb({'elements': _town()}, indexes={'street': _street}, spatial_index=backend)
+    path = str(tmp_path / 'snapshot')
+    fresh.save_snapshot(path)
+    digests = dict((x, hashlib.sha1((tmp_path / 'snapshot' / x).read_bytes()).hexdigest())
+                   for x in os.listdir(path))
+    assert not any(x.endswith('.pickle') for x in digests)
+    opened = osmdb.ColumnarOsmDb(osmdb.load_snapshot(path), indexes={'street': _street}, spatial_index=backend)
+    assert _state(opened) == _state(fresh)
+
+    for db in (fresh, opened):
+        moved = db.getbystreet(('Ulica 1',))[0]
+        moved['tags']['addr:street'] = 'Nowa'
+        db.reindex(moved)
+        db.remove(db.getbystreet(('Ulica 2',))[0])
+        db.add_new({'type': 'node', 'id': -1, 'lat': 50.0005, 'lon': 19.0005, 'tags': {'addr:street': 'Ulica 2'}})
+    assert _state(opened) == _state(fresh)
+    assert ('Nowa',) in opened.getallstreet()
+
+    del opened
+    assert digests == dict((x, hashlib.sha1((tmp_path / 'snapshot' / x).read_bytes()).hexdigest())
+                           for x in os.listdir(path))
+
+
+def _overpass_json():
+    return {
+        'version': 0.6,
+        'osm3s': {'timestamp_osm_base': '2020-01-01T00:00:00Z', 'copyright': 'ODbL'},
+        'elements': [
+            dict(_node(i), tags={'addr:street': 'Źródlana "%d"' % (i,), 'addr:housenumber': '%d\\%d' % (i, i)})
+            for i in range(1, 30)
+        ] + [{'type': 'way', 'id': 1234567890123, 'nodes': [1, 2, 3, 1], 'tags': {'building': 'yes'},
+              'bounds': {'minlat': 50.0, 'minlon': 19.0, 'maxlat': 50.001, 'maxlon': 19.001}}],
+        'remark': 'runtime error: żółw',
+    }
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1024 * 1024])
+@pytest.mark.parametrize('binary', [False, True])
+def test_load_json_in_chunks(chunk_size, binary):
+    data = _overpass_json()
+    text = json.dumps(data, ensure_ascii=False, indent=1)
+    fileobj = io.BytesIO(text.encode('utf-8')) if binary else io.StringIO(text)
+    ret = overpass.load_json(fileobj, chunk_size=chunk_size)
+    assert ret['osm3s'] == data['osm3s']
+    assert 'remark' not in ret
+    assert list(ret['elements']) == data['elements']
+    assert ret['remark'] == data['remark']
+
+
+def test_load_json_empty_and_truncated():
+    assert list(overpass.load_json(io.StringIO('{}'))['elements']) == []
+    ret = overpass.load_json(io.StringIO('{"elements": [ ], "remark": 1}'), chunk_size=1)
+    assert list(ret['elements']) == [] and ret['remark'] == 1
+    text = json.dumps(_overpass_json())
+    ret = overpass.load_json(io.StringIO(text[:text.index('"remark"') - 40]), chunk_size=5)
+    with pytest.raises(ValueError):
+        list(ret['elements'])
+
+
+def test_load_json_into_osmdb():
+    text = json.dumps(_overpass_json())
+    db = osmdb.OsmDb(overpass.load_json(io.BytesIO(text.encode('utf-8')), chunk_size=16))
+    expected = osmdb.OsmDb(json.loads(text))
+    assert db.get('way', 1234567890123)._raw == expected.get('way', 1234567890123)._raw
+    assert sorted(x['id'] for x in db.within_radius(Point(19.0, 50.0), 100.0)) == \
+        sorted(x['id'] for x in expected.within_radius(Point(19.0, 50.0), 100.0))
+
+
+def _ways_db(coords, ways):
+    """OsmDb with nodes at coords (id -> (lon, lat)) and ways (id -> node ids)"""
+    elements = [{'type': 'node', 'id': k, 'lat': lat, 'lon': lon} for (k, (lon, lat)) in coords.items()]
+    for (k, nodes) in ways.items():
+        (lons, lats) = zip(*(coords[x] for x in nodes))
+        elements.append({'type': 'way', 'id': k, 'nodes': nodes,
+                         'bounds': {'minlat': min(lats), 'minlon': min(lons), 'maxlat': max(lats), 'maxlon': max(lons)}})
+    return osmdb.OsmDb({'elements': elements})
+
+
+def test_get_closed_ways_joins_reversed_and_shared_segments():
+    coords = {
+        1: (19.0, 50.0), 2: (19.01, 50.0), 3: (19.01, 50.01), 4: (19.0, 50.01),
+        5: (18.99, 49.99), 6: (19.0, 49.99),
+        7: (19.02, 50.02), 8: (19.03, 50.02), 9: (19.03, 50.03),
+    }
+    ways = {
+        # square, with segments in random order and directions
+        10: [1, 2], 11: [3, 2], 12: [3, 4, 1],
+        # triangle sharing node 1 with the square
+        13: [6, 1], 14: [5, 6], 15: [1, 5],
+        # separate triangle in one way
+        16: [7, 8, 9, 7],
+    }
+    db = _ways_db(coords, ways)
+    lines = [shapely.geometry.LineString([coords[x] for x in nodes]) for nodes in ways.values()]
+    expected = list(shapely.ops.polygonize(lines))
+    for order in ([10, 11, 12, 13, 14, 15, 16], [16, 15, 11, 13, 10, 14, 12], [12, 14, 16, 10, 13, 11, 15]):
+        rings = db.get_closed_ways([db.get('way', x) for x in order])
+        assert all(x.exterior.is_closed for x in rings)
+        assert sum(x.area for x in rings) == pytest.approx(sum(x.area for x in expected))
+        assert shapely.unary_union(rings).symmetric_difference(shapely.unary_union(expected)).area == pytest.approx(0, abs=1e-12)
+
+
+def test_get_closed_ways_open_ring():
+    db = _ways_db({1: (19.0, 50.0), 2: (19.01, 50.0), 3: (19.01, 50.01)}, {10: [1, 2], 11: [3, 2]})
+    with pytest.raises(ValueError):
+        db.get_closed_ways([db.get('way', 10), db.get('way', 11)])
+    assert db.get_closed_ways([]) == []
+
+
+def _boxes(rnd, count):
+    """boxes on a coarse grid, so that many of them are at equal distances"""
+    ret = []
+    for _ in range(count):
+        (x, y) = (rnd.randint(0, 40) * 0.5, rnd.randint(0, 40) * 0.5)
+        ret.append((x, y, x + rnd.randint(0, 2) * 0.5, y + rnd.randint(0, 2) * 0.5))
+    return ret
+
+
+def _backend_results(idx, boxes, queries):
+    ret = []
+    for query in queries:
+        for num_results in (1, 3, 10):
+            found = list(idx.nearest(query, num_results))
+            dists = spatialindex._box_distances(np.array([boxes[x] for x in found]).reshape((-1, 4)), query).tolist()
+            assert dists == sorted(dists)
+            # order of ties is not defined
+            ret.append(sorted(found))
+        ret.append(sorted(idx.intersection(query)))
+    return ret
+
+
+def test_spatial_index_backends_are_equal(tmp_path):
+    rnd = random.Random(3)
+    boxes = dict(enumerate(_boxes(rnd, 500)))
+    queries = [(x, y, x, y) for (x, y, _, _) in _boxes(rnd, 30)] + [(-5, -5, -4, -4), (3, 3, 8, 5)]
+    basename = str(tmp_path / 'rtree')
+    spatialindex.RtreeIndex.save(basename, list(boxes), list(boxes.values()))
+    indexes = dict((name, cls(list(boxes), list(boxes.values()))) for (name, cls) in spatialindex.backends.items())
+    indexes['rtree-loaded'] = spatialindex.RtreeIndex.load(basename)
+    expected = _backend_results(indexes['rtree'], boxes, queries)
+    for (name, idx) in indexes.items():
+        assert _backend_results(idx, boxes, queries) == expected, name
+
+    added = dict((1000 + i, x) for (i, x) in enumerate(_boxes(rnd, 50)))
+    removed = rnd.sample(sorted(boxes), 100)
+    for idx in indexes.values():
+        for (k, v) in added.items():
+            idx.insert(k, v)
+        for k in removed:
+            idx.delete(k, boxes[k])
+    boxes.update(added)
+    expected = _backend_results(spatialindex.RtreeIndex(
+        [x for x in boxes if x not in removed], [v for (k, v) in boxes.items() if k not in removed]), boxes, queries)
+    for (name, idx) in indexes.items():
+        assert _backend_results(idx, boxes, queries) == expected, name
+
+
+def test_spatial_index_backends_empty():
+    for (name, cls) in spatialindex.backends.items():
+        idx = cls()
+        assert list(idx.nearest((19.0, 50.0))) == [], name
+        assert list(idx.intersection((19.0, 50.0, 20.0, 51.0))) == [], name
+        idx.insert(1, (19.5, 50.5, 19.5, 50.5))
+        assert list(idx.nearest((19.0, 50.0))) == [1], name
+        assert list(idx.intersection((19.0, 50.0, 20.0, 51.0))) == [1], name
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = utils.LRUCache(10, len)
+    for key in 'abc':
+        cache[key] = key * 3
+    assert (len(cache), cache.size) == (3, 9)
+    # a is used recently, b is evicted first
+    assert cache.get('a') == 'aaa'
+    cache['d'] = 'dd'
+    assert cache.get('b') is None
+    assert [cache.get(x) for x in 'acd'] == ['aaa', 'ccc', 'dd']
+    assert cache.size == 8
+    # replacing a value does not count it twice
+    cache['c'] = 'c'
+    assert (len(cache), cache.size) == (3, 6)
+    # value larger than the whole cache is not kept, and does not evict others
+    cache['e'] = 'e' * 11
+    assert cache.get('e') is None
+    assert (len(cache), cache.size) == (3, 6)
+    cache['f'] = 'f' * 10
+    assert [cache.get(x) for x in 'acdf'] == [None, None, None, 'f' * 10]
+    assert cache.pop('f') == 'f' * 10 and cache.size == 0
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (5, 5, 4)
+
+
+def test_osmdb_caches_are_bounded_per_instance():
+    elements = [_node(i) for i in range(1, 101)]
+    small = osmdb.OsmDb({'elements': copy.deepcopy(elements)}, position_cache_size=10 * osmdb._position_size)
+    large = osmdb.OsmDb({'elements': copy.deepcopy(elements)})
+    for db in (small, large):
+        for x in elements:
+            db.get_position(db.get('node', x['id'])._raw)
+    assert small.cache_stats()['positions']['entries'] == 10
+    assert small.cache_stats()['positions']['size'] <= 10 * osmdb._position_size
+    assert large.cache_stats()['positions']['entries'] == 100
+    assert small.get_position(small.get('node', 1)._raw) == large.get_position(large.get('node', 1)._raw)
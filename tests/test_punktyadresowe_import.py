@@ -0,0 +1,105 @@
+from urllib.parse import parse_qs, urlsplit
+
+import lxml.etree
+import pytest
+from shapely.geometry import box
+
+import punktyadresowe_import
+from fetcher import HttpCache
+from punktyadresowe_import import GUGiK, e2180toWGS
+
+# addresses on a 4 x 4 grid, 400m apart, in EPSG:2180
+_origin = (500000.0, 400000.0)
+_points = [(_origin[0] + 250 + 400 * (i % 4), _origin[1] + 250 + 400 * (i // 4)) for i in range(16)]
+_area = (_origin[0], _origin[1], _origin[0] + 1800, _origin[1] + 1800)
+
+
+def _kml(points):
+    placemarks = []
+    for (i, (x, y)) in points:
+        (lon, lat) = e2180toWGS(x, y)
+        description = '<h4>Punkt adresowy</h4><ul>' + ''.join(
+            '<li><strong><span>%s</span>:</strong> <span>%s</span></li>' % kv for kv in (
+                ('IDENTYFIKATOR_PUNKTU', 'PL.TEST.%d.1' % (i,)),
+                ('NUMER_PORZADKOWY', str(i + 1)),
+                ('NAZWA_MIEJSCOWOSCI', 'Wieś'),
+                ('STATUS', 'zatwierdzony'),
+            )) + '</ul>'
+        placemarks.append('<Placemark><description><![CDATA[%s]]></description><Point><coordinates>%.7f,%.7f</coordinates>'
+                          '</Point></Placemark>' % (description, lon, lat))
+    return ('<?xml version="1.0" encoding="UTF-8"?><kml xmlns="http://www.opengis.net/kml/2.2"><Document>%s</Document></kml>'
+            % (''.join(placemarks),)).encode('utf-8')
+
+
+def _bbox(path):
+    return tuple(map(float, parse_qs(urlsplit(path).query)['BBOX'][0].split(',')))
+
+
+def _within(bbox):
+    return [(i, (x, y)) for (i, (x, y)) in enumerate(_points) if bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]]
+
+
+@pytest.fixture
+def gugik(http_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(punktyadresowe_import, 'mapstreet', lambda name, sym_ul: name)
+    monkeypatch.setattr(punktyadresowe_import, 'mapcity', lambda name, simc: name)
+    monkeypatch.setattr(GUGiK, '_GUGiK__base_url', http_server.url + '/wms?BBOX=')
+    monkeypatch.setattr(GUGiK, '_GUGiK__MAX_TILE_FEATURES', 5)
+    monkeypatch.setattr(punktyadresowe_import._fetcher, 'cache', HttpCache(str(tmp_path)))
+    ret = GUGiK(None)
+    ret.bbox = e2180toWGS(*_area[:2]) + e2180toWGS(*_area[2:])
+    ret.shape = box(*ret.bbox)
+    return ret
+
+
+def test_dense_tile_is_split_and_not_cached(gugik, http_server):
+    http_server.respond = lambda path: (200, {}, _kml(_within(_bbox(path))))
+    assert sorted(int(x.housenumber) for x in gugik.fetchTiles()) == list(range(1, 17))
+    cache = punktyadresowe_import._fetcher.cache
+    for path in http_server.requests:
+        cached = cache.get(http_server.url + path)
+        if len(_within(_bbox(path))) >= 5:
+            assert cached is None
+        else:
+            assert cached is not None
+
+    # next run reads only complete tiles from cache, tiles over the limit are downloaded again
+    requests = len(http_server.requests)
+    assert requests > 1
+    assert len(gugik.fetchTiles()) == 16
+    assert all(len(_within(_bbox(x))) >= 5 for x in http_server.requests[requests:])
+
+
+def test_error_response_fails_without_splitting(gugik, http_server):
+    http_server.respond = lambda path: (200, {}, b'<?xml version="1.0"?><ServiceExceptionReport/>')
+    with pytest.raises(ValueError):
+        gugik.fetchTiles()
+    assert len(http_server.requests) == 1
+
+    http_server.respond = lambda path: (200, {}, b'<html><body>Internal error</body')
+    with pytest.raises(lxml.etree.XMLSyntaxError):
+        gugik.fetchTiles()
+    assert len(http_server.requests) == 2
+
+
+def test_truncated_tile_is_split(gugik, http_server):
+    def respond(path):
+        bbox = _bbox(path)
+        body = _kml(_within(bbox))
+        if bbox[2] - bbox[0] > 1000:
+            body = body[:len(body) // 2]
+        return (200, {}, body)
+
+    http_server.respond = respond
+    assert sorted(int(x.housenumber) for x in gugik.fetchTiles()) == list(range(1, 17))
+    assert len(http_server.requests) > 1
+
+
+def test_number_of_splits_is_limited(gugik, http_server, monkeypatch):
+    monkeypatch.setattr(GUGiK, '_GUGiK__MAX_TILE_FEATURES', 1)
+    monkeypatch.setattr(GUGiK, '_GUGiK__MAX_TILE_SPLITS', 3)
+    monkeypatch.setattr(GUGiK, '_GUGiK__MIN_TILE_SIZE', 10)
+    http_server.respond = lambda path: (200, {}, _kml(_within(_bbox(path))))
+    with pytest.raises(ValueError):
+        gugik.fetchTiles()
+    assert len(http_server.requests) <= 1 + 4 * 3
@@ -1,4 +1,5 @@
 from concurrent.futures import ThreadPoolExecutor
+import collections
 import functools
 import multiprocessing
 import itertools
@@ -36,6 +37,69 @@ def groupby(lst, keyfunc=lambda x: x, valuefunc=lambda x: x):
         entry.append(valuefunc(i))
     return ret
 
+class LRUCache(object):
+    """
+    Mapping that evicts least recently used values, when total size of values (as returned
+    by sizefunc) exceeds max_size. Counts hits and misses of get().
+    """
+    def __init__(self, max_size, sizefunc=lambda x: 1):
+        self.max_size = max_size
+        self._sizefunc = sizefunc
+        self._data = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            (value, size) = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        size = self._sizefunc(value)
+        if size > self.max_size:
+            # would evict everything else
+            return
+        self._data[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            (_, (_, evicted)) = self._data.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        try:
+            (value, size) = self._data.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
 def main():
     from time import sleep,time
     print(time())